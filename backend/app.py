@@ -1,78 +1,36 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from flask_cors import CORS
 import os
-import joblib
-import pandas as pd
-import numpy as np
+import threading
 from datetime import datetime, timedelta
 import json
-import logging
-from logging.handlers import RotatingFileHandler
 import time
-# 祝日ライブラリ（任意）
-try:
-    import jpholiday  # type: ignore
-    HAS_JPHOLIDAY = True
-except Exception:
-    HAS_JPHOLIDAY = False
+# 重いライブラリ（pandas・joblib・jpholiday・supabase）は起動を速くするため、
+# 使う関数の中か起動ステップ（startup.py）で import する
 
 app = Flask(__name__)
-# --- Logging setup: rotating file + console, request/response/error tracing ---
-def setup_logging(flask_app: Flask) -> None:
-    try:
-        log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-        os.makedirs(log_dir, exist_ok=True)
-        log_file_path = os.path.join(log_dir, 'app.log')
-
-        formatter = logging.Formatter(
-            '%(asctime)s %(levelname)s %(name)s - %(message)s'
-        )
-
-        root_logger = logging.getLogger()
-        root_logger.setLevel(logging.INFO)
-
-        # File handler (rotating)
-        file_handler = RotatingFileHandler(
-            log_file_path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'
-        )
-        file_handler.setFormatter(formatter)
-        file_handler.setLevel(logging.INFO)
-
-        # Console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        console_handler.setLevel(logging.INFO)
+# --- Logging setup: queue-based structured logging, request/response/error tracing ---
+from log_pipeline import setup_logging, request_body_preview
 
-        # Avoid duplicate handler registration when reloaded
-        if not any(isinstance(h, RotatingFileHandler) for h in root_logger.handlers):
-            root_logger.addHandler(file_handler)
-        if not any(isinstance(h, logging.StreamHandler) and not isinstance(h, RotatingFileHandler) for h in root_logger.handlers):
-            root_logger.addHandler(console_handler)
-
-        flask_app.logger.handlers = root_logger.handlers
-        flask_app.logger.setLevel(logging.INFO)
-        flask_app.logger.info('Logging initialized')
-    except Exception as log_err:
-        # As a last resort, print to stdout; do not raise
-        print(f"Failed to setup logging: {log_err}")
-
-
-setup_logging(app)
+setup_logging(app, os.path.join(os.path.dirname(__file__), 'logs'), 'app.log')
 
 @app.before_request
 def _log_request():
     g.request_start_time = time.time()
     g.request_id = f"{int(g.request_start_time * 1000)}-{os.getpid()}"
-    body_preview = ''
     try:
-        if request.is_json:
-            body_preview = json.dumps(request.get_json(silent=True))
-            if body_preview and len(body_preview) > 500:
-                body_preview = body_preview[:500] + '...'
+        body_preview = request_body_preview(request)
     except Exception:
         body_preview = '<unparsable>'
     app.logger.info(
-        f"[{g.request_id}] {request.method} {request.path} from {request.remote_addr} body={body_preview}"
+        f"[{g.request_id}] {request.method} {request.path} from {request.remote_addr}",
+        extra={
+            'request_id': g.request_id,
+            'method': request.method,
+            'path': request.path,
+            'remote_addr': request.remote_addr,
+            'body': body_preview
+        }
     )
 
 
@@ -81,7 +39,14 @@ def _log_response(response):
     try:
         duration_ms = int((time.time() - getattr(g, 'request_start_time', time.time())) * 1000)
         app.logger.info(
-            f"[{getattr(g, 'request_id', '-')}] {request.method} {request.path} -> {response.status_code} in {duration_ms}ms"
+            f"[{getattr(g, 'request_id', '-')}] {request.method} {request.path} -> {response.status_code} in {duration_ms}ms",
+            extra={
+                'request_id': getattr(g, 'request_id', ''),
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': duration_ms
+            }
         )
         response.headers['X-Request-ID'] = getattr(g, 'request_id', '')
         response.headers['X-Process-Time'] = str(duration_ms)
@@ -104,177 +69,187 @@ CORS(app, resources={
 
 # Supabase設定
 from supabase_client import SupabaseService
-
-# Supabaseサービスを初期化
-supabase_service = SupabaseService()
+from prediction_spool import spool_from_env
+
+# Supabaseサービスを初期化（クライアントの作成は起動ステップで行う）
+supabase_service = SupabaseService(connect=False)
+
+# ワーカーごとの直近の予測のリングバッファ（小さい /api/history と /api/stats の直近部分を返す）
+from recent_predictions import recent_from_env
+recent_predictions = recent_from_env()
+
+# 予測ログの書き込み先スレッドプール（ASGIモードで設定され、リクエストを待たせずに記録する）
+prediction_log_executor = None
+
+def log_prediction(prediction_data):
+    """予測結果をSupabaseに記録（executor が設定されていればバックグラウンドで実行）"""
+    log_predictions([prediction_data])
+
+def log_predictions(predictions):
+    """1リクエスト分の予測結果をまとめてSupabaseに記録（同じモデル・日付・特徴量の予測は1行にまとめる）"""
+    version = prediction_model_version()
+    # Supabase に接続できない間もバッファには記録する（/api/history・/api/stats はバッファから返せる）
+    recent_predictions.record(predictions, version)
+    if not supabase_service.is_available():
+        return
+    if prediction_log_executor is not None:
+        prediction_log_executor.submit(supabase_service.log_predictions, predictions, version)
+        return
+    supabase_service.log_predictions(predictions, version)
+
+# カラムナ形式レスポンス（?format=columnar で opt-in）
+from response_format import wants_columnar, columnar_response
+# ETag / Cache-Control による条件付きキャッシュ
+from http_cache import conditional, request_payload, file_signature, file_digest, calendar_version
+# gzip / brotli レスポンス圧縮
+from compression import init_compression
+init_compression(app)
+# Prometheus メトリクス（/metrics）
+from metrics import init_metrics, stage, timed, set_model_version
+init_metrics(app)
+# オンデマンドのリクエストプロファイリング（PROFILE_TOKEN 設定時のみ有効）
+from profiling import init_profiling
+init_profiling(app, os.path.join(os.path.dirname(__file__), 'logs', 'profiles'))
+# 推論コア（モデルのロード・ベクトル化推論・予測キャッシュ・マイクロバッチ）
+from inference import build_features, find_model_file, load_engine
+# 予測履歴のキーセットページネーションとエクスポート（NDJSON / CSV）
+from history_query import EXPORT_FORMATS, EXPORT_MIMETYPES, HistoryQuery, csv_lines, ndjson_lines, next_cursor
+# 起動パイプライン（モデルのロードをバックグラウンドで行い、完了までは /api/health が starting を返す）
+from startup import Warmup, requires_warmup
+warmup = Warmup()
 
 # モデルのパスを設定（環境変数から取得、または固定パス）
 RF_MODEL_PATH = os.environ.get('RF_MODEL_PATH', '../fixed_rf_model.joblib')
 PROPHET_MODEL_PATH = os.environ.get('PROPHET_MODEL_PATH', '../prophet_model.joblib')
-
-# RandomForestモデルをロード
+SCENARIO_DATA_PATH = '../ultimate_pickup_data.csv'
+# サービング階層: forest（既定、RandomForest）/ student（distill_forest.py で蒸留した低レイテンシの生徒モデル）
+SERVING_TIER = os.environ.get('SERVING_TIER', 'forest')
+STUDENT_MODEL_PATH = os.environ.get('STUDENT_MODEL_PATH', 'models/fixed_rf_model.student.npz')
+
+# 実際にロードしたモデルファイル（ETag のモデルバージョンに使用）
+rf_model_path = None
+prophet_model_path = None
+# 実際に使っているサービング階層（生徒モデルをロードできなければ forest）
+serving_tier = None
+
+# RandomForestモデルをロード（見つからない・ロードできない場合は代替モデル）
 def load_rf_model():
-    try:
-        # ローカルファイルからモデルをロード
-        model_paths = [
-            os.path.abspath(RF_MODEL_PATH),
-            os.path.abspath('models/fixed_rf_model.joblib'),
-            os.path.abspath('../fixed_rf_model.joblib'),
-            os.path.abspath('./models/fixed_rf_model.joblib'),
-            os.path.abspath('./fixed_rf_model.joblib')
-        ]
-
-        # すべてのパスをチェック
-        model_path = None
-        for path in model_paths:
-            if os.path.exists(path):
-                print(f"モデルファイルが見つかりました: {path}")
-                model_path = path
-                break
-
-        if model_path is None:
-            print(f"警告: どのパスにもモデルファイルが見つかりません。")
-            print("ダミーモデルを使用します。")
-            class CustomRandomModel:
-                def predict(self, X):
-                    print(f"カスタムモデルが予測します。特徴量: {X.shape}")
-                    # 入力特徴量に基づいて変動する予測値を返す
-                    # total_outpatientとERの影響を反映
-                    base_pred = 3.5
-                    total_effect = (X['total_outpatient'].values[0] - 500) / 500 * 1.0  # 外来患者の影響
-                    er_effect = (X['ER'].values[0] - 15) / 15 * 0.5  # 救急患者の影響
-                    intro_effect = (X['intro_outpatient'].values[0] - 20) / 20 * 0.3  # 紹介患者の影響
-                    holiday_effect = -0.5 if X['public_holiday'].values[0] > 0 else 0  # 祝日の影響
-                    
-                    # 曜日の影響
-                    day_effect = 0
-                    if X['sat'].values[0] > 0:
-                        day_effect = -0.2
-                    elif X['sun'].values[0] > 0:
-                        day_effect = -0.3
-                    
-                    # 最終予測
-                    pred = base_pred + total_effect + er_effect + intro_effect + holiday_effect + day_effect
-                    pred = max(0.5, pred)  # 最低値を0.5に制限
-                    
-                    print(f"予測値: {pred}, 影響: 外来={total_effect}, 救急={er_effect}, 紹介={intro_effect}, 祝日={holiday_effect}, 曜日={day_effect}")
-                    return np.array([pred])
-            return CustomRandomModel()
-        
-        # ローカルファイルからモデルをロード
-        print(f"ローカルファイルからモデルをロード中: {model_path}")
-        try:
-            model = joblib.load(model_path)
-            print("モデルを正常にロードしました")
-            
-            # モデルの内部構造を確認
-            print(f"モデルの型: {type(model)}")
-            if hasattr(model, 'feature_importances_'):
-                print(f"特徴量の重要度: {model.feature_importances_}")
-            
-            # モデルの内部構造を修正（必要な場合）
-            if hasattr(model, 'estimators_'):
-                print(f"推定器の数: {len(model.estimators_)}")
-                for estimator in model.estimators_:
-                    if not hasattr(estimator, 'monotonic_cst'):
-                        estimator.monotonic_cst = None
-                
-                # テスト予測を実行
-                test_features = pd.DataFrame([{
-                    'total_outpatient': 500,
-                    'intro_outpatient': 20,
-                    'ER': 15,
-                    'bed_count': 280,
-                    'public_holiday': 0,
-                    'public_holiday_previous_day': 0,
-                    'mon': 0, 'tue': 0, 'wed': 0, 'thu': 1, 'fri': 0, 'sat': 0, 'sun': 0
-                }])
-                test_pred = model.predict(test_features)
-                print(f"テスト予測値: {test_pred[0]}")
-            
-            return model
-        except Exception as inner_e:
-            print(f"モデルのロード中にエラーが発生しました: {inner_e}")
-            print("代替のカスタムモデルを使用します。")
-            class CustomRandomModel:
-                def predict(self, X):
-                    print(f"カスタムモデルが予測します。特徴量: {X.shape}")
-                    # 入力特徴量に基づいて変動する予測値を返す
-                    # total_outpatientとERの影響を反映
-                    base_pred = 3.5
-                    total_effect = (X['total_outpatient'].values[0] - 500) / 500 * 1.0  # 外来患者の影響
-                    er_effect = (X['ER'].values[0] - 15) / 15 * 0.5  # 救急患者の影響
-                    intro_effect = (X['intro_outpatient'].values[0] - 20) / 20 * 0.3  # 紹介患者の影響
-                    holiday_effect = -0.5 if X['public_holiday'].values[0] > 0 else 0  # 祝日の影響
-                    
-                    # 曜日の影響
-                    day_effect = 0
-                    if X['sat'].values[0] > 0:
-                        day_effect = -0.2
-                    elif X['sun'].values[0] > 0:
-                        day_effect = -0.3
-                    
-                    # 最終予測
-                    pred = base_pred + total_effect + er_effect + intro_effect + holiday_effect + day_effect
-                    pred = max(0.5, pred)  # 最低値を0.5に制限
-                    
-                    print(f"予測値: {pred}, 影響: 外来={total_effect}, 救急={er_effect}, 紹介={intro_effect}, 祝日={holiday_effect}, 曜日={day_effect}")
-                    return np.array([pred])
-            return CustomRandomModel()
-    except Exception as e:
-        print(f"モデルのロードに失敗しました: {e}")
-        # 代替のカスタムモデルを返す
-        class CustomRandomModel:
-            def predict(self, X):
-                print(f"カスタムモデルが予測します。特徴量: {X.shape}")
-                # 入力特徴量に基づいて変動する予測値を返す
-                # total_outpatientとERの影響を反映
-                base_pred = 3.5
-                total_effect = (X['total_outpatient'].values[0] - 500) / 500 * 1.0  # 外来患者の影響
-                er_effect = (X['ER'].values[0] - 15) / 15 * 0.5  # 救急患者の影響
-                intro_effect = (X['intro_outpatient'].values[0] - 20) / 20 * 0.3  # 紹介患者の影響
-                holiday_effect = -0.5 if X['public_holiday'].values[0] > 0 else 0  # 祝日の影響
-                
-                # 曜日の影響
-                day_effect = 0
-                if X['sat'].values[0] > 0:
-                    day_effect = -0.2
-                elif X['sun'].values[0] > 0:
-                    day_effect = -0.3
-                
-                # 最終予測
-                pred = base_pred + total_effect + er_effect + intro_effect + holiday_effect + day_effect
-                pred = max(0.5, pred)  # 最低値を0.5に制限
-                
-                print(f"予測値: {pred}, 影響: 外来={total_effect}, 救急={er_effect}, 紹介={intro_effect}, 祝日={holiday_effect}, 曜日={day_effect}")
-                return np.array([pred])
-        return CustomRandomModel()
+    global rf_model_path, serving_tier
+    if SERVING_TIER == 'student':
+        engine = load_engine([STUDENT_MODEL_PATH], name='student', fallback=False)
+        if engine is not None:
+            rf_model_path = engine.model_path
+            serving_tier = 'student'
+            return engine
+        print("警告: 生徒モデルをロードできないため、RandomForestモデルを使用します。")
+    serving_tier = 'forest'
+    engine = load_engine([
+        RF_MODEL_PATH,
+        'models/fixed_rf_model.npz',
+        'models/fixed_rf_model.joblib',
+        '../fixed_rf_model.joblib',
+        './fixed_rf_model.joblib'
+    ])
+    rf_model_path = engine.model_path
+    return engine
 
 # Prophetモデルをロード
 def load_prophet_model():
+    global prophet_model_path
     try:
-        # Prophet用のパスをチェック
-        prophet_paths = [
-            os.path.abspath(PROPHET_MODEL_PATH),
-            os.path.abspath('../prophet_model.joblib'),
-            os.path.abspath('./prophet_model.joblib'),
-            os.path.abspath('models/prophet_model.joblib')
-        ]
-
-        for path in prophet_paths:
-            if os.path.exists(path):
-                print(f"Prophetモデルファイルが見つかりました: {path}")
-                return joblib.load(path)
-
-        print("警告: Prophetモデルが見つかりません。")
-        return None
+        path = find_model_file([
+            PROPHET_MODEL_PATH,
+            '../prophet_model.joblib',
+            './prophet_model.joblib',
+            'models/prophet_model.joblib'
+        ])
+        if path is None:
+            print("警告: Prophetモデルが見つかりません。")
+            return None
+        print(f"Prophetモデルファイルが見つかりました: {path}")
+        import joblib
+        model = joblib.load(path)
+        prophet_model_path = path
+        return model
     except Exception as e:
         print(f"Prophetモデルのロードに失敗しました: {e}")
         return None
 
-# 両方のモデルをロード
-rf_model = load_rf_model()
-prophet_model = load_prophet_model()
+# モデルは起動ステップでロードする（それまでは None）
+rf_engine = None
+rf_model = None
+prophet_model = None
+
+# マイクロバッチはモデルのロード前に要求されることがあるため、要求を覚えておきロード後に有効化する
+predict_batching_requested = False
+_batching_lock = threading.Lock()
+
+def enable_predict_batching():
+    """同時に届いた単日予測を1回の推論にまとめるディスパッチャを有効化する（PREDICT_BATCHING=1 で起動時に有効）"""
+    global predict_batching_requested
+    with _batching_lock:
+        predict_batching_requested = True
+        if rf_engine is None:
+            return None
+        return rf_engine.enable_batching(
+            max_batch_size=int(os.environ.get('PREDICT_BATCH_MAX_SIZE', 32)),
+            max_wait_ms=float(os.environ.get('PREDICT_BATCH_MAX_WAIT_MS', 2))
+        )
+
+if os.environ.get('PREDICT_BATCHING', '0') == '1':
+    enable_predict_batching()
+
+def forecast_version():
+    """予測結果を左右するバージョン（モデル・祝日カレンダー）。MODEL_VERSION で明示指定も可能"""
+    model_version = os.environ.get('MODEL_VERSION') or f"{file_signature(rf_model_path)}|{file_signature(prophet_model_path)}"
+    return f"{model_version}|{calendar_version()}"
+
+def prediction_model_version():
+    """予測ログに記録するモデルのバージョン（MODEL_VERSION、なければモデルファイルの内容のハッシュ）"""
+    return os.environ.get('MODEL_VERSION') or file_digest(rf_model_path)
+
+def scenario_version():
+    """シナリオ一覧のバージョン（元データCSV）"""
+    return file_signature(os.path.abspath(SCENARIO_DATA_PATH))
+
+# 起動ステップ（登録順にバックグラウンドで実行）
+@warmup.step('randomforest')
+def _load_randomforest():
+    global rf_engine, rf_model
+    engine = load_rf_model()
+    with _batching_lock:
+        rf_engine = engine
+        rf_model = engine.model
+    if predict_batching_requested:
+        enable_predict_batching()
+
+@warmup.step('prophet')
+def _load_prophet():
+    global prophet_model
+    prophet_model = load_prophet_model()
+
+@warmup.step('libraries')
+def _import_libraries():
+    # 最初のリクエストで import 待ちにならないよう先に読み込む
+    import pandas  # noqa: F401
+    holiday_module()
+
+@warmup.step('supabase')
+def _connect_supabase():
+    if supabase_service.connect():
+        # 予測ログはローカルのスプールに書き、バックグラウンドで一括挿入する（SPOOL_DIR= で無効）
+        try:
+            spool = spool_from_env(supabase_service.insert_prediction_logs, 'supabase')
+        except OSError as e:
+            # スプールのディレクトリに書けなくても起動は止めず、予測ログは直接挿入する
+            app.logger.error(f"Failed to open prediction spool, logging predictions directly: {e}")
+            spool = None
+        if spool is not None:
+            supabase_service.attach_spool(spool)
+
+@warmup.step('model_version')
+def _set_model_version():
+    set_model_version(forecast_version())
 
 # 日付から曜日コードを取得する関数
 def get_day_code(date_str=None):
@@ -336,7 +311,24 @@ def day_name_ja(day_code):
     }
     return day_map.get(day_code, '不明')
 
+# 祝日ライブラリ（任意、初回利用時に import）
+_jpholiday = None
+_jpholiday_checked = False
+
+def holiday_module():
+    """jpholiday モジュール（使えなければ None）"""
+    global _jpholiday, _jpholiday_checked
+    if not _jpholiday_checked:
+        try:
+            import jpholiday  # type: ignore
+            _jpholiday = jpholiday
+        except Exception:
+            _jpholiday = None
+        _jpholiday_checked = True
+    return _jpholiday
+
 # 日本の祝日チェック関数（簡易版）
+@timed('holiday_lookup')
 def is_japanese_holiday(date_str):
     """日付が日本の祝日かどうかをチェック。
     jpholiday が使える場合はそれを使用し、なければ簡易版にフォールバック。
@@ -346,7 +338,8 @@ def is_japanese_holiday(date_str):
     except Exception:
         return False
 
-    if HAS_JPHOLIDAY:
+    jpholiday = holiday_module()
+    if jpholiday is not None:
         try:
             return jpholiday.is_holiday(date_obj)
         except Exception:
@@ -399,53 +392,54 @@ def root():
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
+    """ヘルスチェック（起動処理が終わるまでは starting、失敗したら failed を 503 で返す）"""
+    startup_status = warmup.status()
+    status = {'ready': 'healthy', 'failed': 'failed'}.get(startup_status['state'], 'starting')
     return jsonify({
-        "status": "healthy",
+        "status": status,
+        "startup": startup_status,
         "rf_model_loaded": rf_model is not None,
         "prophet_model_loaded": prophet_model is not None,
         "current_date": datetime.now().strftime('%Y-%m-%d'),
         "current_day": get_day_code(),
         "current_season": get_season()
-    })
+    }), 200 if status == 'healthy' else 503
 
-@app.route('/api/predict', methods=['POST'])
+@app.route('/api/predict', methods=['GET', 'POST'])
+@requires_warmup(warmup)
+@conditional(forecast_version, max_age=300, date_keys=('date',))
 def predict():
     try:
-        # リクエストからデータを取得
-        data = request.json
+        # リクエストからデータを取得（GETはクエリ文字列）
+        data = request_payload()
         print(f"受信したデータ: {data}")
         
         # 日付が指定されていない場合は現在の日付を使用
-        date_str = data.get('date', datetime.now().strftime('%Y-%m-%d'))
-        day_code = get_day_code(date_str)
-
-        # 自動的に日本の祝日をチェック
-        is_holiday = is_japanese_holiday(date_str)
-        is_prev_holiday = is_previous_day_holiday(date_str)
-
-        # 曜日のone-hotエンコーディング
-        day_features = {day: 1 if day == day_code else 0 for day in ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']}
-
-        # 特徴量を作成（祝日は自動設定）
-        features = {
-            **day_features,
-            'public_holiday': 1 if is_holiday else 0,
-            'public_holiday_previous_day': 1 if is_prev_holiday else 0,
-            'total_outpatient': data.get('total_outpatient', 500),
-            'intro_outpatient': data.get('intro_outpatient', 20),
-            'ER': data.get('ER', 15),
-            'bed_count': data.get('bed_count', 280)
-        }
+        with stage('feature_build'):
+            date_str = data.get('date', datetime.now().strftime('%Y-%m-%d'))
+            day_code = get_day_code(date_str)
+
+            # 自動的に日本の祝日をチェック
+            is_holiday = is_japanese_holiday(date_str)
+            is_prev_holiday = is_previous_day_holiday(date_str)
+
+            # 特徴量を作成（祝日は自動設定）
+            features = build_features(
+                day_code,
+                public_holiday=1 if is_holiday else 0,
+                public_holiday_previous_day=1 if is_prev_holiday else 0,
+                total_outpatient=data.get('total_outpatient', 500),
+                intro_outpatient=data.get('intro_outpatient', 20),
+                ER=data.get('ER', 15),
+                bed_count=data.get('bed_count', 280)
+            )
         
-        # DataFrameに変換
-        df = pd.DataFrame([features])
-        
-        # RandomForestモデルで予測を実行
-        prediction = rf_model.predict(df)
+        # RandomForestモデルで予測を実行（マイクロバッチが有効ならまとめて推論）
+        prediction = rf_engine.predict_one(features)
         
         # 予測結果を準備
         prediction_result = {
-            "prediction": round(float(prediction[0]), 1),
+            "prediction": round(prediction, 1),
             "date": date_str,
             "day": day_code,
             "day_name": day_name_ja(day_code),
@@ -454,23 +448,27 @@ def predict():
         }
 
         # Supabaseにログ記録（エラーがあっても処理は継続）
-        try:
-            supabase_service.log_prediction(prediction_result)
-        except Exception as log_error:
-            print(f"Supabaseログ記録エラー: {log_error}")
+        with stage('supabase_log'):
+            try:
+                log_prediction(prediction_result)
+            except Exception as log_error:
+                print(f"Supabaseログ記録エラー: {log_error}")
 
         # 結果を返す
-        return jsonify(prediction_result)
+        with stage('serialization'):
+            return jsonify(prediction_result)
         
     except Exception as e:
         print(f"予測中にエラーが発生しました: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/predict_week', methods=['POST'])
+@app.route('/api/predict_week', methods=['GET', 'POST'])
+@requires_warmup(warmup)
+@conditional(forecast_version, max_age=300, date_keys=('start_date',))
 def predict_week():
     try:
-        # リクエストからデータを取得
-        data = request.json
+        # リクエストからデータを取得（GETはクエリ文字列）
+        data = request_payload()
         print(f"受信したデータ: {data}")
         
         # 開始日が指定されていない場合は現在の日付を使用
@@ -492,9 +490,11 @@ def predict_week():
 
         if use_prophet and prophet_model is not None:
             # Prophetで時系列予測
+            import pandas as pd
             future_dates = pd.date_range(start=start_date_obj, periods=7, freq='D')
             future_df = pd.DataFrame({'ds': future_dates})
-            forecast = prophet_model.predict(future_df)
+            with stage('inference'):
+                forecast = prophet_model.predict(future_df)
 
             for i, (_, row) in enumerate(forecast.iterrows()):
                 current_date = start_date_obj + timedelta(days=i)
@@ -533,78 +533,82 @@ def predict_week():
                     "model_used": "prophet"
                 })
         else:
-            # RandomForestで予測（デフォルト）
+            # RandomForestで予測（デフォルト）: 7日分の特徴量を作ってから1回で推論する
+            days = []
             for i in range(7):
                 current_date = start_date_obj + timedelta(days=i)
                 date_str = current_date.strftime('%Y-%m-%d')
-                day_code = get_day_code(date_str)
-
-                # 曜日のone-hotエンコーディング
-                day_features = {day: 1 if day == day_code else 0 for day in ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']}
-
-                # 週末・祝日で表示用の特徴量を調整
-                is_weekend = day_code in ['sat', 'sun']
-                is_holiday = is_japanese_holiday(date_str)
-                if is_weekend or is_holiday:
-                    adjusted_outpatient = int(base_outpatient * 0.3)
-                    adjusted_intro = int(base_intro * 0.2)
-                    adjusted_er = int(base_er * 1.2)
-                else:
-                    adjusted_outpatient = base_outpatient
-                    adjusted_intro = base_intro
-                    adjusted_er = base_er
-
-                # 予測用の特徴量を作成
-                features = {
-                    **day_features,
-                    'public_holiday': 1 if is_holiday else 0,
-                    'public_holiday_previous_day': 1 if is_previous_day_holiday(date_str) else 0,
-                    'total_outpatient': adjusted_outpatient,
-                    'intro_outpatient': adjusted_intro,
-                    'ER': adjusted_er,
-                    'bed_count': bed_count
-                }
-
-                # DataFrameに変換
-                df = pd.DataFrame([features])
-
-                # RandomForestで予測
-                prediction = rf_model.predict(df)
-
-                # 結果を追加
+                with stage('feature_build'):
+                    day_code = get_day_code(date_str)
+
+                    # 週末・祝日で表示用の特徴量を調整
+                    is_weekend = day_code in ['sat', 'sun']
+                    is_holiday = is_japanese_holiday(date_str)
+                    if is_weekend or is_holiday:
+                        adjusted_outpatient = int(base_outpatient * 0.3)
+                        adjusted_intro = int(base_intro * 0.2)
+                        adjusted_er = int(base_er * 1.2)
+                    else:
+                        adjusted_outpatient = base_outpatient
+                        adjusted_intro = base_intro
+                        adjusted_er = base_er
+
+                    # 予測用の特徴量を作成
+                    features = build_features(
+                        day_code,
+                        public_holiday=1 if is_holiday else 0,
+                        public_holiday_previous_day=1 if is_previous_day_holiday(date_str) else 0,
+                        total_outpatient=adjusted_outpatient,
+                        intro_outpatient=adjusted_intro,
+                        ER=adjusted_er,
+                        bed_count=bed_count
+                    )
+                days.append((current_date, date_str, day_code, is_weekend, is_holiday, features))
+
+            # RandomForestで予測
+            week_values = rf_engine.predict_rows([day[-1] for day in days])
+
+            for (current_date, date_str, day_code, is_weekend, is_holiday, features), prediction in zip(days, week_values):
                 predictions.append({
                     "date": date_str,
                     "day": day_code,
                     "day_label": ['月', '火', '水', '木', '金', '土', '日'][current_date.weekday()],
                     "day_name": day_name_ja(day_code),
-                    "prediction": round(float(prediction[0]), 1),
+                    "prediction": round(float(prediction), 1),
                     "is_weekend": is_weekend,
                     "is_holiday": is_holiday,
                     "features": {
-                        'total_outpatient': adjusted_outpatient,
-                        'intro_outpatient': adjusted_intro,
-                        'ER': adjusted_er,
+                        'total_outpatient': features['total_outpatient'],
+                        'intro_outpatient': features['intro_outpatient'],
+                        'ER': features['ER'],
                         'bed_count': bed_count,
-                        'public_holiday': 1 if is_holiday else 0
+                        'public_holiday': features['public_holiday']
                     },
                     "model_used": "randomforest"
                 })
         
-        return jsonify({
+        week_result = {
             "start_date": start_date,
             "predictions": predictions
-        })
+        }
+        with stage('serialization'):
+            if wants_columnar():
+                return columnar_response(week_result)
+            return jsonify(week_result)
         
     except Exception as e:
         print(f"週間予測中にエラーが発生しました: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/scenarios', methods=['GET'])
+@requires_warmup(warmup)
+@conditional(scenario_version, max_age=3600)
 def get_scenarios():
     try:
         # ローカルファイルからCSVを読み込み
+        import pandas as pd
         try:
-            df = pd.read_csv('../ultimate_pickup_data.csv')
+            df = pd.read_csv(SCENARIO_DATA_PATH)
         except FileNotFoundError:
             return jsonify({"error": "Scenario data not found"}), 404
         
@@ -642,6 +646,11 @@ def get_status():
             "rf_model_loaded": rf_model is not None,
                 "prophet_model_loaded": prophet_model is not None,
             "supabase_available": supabase_service.is_available(),
+            "supabase": supabase_service.stats(),
+            "predict_batching": rf_engine.dispatcher.stats() if rf_engine is not None and rf_engine.dispatcher is not None else None,
+            "serving_tier": serving_tier,
+            "inference": rf_engine.stats() if rf_engine is not None else None,
+            "startup": warmup.status(),
             "app_version": "1.0.0"
         })
     except Exception as e:
@@ -649,35 +658,115 @@ def get_status():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/history', methods=['GET'])
+@requires_warmup(warmup)
 def get_prediction_history():
-    """予測履歴を取得"""
+    """
+    予測履歴を取得
+
+    created_at・id の降順で limit 件（上限 HISTORY_MAX_LIMIT）を返し、続きがあれば next_cursor を返す。
+    date_from・date_to（予測日）、day_of_week（mon,tue など）、columns（返す列）で絞り込める。
+    format=ndjson / csv なら条件に合う全件（limit 指定時はその件数）を1ページずつ逐次返す。
+    """
     try:
-        limit = request.args.get('limit', 100, type=int)
-        history = supabase_service.get_prediction_history(limit)
+        export = request.args.get('format', '').lower()
+        if export and export not in EXPORT_FORMATS:
+            return jsonify({"error": f"format は {' / '.join(EXPORT_FORMATS)} で指定してください"}), 400
+        try:
+            query = HistoryQuery.from_args(request.args, export=bool(export))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if export:
+            return export_prediction_history(query, export)
+
+        # 直近の小さい limit はこのワーカーのバッファから返す（source=database でデータベースから取る）
+        if request.args.get('source') != 'database':
+            history = recent_predictions.history(query)
+            if history is not None:
+                return jsonify({
+                    "history": history,
+                    "count": len(history),
+                    "next_cursor": None,
+                    "source": "memory"
+                })
+
+        history = supabase_service.get_prediction_history(query=query)
         return jsonify({
             "history": history,
-            "count": len(history)
+            "count": len(history),
+            "next_cursor": next_cursor(history, query.limit),
+            "source": "database"
         })
     except Exception as e:
         print(f"予測履歴の取得中にエラーが発生しました: {e}")
         return jsonify({"error": str(e)}), 500
 
+def export_prediction_history(query, export):
+    """
+    予測履歴を NDJSON / CSV で逐次返す
+
+    途中で失敗したら、NDJSON は最終行に error を書き、CSV はレスポンスを打ち切る（正常に終わった
+    ファイルに見えないように、終端のチャンクを送らずに接続を閉じる）。
+    """
+    if not supabase_service.is_available():
+        return jsonify({"error": "Supabase not available"}), 503
+    rows = supabase_service.iter_prediction_history(query)
+
+    def generate():
+        count = 0
+        error = None
+
+        def counted():
+            nonlocal count, error
+            try:
+                for row in rows:
+                    count += 1
+                    yield row
+            except Exception as e:
+                print(f"予測履歴のエクスポート中にエラーが発生しました: {e}")
+                error = str(e)
+                if export == 'csv':
+                    # CSV には失敗を書く行が無いため、チャンク転送を途中で打ち切ってダウンロードを失敗させる
+                    raise
+
+        if export == 'csv':
+            yield from csv_lines(counted(), query.columns or query.select_columns())
+        else:
+            yield from ndjson_lines(counted())
+            yield json.dumps({"count": count, **({"error": error} if error else {})}, ensure_ascii=False) + '\n'
+
+    filename = f"prediction_history.{export}"
+    return Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[export],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 @app.route('/api/stats', methods=['GET'])
+@requires_warmup(warmup)
 def get_stats():
     """統計情報を取得"""
     try:
-        stats = supabase_service.get_stats()
+        stats = dict(supabase_service.get_stats())
+        # データベースの集計が取れなかったことはエラーではなく database で示す（/api/history の source と同様）
+        database_error = stats.pop("error", None)
+        stats["database"] = "unavailable" if database_error else "available"
+        if database_error and not recent_predictions.enabled:
+            return jsonify({"error": database_error, "database": "unavailable"}), 503
+        # 直近の予測と逐次更新の集計はこのワーカーのバッファから返す
+        if recent_predictions.enabled:
+            stats["recent_predictions"] = recent_predictions.latest(5) or stats.get("recent_predictions", [])
+            stats["recent"] = recent_predictions.stats()
         return jsonify(stats)
     except Exception as e:
         print(f"統計情報の取得中にエラーが発生しました: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/predict_month', methods=['POST'])
+@app.route('/api/predict_month', methods=['GET', 'POST'])
+@requires_warmup(warmup)
+@conditional(forecast_version, max_age=600, date_keys=('year', 'month'))
 def predict_month():
     """月間予測を実行"""
     try:
-        # リクエストからデータを取得
-        data = request.json
+        # リクエストからデータを取得（GETはクエリ文字列）
+        data = request_payload()
         print(f"受信したデータ: {data}")
 
         # 年月が指定されていない場合は現在の月を使用
@@ -695,9 +784,11 @@ def predict_month():
 
         if use_prophet and prophet_model is not None:
             # Prophetで月全体を時系列予測
+            import pandas as pd
             month_dates = pd.date_range(start=start_date, periods=last_day, freq='D')
             future_df = pd.DataFrame({'ds': month_dates})
-            forecast = prophet_model.predict(future_df)
+            with stage('inference'):
+                forecast = prophet_model.predict(future_df)
 
             for i, (_, row) in enumerate(forecast.iterrows()):
                 current_date = datetime(year, month, i + 1)
@@ -740,68 +831,64 @@ def predict_month():
                     }
                 })
         else:
-            # RandomForestで月全体を予測（デフォルト）
+            # RandomForestで月全体を予測（デフォルト）: 全日の特徴量を作ってから1回で推論する
+            days = []
             for day in range(1, last_day + 1):
                 current_date = datetime(year, month, day)
                 date_str = current_date.strftime('%Y-%m-%d')
-                day_code = get_day_code(date_str)
-
-                # 曜日のone-hotエンコーディング
-                day_features = {day: 1 if day == day_code else 0 for day in ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']}
-
-                # 基本データ（土日祝日は外来患者数を調整）
-                base_outpatient = data.get('total_outpatient', 500)
-                base_intro = data.get('intro_outpatient', 20)
-                base_er = data.get('ER', 15)
-
-                # 土日祝日の調整
-                is_weekend = day_code in ['sat', 'sun']
-                # 祝日判定は日付ベースで統一（週次と揃える）
-                is_holiday = is_japanese_holiday(date_str)
-
-                if is_weekend or is_holiday:
-                    adjusted_outpatient = int(base_outpatient * 0.3)
-                    adjusted_intro = int(base_intro * 0.2)
-                    adjusted_er = int(base_er * 1.2)
-                else:
-                    adjusted_outpatient = base_outpatient
-                    adjusted_intro = base_intro
-                    adjusted_er = base_er
-
-                # 特徴量を作成
-                features = {
-                    **day_features,
-                    'public_holiday': 1 if is_holiday else 0,
-                    'public_holiday_previous_day': 1 if is_previous_day_holiday(date_str) else 0,
-                    'total_outpatient': adjusted_outpatient,
-                    'intro_outpatient': adjusted_intro,
-                    'ER': adjusted_er,
-                    'bed_count': data.get('bed_count', 280)
-                }
-
-                # DataFrameに変換
-                features_df = pd.DataFrame([features])
-
-                # RandomForestで予測
-                prediction_value = rf_model.predict(features_df)[0]
-                prediction_rounded = round(float(prediction_value), 1)
-
-                # 結果に追加
+                with stage('feature_build'):
+                    day_code = get_day_code(date_str)
+
+                    # 基本データ（土日祝日は外来患者数を調整）
+                    base_outpatient = data.get('total_outpatient', 500)
+                    base_intro = data.get('intro_outpatient', 20)
+                    base_er = data.get('ER', 15)
+
+                    # 土日祝日の調整
+                    is_weekend = day_code in ['sat', 'sun']
+                    # 祝日判定は日付ベースで統一（週次と揃える）
+                    is_holiday = is_japanese_holiday(date_str)
+
+                    if is_weekend or is_holiday:
+                        adjusted_outpatient = int(base_outpatient * 0.3)
+                        adjusted_intro = int(base_intro * 0.2)
+                        adjusted_er = int(base_er * 1.2)
+                    else:
+                        adjusted_outpatient = base_outpatient
+                        adjusted_intro = base_intro
+                        adjusted_er = base_er
+
+                    # 特徴量を作成
+                    features = build_features(
+                        day_code,
+                        public_holiday=1 if is_holiday else 0,
+                        public_holiday_previous_day=1 if is_previous_day_holiday(date_str) else 0,
+                        total_outpatient=adjusted_outpatient,
+                        intro_outpatient=adjusted_intro,
+                        ER=adjusted_er,
+                        bed_count=data.get('bed_count', 280)
+                    )
+                days.append((current_date, day, is_weekend, is_holiday, features))
+
+            # RandomForestで予測
+            month_values = rf_engine.predict_rows([d[-1] for d in days])
+
+            for (current_date, day, is_weekend, is_holiday, features), prediction_value in zip(days, month_values):
                 predictions.append({
-                    'date': date_str,
+                    'date': current_date.strftime('%Y-%m-%d'),
                     'day': day,
                     'day_of_week': current_date.weekday(),
                     'day_label': ['月', '火', '水', '木', '金', '土', '日'][current_date.weekday()],
-                    'prediction': prediction_rounded,
+                    'prediction': round(float(prediction_value), 1),
                     'is_weekend': is_weekend,
                     'is_holiday': is_holiday,
                     'model_used': 'randomforest',
                     'features': {
-                        'total_outpatient': adjusted_outpatient,
-                        'intro_outpatient': adjusted_intro,
-                        'ER': adjusted_er,
-                        'bed_count': data.get('bed_count', 280),
-                        'public_holiday': 1 if is_holiday else 0
+                        'total_outpatient': features['total_outpatient'],
+                        'intro_outpatient': features['intro_outpatient'],
+                        'ER': features['ER'],
+                        'bed_count': features['bed_count'],
+                        'public_holiday': features['public_holiday']
                     }
                 })
 
@@ -822,25 +909,28 @@ def predict_month():
         }
 
         # Supabaseに結果をログ
-        if supabase_service.is_available():
+        with stage('supabase_log'):
             try:
-                for prediction in predictions:
-                    log_data = {
-                        'date': prediction['date'],
-                        'prediction': prediction['prediction'],
-                        'features': prediction['features']
-                    }
-                    supabase_service.log_prediction(log_data)
+                log_predictions([{
+                    'date': prediction['date'],
+                    'prediction': prediction['prediction'],
+                    'features': prediction['features']
+                } for prediction in predictions])
             except Exception as e:
                 print(f"Supabaseログ記録エラー: {e}")
 
         # 結果を返す
-        return jsonify(month_result)
+        with stage('serialization'):
+            if wants_columnar():
+                return columnar_response(month_result)
+            return jsonify(month_result)
 
     except Exception as e:
         print(f"月間予測中にエラーが発生しました: {e}")
         return jsonify({"error": str(e)}), 500
 
+warmup.start()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('FLASK_ENV') != 'production'
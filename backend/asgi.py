@@ -0,0 +1,222 @@
+"""
+ASGI エントリポイント
+
+同じ Flask アプリ（app.py）のルートとリクエスト/レスポンス仕様をそのまま ASGI で公開する。
+イベントループ自体はブロックせず、リクエストの種類ごとに上限付きのスレッドプールへ振り分ける。
+
+- 推論系（/api/predict など）: CPU バウンドなので CPU 数程度の推論プールで実行
+  （マイクロバッチ有効時の /api/predict はディスパッチャの推論を待つだけなので I/O プールで実行し、
+  同時に待てる数が推論プールのスレッド数で頭打ちにならないようにする）
+- それ以外（履歴・統計など Supabase への問い合わせ）: I/O プールで実行
+- 予測ログの書き込み: I/O プールへ投げっぱなしにし、レスポンスを待たせない
+
+起動:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app   # 複数ワーカーの場合
+
+環境変数:
+    ASGI_INFERENCE_WORKERS  推論プールのスレッド数（既定: CPU数）
+    ASGI_IO_WORKERS         I/O プールのスレッド数（既定: 32）
+    ASGI_MAX_PENDING        処理中+待機中リクエストの上限。超えると 503（既定: 256）
+    PREDICT_BATCHING        0 で単日予測のマイクロバッチを無効化（ASGIモードでは既定で有効）
+"""
+
+import asyncio
+import importlib
+import io
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from log_pipeline import stop_logging
+from metrics import register_queue
+
+logger = logging.getLogger(__name__)
+
+# 推論（CPU バウンド）として扱うパス
+INFERENCE_PATHS = (
+    '/api/predict',
+    '/api/predict_week',
+    '/api/predict_month',
+    '/api/scenarios'
+)
+
+
+def build_environ(scope: dict, body: bytes) -> dict:
+    """ASGI の scope とボディから WSGI environ を組み立てる"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': str(client[0]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """Flask アプリをスレッドプール経由で動かす ASGI アプリケーション"""
+
+    def __init__(self):
+        self.flask_module = None
+        self.inference_pool = None
+        self.io_pool = None
+        self.pending = None
+        self.predict_batching = False
+        self.max_pending = int(os.environ.get('ASGI_MAX_PENDING', 256))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.exception(f"ASGI startup failed: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        """スレッドプールを作成し、app.py をプール上で import する（モデルは app.py の起動ステップでバックグラウンドにロード）"""
+        self.inference_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('ASGI_INFERENCE_WORKERS', os.cpu_count() or 2)),
+            thread_name_prefix='inference'
+        )
+        self.io_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('ASGI_IO_WORKERS', 32)),
+            thread_name_prefix='io'
+        )
+        self.pending = asyncio.Semaphore(self.max_pending)
+
+        loop = asyncio.get_running_loop()
+        self.flask_module = await loop.run_in_executor(self.inference_pool, importlib.import_module, 'app')
+        # 予測ログは I/O プールで非同期に書き込む
+        self.flask_module.prediction_log_executor = self.io_pool
+        register_queue('prediction_log', self.io_pool._work_queue.qsize)
+        # 同時リクエストが集まるため単日予測はマイクロバッチで推論する（PREDICT_BATCHING=0 で無効、ロード前ならロード後に有効化）
+        if os.environ.get('PREDICT_BATCHING', '1') != '0':
+            self.flask_module.enable_predict_batching()
+            self.predict_batching = True
+        logger.info('ASGI startup complete')
+
+    async def shutdown(self):
+        """保留中の予測ログ書き込みを待ってからプールを閉じ、ログをフラッシュする"""
+        if self.flask_module is not None:
+            self.flask_module.prediction_log_executor = None
+        loop = asyncio.get_running_loop()
+        for pool in (self.inference_pool, self.io_pool):
+            if pool is not None:
+                await loop.run_in_executor(None, pool.shutdown, True)
+        logger.info('ASGI shutdown complete')
+        # キューに残ったログを書き出してリスナーを止める
+        stop_logging()
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    def _pool_for(self, path: str):
+        if path == '/api/predict' and self.predict_batching:
+            return self.io_pool
+        return self.inference_pool if path in INFERENCE_PATHS else self.io_pool
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+
+        if self.pending.locked():
+            await self._send_json(send, 503, {"error": "サーバーが混雑しています。しばらくしてから再試行してください"})
+            return
+
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            environ = build_environ(scope, body)
+            await loop.run_in_executor(self._pool_for(scope['path']), self._run_wsgi, environ, send, loop)
+
+    def _run_wsgi(self, environ, send, loop):
+        """プールのスレッド上で Flask を実行し、レスポンスをイベントループ経由で送る"""
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def emit_start():
+            emit({
+                'type': 'http.response.start',
+                'status': response_start['status'],
+                'headers': response_start['headers']
+            })
+
+        result = self.flask_module.app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not started:
+                    emit_start()
+                    started = True
+                if chunk:
+                    emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                emit_start()
+            emit({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def _send_json(self, send, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+app = AsgiApp()
@@ -0,0 +1,131 @@
+"""
+単日予測のマイクロバッチ処理
+
+同時に届いた /api/predict の特徴量行をキューに溜め、最大バッチサイズに達するか
+最大待ち時間（既定 2ms）が過ぎた時点で1回の model.predict にまとめて実行し、
+各呼び出し元に結果を返す。負荷時の1呼び出しあたりのオーバーヘッドを、
+上限付きの待ち時間と引き換えに償却する。
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence
+
+from metrics import record_batch_size
+
+
+class BatchDispatcher:
+    """特徴量行をまとめて推論するディスパッチャ"""
+
+    def __init__(self, predict_rows: Callable[[List[Dict]], Sequence[float]], max_batch_size: int = 32,
+                 max_wait_ms: float = 2.0):
+        """
+        Args:
+            predict_rows: 特徴量 dict のリストを1回で推論する関数（InferenceEngine.predict_uncached）
+            max_batch_size (int): 1回の推論にまとめる最大行数
+            max_wait_ms (float): 最初の行が届いてからフラッシュするまでの最大待ち時間
+        """
+        self.predict_rows = predict_rows
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {
+            'batches': 0,
+            'rows': 0,
+            'batch_size_counts': {},
+            'queue_wait_ms_total': 0.0,
+            'queue_wait_ms_max': 0.0,
+            'inference_ms_total': 0.0,
+            'fallbacks': 0
+        }
+        self._worker = threading.Thread(target=self._run, name='predict-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, features: Dict) -> Future:
+        """特徴量行をキューに入れ、予測値（float）を返す Future を受け取る"""
+        future: Future = Future()
+        self._queue.put((features, future, time.perf_counter()))
+        return future
+
+    def predict(self, features: Dict, timeout: Optional[float] = None) -> float:
+        """特徴量行を予測する（バッチがフラッシュされるまでブロック）"""
+        return self.submit(features).result(timeout)
+
+    def queue_depth(self) -> int:
+        """フラッシュ待ちの行数"""
+        return self._queue.qsize()
+
+    def _collect(self) -> list:
+        """最初の1件を待ち、その後は期限かバッチサイズに達するまで集める"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            flush_time = time.perf_counter()
+            rows = [features for features, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+
+            start = time.perf_counter()
+            try:
+                predictions = self.predict_rows(rows)
+                for future, value in zip(futures, predictions):
+                    future.set_result(float(value))
+                fallback = False
+            except Exception:
+                # 1行の不正値でバッチ全体を失敗させないよう、行ごとに再実行する
+                fallback = True
+                for features, future in zip(rows, futures):
+                    try:
+                        value = self.predict_rows([features])[0]
+                        future.set_result(float(value))
+                    except Exception as e:
+                        future.set_exception(e)
+            inference_ms = (time.perf_counter() - start) * 1000
+
+            record_batch_size(len(batch))
+            waits = [(flush_time - enqueued) * 1000 for _, _, enqueued in batch]
+            with self._lock:
+                stats = self._stats
+                stats['batches'] += 1
+                stats['rows'] += len(batch)
+                stats['batch_size_counts'][len(batch)] = stats['batch_size_counts'].get(len(batch), 0) + 1
+                stats['queue_wait_ms_total'] += sum(waits)
+                stats['queue_wait_ms_max'] = max(stats['queue_wait_ms_max'], max(waits))
+                stats['inference_ms_total'] += inference_ms
+                stats['fallbacks'] += int(fallback)
+
+    def stats(self) -> Dict:
+        """バッチサイズ・キュー待ち時間などの集計を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['batch_size_counts'] = dict(sorted(self._stats['batch_size_counts'].items()))
+        batches = stats['batches'] or 1
+        rows = stats['rows'] or 1
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queue_depth': self.queue_depth(),
+            'batches': stats['batches'],
+            'rows': stats['rows'],
+            'avg_batch_size': round(stats['rows'] / batches, 2),
+            'batch_size_counts': stats['batch_size_counts'],
+            'avg_queue_wait_ms': round(stats['queue_wait_ms_total'] / rows, 3),
+            'max_queue_wait_ms': round(stats['queue_wait_ms_max'], 3),
+            'avg_inference_ms': round(stats['inference_ms_total'] / batches, 3),
+            'fallbacks': stats['fallbacks']
+        }
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+予測グリッドの作成（オフラインジョブ）
+
+モデル（.joblib または配列形式の .npz）で、曜日・祝日フラグの全28通りと、4つの整数特徴量を
+量子化した格子点の全ての組み合わせを推論し、prediction_grid.py が読める .npy と .json を書き出す。
+書き出し後、ランダムな格子点でライブモデルの予測と一致するか確認する。
+
+PREDICTION_GRID_PATH に出力先を指定すると、同じモデルを使うバックエンドは格子点の行を
+配列の添字引きで返す（格子の外の行はライブモデルで推論）。
+
+軸は "開始:終了:ステップ" で指定する（終了を含む）。点の数は 28 x 各軸の点数の積になるので、
+ステップを細かくするとファイルサイズと作成時間が増える。
+
+使い方:
+    python build_prediction_grid.py --model models/fixed_rf_model.npz --output models/prediction_grid.npy
+    python build_prediction_grid.py --model ../fixed_rf_model.joblib --total-outpatient 0:1200:5 --er 0:60:1 --dtype float16
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from forest_predictor import file_sha256
+from inference import FEATURE_COLUMNS, load_engine
+from prediction_grid import (COUNT_COLUMNS, COUNT_INDEX, DEFAULT_AXES, FLAG_COMBINATIONS, GRID_VERSION,
+                             PredictionGrid, axis_values, flag_features, meta_path)
+
+# 1回の推論に渡す最大行数
+BUILD_CHUNK_ROWS = 200000
+
+
+def parse_axis(text: str):
+    try:
+        start, stop, step = (float(part) for part in text.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"軸は 開始:終了:ステップ で指定してください: {text}")
+    if step <= 0 or stop < start:
+        raise argparse.ArgumentTypeError(f"軸の範囲が不正です: {text}")
+    return start, stop, step
+
+
+def build_grid(engine, axes: dict, output: str, dtype: str = 'float32') -> np.ndarray:
+    """全ての格子点を推論し、output（.npy）にメモリマップで書き込む"""
+    grids = [axis_values(*axes[c]) for c in COUNT_COLUMNS]
+    shape = (FLAG_COMBINATIONS,) + tuple(len(g) for g in grids)
+    table = np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=shape)
+
+    # 4つの整数特徴量の全ての組み合わせ（曜日・祝日フラグごとに同じもの）
+    counts = np.stack([g.ravel() for g in np.meshgrid(*grids, indexing='ij')], axis=1)
+    X = np.zeros((len(counts), len(FEATURE_COLUMNS)))
+    for i, column in enumerate(COUNT_COLUMNS):
+        X[:, COUNT_INDEX[column]] = counts[:, i]
+
+    for flag in range(FLAG_COMBINATIONS):
+        start = time.perf_counter()
+        X[:, :9] = flag_features(flag)
+        values = np.empty(len(X))
+        for begin in range(0, len(X), BUILD_CHUNK_ROWS):
+            values[begin:begin + BUILD_CHUNK_ROWS] = engine.predict_matrix(X[begin:begin + BUILD_CHUNK_ROWS])
+        table[flag] = values.reshape(shape[1:])
+        print(f"  {flag + 1:>2}/{FLAG_COMBINATIONS} ({time.perf_counter() - start:.1f} 秒)", file=sys.stderr)
+    table.flush()
+    return table
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='予測グリッドを作成する')
+    parser.add_argument('--model', default=os.environ.get('RF_MODEL_PATH', 'models/fixed_rf_model.npz'),
+                        help='モデル（.joblib または .npz）のパス')
+    parser.add_argument('--output', default='models/prediction_grid.npy', help='出力する .npy のパス（.json も作成）')
+    parser.add_argument('--total-outpatient', type=parse_axis, default=DEFAULT_AXES['total_outpatient'])
+    parser.add_argument('--intro-outpatient', type=parse_axis, default=DEFAULT_AXES['intro_outpatient'])
+    parser.add_argument('--er', type=parse_axis, default=DEFAULT_AXES['ER'])
+    parser.add_argument('--bed-count', type=parse_axis, default=DEFAULT_AXES['bed_count'])
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32', help='予測値の型')
+    parser.add_argument('--check', type=int, default=2000, help='ライブモデルと比較する格子点の数')
+    args = parser.parse_args()
+
+    # prediction_grid.py の列番号が推論コアの列順と一致していることを確認する
+    assert all(FEATURE_COLUMNS[COUNT_INDEX[c]] == c for c in COUNT_COLUMNS)
+
+    engine = load_engine([args.model], fallback=False)
+    if engine is None:
+        print(f"モデルをロードできません: {args.model}")
+        return 2
+    engine.grid = None
+    axes = {
+        'total_outpatient': args.total_outpatient,
+        'intro_outpatient': args.intro_outpatient,
+        'ER': args.er,
+        'bed_count': args.bed_count
+    }
+    cells = FLAG_COMBINATIONS * int(np.prod([len(axis_values(*axes[c])) for c in COUNT_COLUMNS]))
+    print(f"格子点: {cells:,} 点（{cells * np.dtype(args.dtype).itemsize / 1024 ** 2:.1f} MiB）", file=sys.stderr)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    start = time.perf_counter()
+    build_grid(engine, axes, args.output, args.dtype)
+    elapsed = time.perf_counter() - start
+    with open(meta_path(args.output), 'w', encoding='utf-8') as f:
+        json.dump({
+            'grid_version': GRID_VERSION,
+            'axes': {c: list(axes[c]) for c in COUNT_COLUMNS},
+            'dtype': args.dtype,
+            'model': os.path.basename(args.model),
+            'model_sha256': file_sha256(engine.model_path),
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'build_seconds': round(elapsed, 1)
+        }, f, ensure_ascii=False, indent=2)
+
+    # ランダムな格子点でライブモデルと比較する
+    grid = PredictionGrid.load(args.output)
+    rng = np.random.default_rng(0)
+    X = np.zeros((args.check, len(FEATURE_COLUMNS)))
+    flags = rng.integers(0, FLAG_COMBINATIONS, args.check)
+    X[:, :9] = [flag_features(flag) for flag in flags]
+    for column in COUNT_COLUMNS:
+        values = axis_values(*axes[column])
+        X[:, COUNT_INDEX[column]] = values[rng.integers(0, len(values), args.check)]
+    looked_up, hit = grid.lookup(X)
+    expected = engine.predict_matrix(X)
+    diff = float(np.abs(looked_up - expected).max()) if args.check else 0.0
+    # 予測値を dtype に丸めた分の誤差は許容する
+    tolerance = 2 * float(np.finfo(args.dtype).eps) * max(1.0, float(np.abs(expected).max()) if args.check else 0.0)
+
+    print(f"書き出し: {args.output}（{os.path.getsize(args.output) / 1024 ** 2:.1f} MiB、{elapsed:.1f} 秒）")
+    print(f"確認: {args.check} 点、ヒット {int(hit.sum())}、ライブモデルとの差の最大値 {diff:.3g}")
+    if not hit.all() or diff > tolerance:
+        print("エラー: 予測グリッドがライブモデルと一致しません")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+外部サービス呼び出しのサーキットブレーカーとリトライ
+
+連続して failure_threshold 回失敗するとブレーカーを開き（open）、reset_timeout 秒の間は
+呼び出さずに CircuitOpenError を返す。時間が過ぎると1件だけ試し呼び出し（half_open）を通し、
+成功すれば閉じ（closed）、失敗すればもう一度開く。障害中の呼び出しがタイムアウトまで
+待たされる代わりに即座に失敗するため、呼び出し元（予測リクエストなど）の遅延が増えない。
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, Optional
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """ブレーカーが開いているため呼び出さなかった"""
+
+
+def backoff_delays(retries: int, base: float = 0.05, cap: float = 1.0) -> Iterator[float]:
+    """リトライ前の待ち時間（指数バックオフ + フルジッタ）"""
+    for attempt in range(retries):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyWindow:
+    """直近 size 件の所要時間（ms）と結果ごとの件数"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def record(self, elapsed_ms: Optional[float], result: str) -> None:
+        """elapsed_ms が None（呼び出していない）なら件数だけ数える"""
+        with self._lock:
+            if elapsed_ms is not None:
+                self._samples.append(elapsed_ms)
+            self.counts[result] = self.counts.get(result, 0) + 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            counts = dict(self.counts)
+
+        def percentile(q: float) -> Optional[float]:
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(q * len(samples)))], 2)
+
+        return {'calls': counts, 'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'max_ms': percentile(1.0)}
+
+
+class CircuitBreaker:
+    """連続失敗で開き、一定時間後に試し呼び出しで復旧を確認するブレーカー"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Args:
+            failure_threshold (int): ブレーカーを開く連続失敗回数
+            reset_timeout (float): 開いてから試し呼び出しを通すまでの秒数
+        """
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = {'opened': 0, 'short_circuited': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """呼び出してよいか（half_open では試し呼び出しを1件だけ通す）"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._probing = False
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._stats['short_circuited'] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self._stats['opened'] += 1
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> Dict:
+        state = self.state
+        with self._lock:
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)) if state == OPEN else None
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout_s': self.reset_timeout,
+                'retry_in_s': round(retry_in, 1) if retry_in is not None else None,
+                **self._stats
+            }
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RandomForest モデルの圧縮
+
+配列形式（export_forest.py の .npz）または joblib のモデルを読み込み、
+- 閾値と葉の値を float32 にする（閾値は float32 の入力に対する比較結果が変わらないよう切り下げる）
+- 子が2つとも同じ値の葉であるノードを葉にまとめる（予測値は変わらない。--merge-tolerance を指定すると
+  値の差がそれ以下の葉もまとめ、ノード自身の値（学習時のそのノードのサンプル平均）を葉の値にする）
+- --trees を指定すると先頭の N 本だけを残す
+を行って、バックエンドがそのまま読み込める .npz を書き出す。
+
+学習データCSVの直近 --check-days 日分（y がある行）で、元のモデルと圧縮後のモデルの
+MAE・RMSE と予測値の差を表示する。MAE の悪化が --max-mae-increase を超えたら終了コード 1。
+本番のモデル（main_randomforest.py）はこの CSV の全行で学習しているため、これは学習に使った行での
+確認（in-sample）で、汎化性能の悪化ではない。特に --trees で木を減らした時の悪化は小さく出るため、
+許容範囲には余裕を持たせること。
+
+使い方:
+    python compress_forest.py --model models/fixed_rf_model.npz --output models/fixed_rf_model.compact.npz
+    python compress_forest.py --model ../fixed_rf_model.joblib --output models/fixed_rf_model.compact.npz \\
+        --trees 40 --data ../ultimate_pickup_data.csv --max-mae-increase 0.1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from forest_predictor import ForestPredictor, is_artifact
+from inference import FEATURE_COLUMNS
+
+
+def load_forest(path: str) -> ForestPredictor:
+    """配列形式ならそのまま、joblib なら配列形式に変換して読み込む（joblib には scikit-learn が必要）"""
+    if is_artifact(path):
+        return ForestPredictor.load(path)
+    import joblib
+    from export_forest import export_forest
+    from inference import patch_estimators
+    model = joblib.load(path)
+    patch_estimators(model)
+    return export_forest(model, path)
+
+
+def round_down_float32(values: np.ndarray) -> np.ndarray:
+    """float64 の閾値を、それ以下で最大の float32 にする（float32 の x に対して x <= t の結果が変わらない）"""
+    rounded = values.astype(np.float32)
+    over = rounded.astype(np.float64) > values
+    rounded[over] = np.nextafter(rounded[over], np.float32(-np.inf))
+    return rounded
+
+
+def tree_bounds(forest: ForestPredictor):
+    """各木のノードの範囲（開始, 終了）"""
+    starts = forest.roots.astype(np.int64)
+    ends = np.append(starts[1:], len(forest.feature))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def compact_tree(feature, threshold, left, right, value, tolerance: float = 0.0):
+    """
+    1本の木の同じ値（差が tolerance 以下）の葉をまとめ、根から辿れるノードだけを前順に詰め直す
+
+    引数は木の中でのローカルな番号（葉は left == right == 自分）。
+    Returns: (feature, threshold, left, right, value, 最大深さ)
+    """
+    feature, threshold, left, right, value = (a.copy() for a in (feature, threshold, left, right, value))
+    # scikit-learn の木は前順に並んでいて子の番号は親より大きいため、後ろから1回走査すれば連鎖的にまとまる
+    for node in range(len(feature) - 1, -1, -1):
+        if feature[node] < 0:
+            continue
+        l, r = left[node], right[node]
+        if feature[l] < 0 and feature[r] < 0 and abs(value[l] - value[r]) <= tolerance:
+            feature[node] = -1
+            threshold[node] = 0
+            if value[l] == value[r]:
+                value[node] = value[l]
+            left[node] = right[node] = node
+
+    order = []
+    depth = {0: 0}
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if feature[node] >= 0:
+            depth[right[node]] = depth[left[node]] = depth[node] + 1
+            stack.extend((right[node], left[node]))
+    order = np.asarray(order)
+    remap = np.full(len(feature), -1, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return (feature[order], threshold[order], remap[left[order]], remap[right[order]], value[order],
+            max(depth.values()))
+
+
+def compress_forest(forest: ForestPredictor, n_trees: int = None, quantize: bool = True,
+                    merge_tolerance: float = 0.0) -> ForestPredictor:
+    """ForestPredictor を圧縮した新しい ForestPredictor を返す"""
+    bounds = tree_bounds(forest)
+    if n_trees:
+        bounds = bounds[:n_trees]
+    threshold_all = round_down_float32(forest.threshold) if quantize else forest.threshold
+    value_all = forest.value.astype(np.float32) if quantize else forest.value
+
+    parts = {name: [] for name in ('feature', 'threshold', 'left', 'right', 'value')}
+    roots = []
+    offset = 0
+    max_depth = 0
+    for start, end in bounds:
+        feature, threshold, left, right, value, depth = compact_tree(
+            forest.feature[start:end], threshold_all[start:end],
+            forest.left[start:end] - start, forest.right[start:end] - start, value_all[start:end], merge_tolerance
+        )
+        for name, array in zip(('feature', 'threshold', 'left', 'right', 'value'), (feature, threshold, left, right, value)):
+            parts[name].append(array + offset if name in ('left', 'right') else array)
+        roots.append(offset)
+        offset += len(feature)
+        max_depth = max(max_depth, depth)
+
+    feature_dtype = np.int8 if quantize and forest.n_features < 128 else np.int32
+    meta = dict(forest.meta)
+    meta.update({
+        'max_depth': int(max_depth),
+        'node_count': int(offset),
+        'compression': {
+            'quantized': quantize,
+            'merge_tolerance': merge_tolerance,
+            'trees': len(bounds),
+            'source_trees': forest.n_estimators,
+            'source_node_count': int(len(forest.feature))
+        }
+    })
+    return ForestPredictor(
+        np.concatenate(parts['feature']).astype(feature_dtype),
+        np.concatenate(parts['threshold']),
+        np.concatenate(parts['left']).astype(np.int32),
+        np.concatenate(parts['right']).astype(np.int32),
+        np.concatenate(parts['value']),
+        np.asarray(roots, dtype=np.int32),
+        meta
+    )
+
+
+def recent_frame(data_path: str, days: int) -> pd.DataFrame:
+    """学習データCSVの直近 days 日分（y がある行、日付順）"""
+    data = pd.read_csv(data_path)
+    data['parsed_date'] = pd.to_datetime(data['date'], format='%Y/%m/%d', errors='coerce')
+    data = data.dropna(subset=FEATURE_COLUMNS + ['y', 'parsed_date']).sort_values('parsed_date')
+    return data.tail(days)
+
+
+def evaluate(forest: ForestPredictor, frame: pd.DataFrame) -> dict:
+    X = frame[FEATURE_COLUMNS].to_numpy(dtype=float)
+    model_input = pd.DataFrame(X, columns=FEATURE_COLUMNS) if forest.feature_names else X
+    start = time.perf_counter()
+    predicted = forest.predict(model_input)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    error = predicted - frame['y'].to_numpy(dtype=float)
+    return {
+        'predicted': predicted,
+        'mae': float(np.abs(error).mean()),
+        'rmse': float(np.sqrt((error ** 2).mean())),
+        'predict_ms': elapsed_ms
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='RandomForest モデルを圧縮する')
+    parser.add_argument('--model', default=os.environ.get('RF_MODEL_PATH', 'models/fixed_rf_model.npz'),
+                        help='圧縮するモデル（.npz または .joblib）のパス')
+    parser.add_argument('--output', default='models/fixed_rf_model.compact.npz', help='出力する .npz のパス')
+    parser.add_argument('--trees', type=int, help='残す木の本数（省略時は全て残す）')
+    parser.add_argument('--merge-tolerance', type=float, default=0.0,
+                        help='値の差がこれ以下の兄弟の葉をまとめる（既定: 0 = 同じ値のみ、予測値は変わらない）')
+    parser.add_argument('--no-quantize', action='store_true', help='float32 への変換をしない')
+    parser.add_argument('--data', default='../ultimate_pickup_data.csv', help='精度の確認に使う学習データCSV')
+    parser.add_argument('--check-days', '--holdout-days', dest='check_days', type=int, default=180,
+                        help='精度の確認に使う直近の日数（学習に使った行なので in-sample の確認）')
+    parser.add_argument('--max-mae-increase', type=float, help='許容する MAE の悪化（省略時はチェックしない）')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"モデルファイルが見つかりません: {args.model}")
+        return 2
+    forest = load_forest(args.model)
+    if args.trees and not 0 < args.trees <= forest.n_estimators:
+        print(f"--trees は 1〜{forest.n_estimators} で指定してください")
+        return 2
+
+    compressed = compress_forest(forest, args.trees, quantize=not args.no_quantize, merge_tolerance=args.merge_tolerance)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    compressed.save(args.output)
+    compressed = ForestPredictor.load(args.output)
+
+    print(f"書き出し: {args.output}")
+    print(f"木の数:       {forest.n_estimators:>9} -> {compressed.n_estimators}")
+    print(f"ノード数:     {len(forest.feature):>9} -> {len(compressed.feature)}")
+    print(f"最大深さ:     {forest.max_depth:>9} -> {compressed.max_depth}")
+    print(f"メモリ:       {forest.nbytes() / 1024:>7.0f} KiB -> {compressed.nbytes() / 1024:.0f} KiB")
+    if is_artifact(args.model):
+        print(f"ファイル:     {os.path.getsize(args.model) / 1024:>7.0f} KiB -> {os.path.getsize(args.output) / 1024:.0f} KiB")
+
+    if not args.data or not os.path.exists(args.data):
+        print("学習データCSVが無いため、精度の確認をスキップします")
+        return 0
+    frame = recent_frame(args.data, args.check_days)
+    before = evaluate(forest, frame)
+    after = evaluate(compressed, frame)
+    diff = np.abs(before['predicted'] - after['predicted'])
+    print(f"\n直近 {len(frame)} 日（{frame['parsed_date'].min():%Y-%m-%d}〜{frame['parsed_date'].max():%Y-%m-%d}）での精度"
+          f"（学習に使った行での in-sample の確認。汎化性能の悪化はこれより大きい可能性がある）:")
+    print(f"MAE:          {before['mae']:>9.4f} -> {after['mae']:.4f}")
+    print(f"RMSE:         {before['rmse']:>9.4f} -> {after['rmse']:.4f}")
+    print(f"推論時間:     {before['predict_ms']:>7.1f} ms -> {after['predict_ms']:.1f} ms")
+    print(f"予測値の差:   最大 {diff.max():.4g}、平均 {diff.mean():.4g}")
+
+    if args.max_mae_increase is not None and after['mae'] - before['mae'] > args.max_mae_increase:
+        print(f"エラー: MAE の悪化（{after['mae'] - before['mae']:.4f}）が許容範囲（{args.max_mae_increase}）を超えています")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
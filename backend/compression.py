@@ -0,0 +1,174 @@
+"""
+レスポンス圧縮（gzip / brotli）
+
+月間予測や履歴などの大きな JSON を、Accept-Encoding に応じて圧縮して返す。
+閾値未満の小さなレスポンスはそのまま返し、ストリーミングレスポンスは
+逐次圧縮する。ストリーミングでは COMPRESS_FLUSH_BYTES バイト溜まるか、前回のフラッシュから
+COMPRESS_FLUSH_MS ミリ秒経つまでフラッシュしない（1行ずつのエクスポートでも圧縮が効く）。
+
+環境変数:
+    COMPRESS_MIN_SIZE    圧縮する最小バイト数（既定: 1024）
+    COMPRESS_LEVEL       gzip の圧縮レベル 1-9（既定: 6）
+    COMPRESS_BR_QUALITY  brotli の品質 0-11（既定: 4）
+    COMPRESS_FLUSH_BYTES ストリーミングでフラッシュするまでに溜める入力バイト数（既定: 32768）
+    COMPRESS_FLUSH_MS    ストリーミングでフラッシュする最大間隔（既定: 200）
+    COMPRESS_DISABLED    1 で圧縮を無効化
+"""
+
+import gzip
+import os
+import time
+import zlib
+
+from flask import Flask, request
+
+# brotli（任意）
+try:
+    import brotli  # type: ignore
+    HAS_BROTLI = True
+except Exception:
+    HAS_BROTLI = False
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'application/x-ndjson',
+    'application/vnd.inhospital.columnar+json',
+    'text/csv',
+    'text/plain',
+    'text/html'
+)
+
+
+def _config() -> dict:
+    return {
+        'min_size': int(os.environ.get('COMPRESS_MIN_SIZE', 1024)),
+        'level': int(os.environ.get('COMPRESS_LEVEL', 6)),
+        'br_quality': int(os.environ.get('COMPRESS_BR_QUALITY', 4)),
+        'flush_bytes': int(os.environ.get('COMPRESS_FLUSH_BYTES', 32768)),
+        'flush_ms': float(os.environ.get('COMPRESS_FLUSH_MS', 200)),
+        'disabled': os.environ.get('COMPRESS_DISABLED', '0') == '1'
+    }
+
+
+def choose_encoding() -> str:
+    """Accept-Encoding（q値を考慮）から使うエンコーディングを選ぶ。圧縮しない場合は空文字"""
+    offers = ['br', 'gzip'] if HAS_BROTLI else ['gzip']
+    return request.accept_encodings.best_match(offers) or ''
+
+
+def compress_bytes(data: bytes, encoding: str, level: int = 6, br_quality: int = 4) -> bytes:
+    """バイト列を一括圧縮する"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=br_quality)
+    return gzip.compress(data, compresslevel=level)
+
+
+class StreamCompressor:
+    """チャンク単位で圧縮するストリーミング用コンプレッサ"""
+
+    def __init__(self, encoding: str, level: int = 6, br_quality: int = 4,
+                 flush_bytes: int = 32768, flush_ms: float = 200):
+        """
+        Args:
+            flush_bytes: 前回のフラッシュからこのバイト数の入力が溜まったらフラッシュする
+            flush_ms: 前回のフラッシュからこの時間が経ったらフラッシュする
+        """
+        self.encoding = encoding
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_ms / 1000.0
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=br_quality)
+        else:
+            # wbits=31 で gzip ヘッダ付き
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes) -> bytes:
+        """
+        チャンクを圧縮する。溜まった入力が flush_bytes を超えるか flush_ms 経っていれば、
+        クライアントがすぐ展開できるようフラッシュする
+        """
+        if self.encoding == 'br':
+            data = self._compressor.process(chunk)
+        else:
+            data = self._compressor.compress(chunk)
+        self._pending += len(chunk)
+        if self._pending >= self.flush_bytes or time.monotonic() - self._flushed_at >= self.flush_interval:
+            data += self.flush()
+        return data
+
+    def flush(self) -> bytes:
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+        if self.encoding == 'br':
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+    def wrap(self, iterable):
+        """レスポンスのイテレータを圧縮済みチャンクのイテレータに変換する"""
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                data = self.compress(chunk)
+                if data:
+                    yield data
+        yield self.finish()
+
+
+def _add_vary(response) -> None:
+    vary = [v.strip() for v in response.headers.get('Vary', '').split(',') if v.strip()]
+    if 'Accept-Encoding' not in vary:
+        vary.append('Accept-Encoding')
+    response.headers['Vary'] = ', '.join(vary)
+
+
+def _tag_etag(response, encoding: str) -> None:
+    """エンコーディングごとに表現が異なるため、強い ETag にサフィックスを付ける"""
+    etag = response.headers.get('ETag')
+    if etag and etag.endswith('"'):
+        response.headers['ETag'] = f"{etag[:-1]}-{encoding}\""
+
+
+def compress_response(response):
+    """after_request フック: 条件を満たすレスポンスを圧縮する"""
+    config = _config()
+    if config['disabled']:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    _add_vary(response)
+    encoding = choose_encoding()
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        compressor = StreamCompressor(encoding, config['level'], config['br_quality'],
+                                      config['flush_bytes'], config['flush_ms'])
+        response.response = compressor.wrap(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['min_size']:
+            return response
+        response.set_data(compress_bytes(data, encoding, config['level'], config['br_quality']))
+
+    response.headers['Content-Encoding'] = encoding
+    _tag_etag(response, encoding)
+    return response
+
+
+def init_compression(flask_app: Flask) -> None:
+    """Flask アプリに圧縮フックを登録する"""
+    flask_app.after_request(compress_response)
@@ -1,10 +1,19 @@
 import os
+import json
+import uuid
 import psycopg2
 import pandas as pd
+from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
 import logging
 from datetime import datetime
 
+from history_query import HISTORY_EXPORT_PAGE_SIZE, HistoryQuery
+from prediction_spool import merge_duplicates, prediction_log_row, spool_from_env, valid_log_rows
+
+# 予測ログの冪等キー・まとめ書き込みの関数・集計テーブルとトリガー（Supabase と共通の定義。起動時に実行する）
+PREDICTION_LOGS_SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'prediction_logs.sql')
+
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,6 +35,18 @@ class DatabaseService:
                 logger.error(f"Failed to connect to database: {e}")
                 self.connection = None
 
+        # 予測ログはローカルのスプールに書き、バックグラウンドで一括挿入する（SPOOL_DIR= で無効）
+        # リプレイスレッドはリクエストのスレッドと接続（トランザクション）を共有しない
+        self._spool_connection = None
+        self._spool_connection_pid = None
+        self.spool = None
+        if self.connection:
+            try:
+                self.spool = spool_from_env(self._insert_spooled_logs, 'postgres')
+            except OSError as e:
+                # スプールのディレクトリに書けなくても予測ログは直接挿入する
+                logger.error(f"Failed to open prediction spool, logging predictions directly: {e}")
+
     def _create_tables(self):
         """必要なテーブルを作成"""
         if not self.connection:
@@ -48,6 +69,27 @@ class DatabaseService:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                # 同じモデル・予測日・特徴量の予測を1行にまとめるための列
+                for column in ("features JSONB", "model_version VARCHAR(64)", "fingerprint VARCHAR(32)",
+                               "hit_count INTEGER NOT NULL DEFAULT 1",
+                               "last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"):
+                    cursor.execute(f"ALTER TABLE prediction_logs ADD COLUMN IF NOT EXISTS {column}")
+                cursor.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_prediction_logs_fingerprint
+                    ON prediction_logs(fingerprint)
+                """)
+                # 予測履歴のキーセットページネーション（created_at, id の降順）
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_prediction_logs_created_at_id
+                    ON prediction_logs(created_at, id)
+                """)
+                # 受け取り済みの予測ログの冪等キー・まとめ書き込みの関数・集計テーブルとトリガー
+                with open(PREDICTION_LOGS_SQL_PATH, encoding='utf-8') as f:
+                    cursor.execute(f.read())
+                # 集計テーブルを作った直後は既存の予測ログから作り直す
+                cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM prediction_stats_by_model)")
+                if cursor.fetchone()[0]:
+                    cursor.execute("SELECT refresh_prediction_stats()")
 
                 # シナリオデータテーブル（CSVデータのキャッシュ用）
                 cursor.execute("""
@@ -87,49 +129,83 @@ class DatabaseService:
             logger.error(f"Error creating tables: {e}")
             self.connection.rollback()
 
-    def log_prediction(self, prediction_data):
+    def log_prediction(self, prediction_data, model_version=None):
         """
         予測結果をデータベースに記録
 
         Args:
             prediction_data (dict): 予測データ
+            model_version (str): 予測したモデルのバージョン（指紋に含める）
+        """
+        return self.log_predictions([prediction_data], model_version)
+
+    def log_predictions(self, predictions, model_version=None):
+        """
+        1リクエスト分の予測結果をまとめてデータベースに記録（同じ指紋の予測は1行にまとめる）
+
+        Args:
+            predictions (list): 予測データのリスト
+            model_version (str): 予測したモデルのバージョン
         """
         if not self.connection:
             return False
 
-        try:
-            with self.connection.cursor() as cursor:
-                cursor.execute("""
-                    INSERT INTO prediction_logs (
-                        prediction_date, predicted_value, total_outpatient,
-                        intro_outpatient, er_patients, bed_count,
-                        public_holiday, day_of_week
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    prediction_data.get('date'),
-                    prediction_data.get('prediction'),
-                    prediction_data.get('features', {}).get('total_outpatient'),
-                    prediction_data.get('features', {}).get('intro_outpatient'),
-                    prediction_data.get('features', {}).get('ER'),
-                    prediction_data.get('features', {}).get('bed_count'),
-                    prediction_data.get('features', {}).get('public_holiday', False),
-                    prediction_data.get('day')
-                ))
-                self.connection.commit()
-                logger.info("Prediction logged to database")
-                return True
+        rows = merge_duplicates([prediction_log_row(p, model_version) for p in predictions])
+        if self.spool is not None:
+            self.spool.extend(rows)
+            return True
 
+        rows = valid_log_rows(rows)
+        if not rows:
+            return False
+        try:
+            self.insert_prediction_logs(rows)
+            logger.info(f"Logged {len(rows)} predictions to database")
+            return True
         except Exception as e:
             logger.error(f"Error logging prediction: {e}")
-            self.connection.rollback()
             return False
 
-    def get_prediction_history(self, limit=100):
+    def insert_prediction_logs(self, rows):
         """
-        予測履歴を取得
+        予測ログをまとめて upsert する（失敗時は例外）
 
         Args:
-            limit (int): 取得する件数
+            rows (list): prediction_log_row の形式の行（受け取り済みの idempotency_key の行は無視する）
+        """
+        if not self.connection:
+            raise RuntimeError("Database not available")
+        self._upsert_prediction_logs(self.connection, rows)
+
+    def _insert_spooled_logs(self, rows):
+        """スプールの送信先（リプレイスレッドだけが使う専用の接続で upsert する）"""
+        connection = self._spool_connection
+        if connection is None or connection.closed or self._spool_connection_pid != os.getpid():
+            # fork 前の親の接続（ソケット）は使わない
+            connection = psycopg2.connect(self.connection_string)
+            self._spool_connection = connection
+            self._spool_connection_pid = os.getpid()
+        self._upsert_prediction_logs(connection, rows)
+
+    @staticmethod
+    def _upsert_prediction_logs(connection, rows):
+        rows = [row if 'idempotency_key' in row else {**row, 'idempotency_key': uuid.uuid4().hex} for row in rows]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT upsert_prediction_logs(%s::jsonb)", (json.dumps(rows, default=str),))
+            connection.commit()
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+
+    def get_prediction_history(self, limit=100, query=None):
+        """
+        予測履歴を取得（created_at・id の降順）
+
+        Args:
+            limit (int): 取得する件数（query を指定しない場合）
+            query (HistoryQuery): カーソル・予測日の範囲・曜日・列の指定
 
         Returns:
             list: 予測履歴のリスト
@@ -139,19 +215,95 @@ class DatabaseService:
 
         try:
             with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute("""
-                    SELECT * FROM prediction_logs
-                    ORDER BY created_at DESC
-                    LIMIT %s
-                """, (limit,))
-
+                cursor.execute(*self._history_sql(query or HistoryQuery(limit=limit)))
                 results = cursor.fetchall()
-                return [dict(row) for row in results]
+            self.connection.commit()
+            return [dict(row) for row in results]
 
         except Exception as e:
             logger.error(f"Error fetching prediction history: {e}")
+            self.connection.rollback()
             return []
 
+    def iter_prediction_history(self, query):
+        """
+        予測履歴をサーバー側カーソルで HISTORY_EXPORT_PAGE_SIZE 件ずつ取り出して返す（エクスポート用）
+
+        長いトランザクションで共有の接続を塞がないよう、専用の接続を開いて終わったら閉じる。
+        """
+        if not self.connection:
+            raise RuntimeError("Database not available")
+
+        connection = psycopg2.connect(self.connection_string)
+        try:
+            connection.set_session(readonly=True)
+            with connection.cursor(name=f"history_export_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cursor:
+                cursor.itersize = HISTORY_EXPORT_PAGE_SIZE
+                cursor.execute(*self._history_sql(query))
+                for row in cursor:
+                    yield dict(row)
+            connection.rollback()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _history_sql(query):
+        """検索条件の SELECT 文とパラメータ（列名は HISTORY_COLUMNS で検証済み）"""
+        conditions, params = [], []
+        if query.date_from:
+            conditions.append(sql.SQL("prediction_date >= %s"))
+            params.append(query.date_from)
+        if query.date_to:
+            conditions.append(sql.SQL("prediction_date <= %s"))
+            params.append(query.date_to)
+        if query.days:
+            conditions.append(sql.SQL("day_of_week = ANY(%s)"))
+            params.append(list(query.days))
+        if query.after:
+            conditions.append(sql.SQL("(created_at, id) < (%s::timestamp, %s)"))
+            params.extend(query.after)
+        statement = sql.SQL("SELECT {columns} FROM prediction_logs {where} ORDER BY created_at DESC, id DESC").format(
+            columns=sql.SQL(', ').join(sql.Identifier(c) for c in query.select_columns()),
+            where=sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
+        )
+        if query.limit is not None:
+            statement += sql.SQL(" LIMIT %s")
+            params.append(query.limit)
+        return statement, params
+
+    def get_stats(self, days=30):
+        """
+        統計情報を取得（トリガーで増分更新した集計テーブルを読む）
+
+        Args:
+            days (int): 日別の集計を返す日数
+
+        Returns:
+            dict: 統計情報
+        """
+        if not self.connection:
+            return {"error": "Database not available"}
+
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT get_prediction_stats(%s)", (days,))
+                summary = cursor.fetchone()[0] or {}
+            self.connection.commit()
+            return {
+                "total_predictions": summary.get('total_requests', 0),
+                "unique_predictions": summary.get('unique_predictions', 0),
+                "recent_predictions": summary.get('recent_predictions', []),
+                "daily": summary.get('daily', []),
+                "by_model_version": summary.get('by_model_version', []),
+                "by_weekday": summary.get('by_weekday', []),
+                "database_status": "connected"
+            }
+
+        except Exception as e:
+            logger.error(f"Error getting stats: {e}")
+            self.connection.rollback()
+            return {"error": str(e)}
+
     def store_scenario_data(self, df):
         """
         シナリオデータをデータベースに保存
@@ -287,7 +439,11 @@ class DatabaseService:
             return False
 
     def close(self):
-        """データベース接続を閉じる"""
+        """データベース接続を閉じる（スプールの未送信の行はファイルに残り、次の起動で送る）"""
+        if self.spool is not None:
+            self.spool.close()
+        if self._spool_connection is not None and self._spool_connection_pid == os.getpid():
+            self._spool_connection.close()
         if self.connection:
             self.connection.close()
             logger.info("Database connection closed")
\ No newline at end of file
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RandomForest モデルの蒸留（小さく速い生徒モデルの作成）
+
+教師（fixed_rf_model.joblib または配列形式の .npz）の予測値を目的変数にして、
+浅い勾配ブースティング（scikit-learn の GradientBoostingRegressor）を学習する。
+学習データは学習データCSVの実データの入力（直近 --holdout-days 日分を除く、重み --real-weight）と、
+その行を同じ曜日・祝日の組の中で揺らした入力（export_forest.jittered_inputs、揺らす大きさは --jitter）で、
+目的変数はどちらも教師の予測値（実績値 y は学習に使わない）。範囲内の一様な乱数の入力は、休日に平日並みの
+外来数のような実際には無い行ばかりになり、実データでの教師との誤差を小さくできないため使わない。
+
+学習後、
+- 学習に使っていない揺らした入力（検証用）で、教師との誤差（MAE）が --max-teacher-mae 以下
+- 直近 --holdout-days 日分の実績値に対する MAE の悪化が --max-actual-mae-increase 以下。比べる相手は、教師と
+  同じ設定のフォレストを直近の期間を除いた行で学習し直した参照モデル（教師そのものはこの期間の実績値で
+  学習しているため、その MAE は in-sample の値で、見ていない期間に対する生徒とは比べられない）
+を満たした場合だけ、生徒を配列形式（.npz）で書き出す。満たさなければ書き出さずに終了コード 1。
+直近の期間での教師との誤差と教師の in-sample の MAE は参考として表示する。
+
+既定の設定（木 300 本・深さ 7・--jitter 0.25）は、同梱の学習データと fixed_rf_model.joblib で両方の条件を満たす。
+
+書き出した生徒は ForestPredictor（NumPy のみ）で推論でき、app.py では SERVING_TIER=student で
+使われる（教師のフォレストはオフラインの評価などに残す）。学習には scikit-learn が必要。
+
+使い方:
+    python distill_forest.py --teacher ../fixed_rf_model.joblib --output models/fixed_rf_model.student.npz
+    python distill_forest.py --teacher models/fixed_rf_model.npz --trees 500 --depth 6 --max-teacher-mae 0.3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from compress_forest import load_forest, recent_frame
+from export_forest import flatten_trees, jittered_inputs
+from forest_predictor import FORMAT_VERSION, ForestPredictor, file_sha256, is_artifact
+from inference import FEATURE_COLUMNS
+
+
+def export_student(model, teacher_path: str, metrics: dict) -> ForestPredictor:
+    """学習済みの GradientBoostingRegressor を ForestPredictor（aggregation="sum"）に変換する"""
+    arrays = flatten_trees(model.estimators_[:, 0])
+    init = getattr(model, 'init_', None)
+    bias = float(np.ravel(init.constant_)[0]) if hasattr(init, 'constant_') else 0.0
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'model_type': type(model).__name__,
+        'role': 'student',
+        'n_features': int(model.n_features_in_),
+        'feature_names': None,
+        'max_depth': arrays.pop('max_depth'),
+        'node_count': arrays.pop('node_count'),
+        'aggregation': 'sum',
+        'bias': bias,
+        'scale': float(model.learning_rate),
+        'teacher': os.path.basename(teacher_path),
+        'teacher_sha256': file_sha256(teacher_path),
+        'metrics': metrics,
+        'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    return ForestPredictor(meta=meta, **arrays)
+
+
+def reference_model(teacher_path: str, teacher: ForestPredictor, seed: int):
+    """教師と同じ設定の未学習のフォレスト（実績値の比較用に、直近の期間を除いた行で学習し直す）"""
+    from sklearn.base import clone
+    from sklearn.ensemble import RandomForestRegressor
+    if not is_artifact(teacher_path):
+        import joblib
+        return clone(joblib.load(teacher_path))
+    # 配列形式には学習時の設定が無いため、木の本数だけ合わせた既定の RandomForestRegressor
+    return RandomForestRegressor(n_estimators=teacher.n_estimators, random_state=seed)
+
+
+def mae(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.abs(a - b).mean())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='RandomForest モデルを小さな生徒モデルに蒸留する')
+    parser.add_argument('--teacher', default=os.environ.get('RF_MODEL_PATH', '../fixed_rf_model.joblib'),
+                        help='教師モデル（.joblib または .npz）のパス')
+    parser.add_argument('--output', default='models/fixed_rf_model.student.npz', help='生徒モデルを書き出す .npz のパス')
+    parser.add_argument('--data', default='../ultimate_pickup_data.csv', help='学習データCSV')
+    parser.add_argument('--samples', type=int, default=30000, help='実データを揺らして作る入力の行数')
+    parser.add_argument('--jitter', type=float, default=0.25,
+                        help='揺らす大きさ（同じ曜日・祝日の組の標準偏差に対する倍率）')
+    parser.add_argument('--validation', type=float, default=0.2, help='揺らした入力のうち検証に回す割合')
+    parser.add_argument('--holdout-days', type=int, default=180, help='実績値での検証に使う直近の日数')
+    parser.add_argument('--real-weight', type=float, default=20.0, help='実データの入力1行あたりの学習の重み（ランダム入力は 1）')
+    parser.add_argument('--trees', type=int, default=300, help='生徒の木の本数')
+    parser.add_argument('--depth', type=int, default=7, help='生徒の木の最大深さ')
+    parser.add_argument('--learning-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-teacher-mae', type=float, default=0.5, help='教師との誤差（MAE）の上限')
+    parser.add_argument('--max-actual-mae-increase', type=float, default=0.3, help='実績値に対する MAE の悪化の上限')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.teacher):
+        print(f"教師モデルが見つかりません: {args.teacher}")
+        return 2
+    if not os.path.exists(args.data):
+        print(f"学習データCSVが見つかりません: {args.data}")
+        return 2
+    from sklearn.ensemble import GradientBoostingRegressor
+
+    teacher = load_forest(args.teacher)
+
+    # 入力: 実データ + 実データを揺らした入力（目的変数は教師の予測値）
+    # 直近 --holdout-days 日分は検証にだけ使い、生徒の学習にも揺らす元の行にも入れない
+    frame = recent_frame(args.data, 10 ** 9)
+    holdout = frame.tail(args.holdout_days)
+    history = frame.iloc[:len(frame) - len(holdout)]
+    real = history[FEATURE_COLUMNS].to_numpy(dtype=float)
+    synthetic = jittered_inputs(history, args.samples, args.jitter, args.seed).to_numpy(dtype=float)
+    rng = np.random.default_rng(args.seed)
+    is_validation = rng.random(len(synthetic)) < args.validation
+    X_train = np.vstack([real, synthetic[~is_validation]])
+    weights = np.concatenate([np.full(len(real), args.real_weight), np.ones(int((~is_validation).sum()))])
+    X_valid = synthetic[is_validation]
+    X_holdout = holdout[FEATURE_COLUMNS].to_numpy(dtype=float)
+    actual = holdout['y'].to_numpy(dtype=float)
+
+    start = time.perf_counter()
+    student = GradientBoostingRegressor(
+        n_estimators=args.trees, max_depth=args.depth, learning_rate=args.learning_rate,
+        subsample=0.8, random_state=args.seed
+    )
+    student.fit(X_train, teacher.predict(X_train), sample_weight=weights)
+    train_s = time.perf_counter() - start
+
+    # 教師と同じ設定で直近の期間を見ずに学習した参照モデル（実績値の MAE の比較相手）
+    reference = reference_model(args.teacher, teacher, args.seed)
+    reference.fit(real, history['y'].to_numpy(dtype=float))
+
+    teacher_holdout = teacher.predict(X_holdout)
+    student_holdout = student.predict(X_holdout)
+    metrics = {
+        'teacher_mae_validation': mae(student.predict(X_valid), teacher.predict(X_valid)),
+        'teacher_mae_holdout': mae(student_holdout, teacher_holdout),
+        'actual_mae_teacher': mae(teacher_holdout, actual),
+        'actual_mae_reference': mae(reference.predict(X_holdout), actual),
+        'actual_mae_student': mae(student_holdout, actual),
+        'holdout_days': int(len(actual)),
+        'train_rows': int(len(X_train)),
+        'jitter': args.jitter
+    }
+    metrics['actual_mae_increase'] = metrics['actual_mae_student'] - metrics['actual_mae_reference']
+    exported = export_student(student, args.teacher, metrics)
+
+    # 配列形式が scikit-learn の生徒と同じ値を返すか確認する
+    check = np.vstack([X_valid, X_holdout])
+    export_diff = float(np.abs(exported.predict(check) - student.predict(check)).max())
+
+    sample = X_holdout[:1]
+    timings = {}
+    for name, model in (('teacher', teacher), ('student', exported)):
+        model.predict(sample)
+        start = time.perf_counter()
+        for _ in range(200):
+            model.predict(sample)
+        timings[name] = (time.perf_counter() - start) / 200 * 1000
+
+    print(f"生徒モデル: 木 {exported.n_estimators} 本、深さ {exported.max_depth}、ノード {len(exported.feature)}"
+          f"（教師: 木 {teacher.n_estimators} 本、ノード {len(teacher.feature)}）、学習 {train_s:.1f} 秒")
+    print(f"メモリ:                 {teacher.nbytes() / 1024:8.0f} KiB -> {exported.nbytes() / 1024:.0f} KiB")
+    print(f"1行の推論時間:          {timings['teacher']:8.3f} ms -> {timings['student']:.3f} ms")
+    print(f"教師との MAE（検証）:   {metrics['teacher_mae_validation']:8.4f}（上限 {args.max_teacher_mae}）")
+    print(f"教師との MAE（直近）:   {metrics['teacher_mae_holdout']:8.4f}（参考: 教師はこの期間を学習済み）")
+    print(f"実績値との MAE（直近 {metrics['holdout_days']} 日）: 参照 {metrics['actual_mae_reference']:.4f} / "
+          f"生徒 {metrics['actual_mae_student']:.4f}（悪化の上限 {args.max_actual_mae_increase}）、"
+          f"教師 {metrics['actual_mae_teacher']:.4f}（in-sample）")
+
+    failures = []
+    if export_diff > 1e-6:
+        failures.append(f"配列形式と scikit-learn の生徒の予測が一致しません（差 {export_diff:.3g}）")
+    if metrics['teacher_mae_validation'] > args.max_teacher_mae:
+        failures.append("教師との誤差が上限を超えています")
+    if metrics['actual_mae_increase'] > args.max_actual_mae_increase:
+        failures.append("実績値に対する MAE の悪化が上限を超えています")
+    if failures:
+        print("\n生徒モデルを書き出しませんでした:")
+        for line in failures:
+            print(f"  {line}")
+        return 1
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    exported.save(args.output)
+    print(f"\n書き出し: {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RandomForest モデルを配列形式（.npz）に書き出す
+
+fixed_rf_model.joblib（scikit-learn の RandomForestRegressor）の各決定木のノードを
+連結した配列にして保存する。書き出したファイルは forest_predictor.py（NumPy のみ）で
+推論でき、RF_MODEL_PATH に指定すればサービング時に scikit-learn が不要になる。
+
+書き出し後、学習データCSVの行と範囲内のランダムな入力で scikit-learn の予測と比較し、
+差の最大値が --tolerance を超えたら終了コード 1 を返す（書き出しにだけ scikit-learn が必要）。
+
+使い方:
+    python export_forest.py --model ../fixed_rf_model.joblib --output models/fixed_rf_model.npz
+    python export_forest.py --model ../fixed_rf_model.joblib --output models/fixed_rf_model.npz \\
+        --check-data ../ultimate_pickup_data.csv --samples 20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from forest_predictor import FORMAT_VERSION, ForestPredictor, file_sha256
+from inference import DAY_CODES, FEATURE_COLUMNS, SAMPLE_FEATURES, patch_estimators
+
+# CSV が無い場合にランダム入力を作る範囲（数値特徴量）
+DEFAULT_RANGES = {
+    'total_outpatient': (200, 1000),
+    'intro_outpatient': (0, 60),
+    'ER': (0, 50),
+    'bed_count': (150, 350)
+}
+
+
+def flatten_trees(trees) -> dict:
+    """scikit-learn の回帰木のリストを、ノードを連結した配列にする（ForestPredictor の引数）"""
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in trees:
+        tree = estimator.tree_
+        n = tree.node_count
+        leaf = tree.children_left < 0
+        index = np.arange(n)
+        # 葉は特徴量 -1、子は自分自身（何段辿っても葉に留まる）
+        features.append(np.where(leaf, -1, tree.feature).astype(np.int32))
+        thresholds.append(np.where(leaf, 0.0, tree.threshold).astype(np.float64))
+        lefts.append((np.where(leaf, index, tree.children_left) + offset).astype(np.int32))
+        rights.append((np.where(leaf, index, tree.children_right) + offset).astype(np.int32))
+        values.append(tree.value[:, 0, 0].astype(np.float64))
+        roots.append(offset)
+        offset += n
+        max_depth = max(max_depth, tree.max_depth)
+    return {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'left': np.concatenate(lefts),
+        'right': np.concatenate(rights),
+        'value': np.concatenate(values),
+        'roots': np.asarray(roots, dtype=np.int32),
+        'max_depth': int(max_depth),
+        'node_count': int(offset)
+    }
+
+
+def export_forest(model, source: str = None) -> ForestPredictor:
+    """学習済みの RandomForestRegressor を ForestPredictor に変換する"""
+    estimators = getattr(model, 'estimators_', None)
+    if not estimators:
+        raise ValueError(f"決定木のアンサンブルではありません: {type(model).__name__}")
+    if getattr(model, 'n_outputs_', 1) != 1:
+        raise ValueError("出力が1つの回帰モデルのみ対応しています")
+
+    arrays = flatten_trees(estimators)
+    names = getattr(model, 'feature_names_in_', None)
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'model_type': type(model).__name__,
+        'n_features': int(model.n_features_in_),
+        'feature_names': [str(c) for c in names] if names is not None else None,
+        'max_depth': arrays.pop('max_depth'),
+        'node_count': arrays.pop('node_count'),
+        'sklearn_version': getattr(model, '_sklearn_version', None),
+        'source': os.path.basename(source) if source else None,
+        'source_sha256': file_sha256(source) if source else None,
+        'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    return ForestPredictor(meta=meta, **arrays)
+
+
+def input_ranges(data: pd.DataFrame) -> dict:
+    """学習データの数値特徴量ごとの (最小, 最大)"""
+    return {c: (data[c].min(), data[c].max()) for c in DEFAULT_RANGES}
+
+
+def random_inputs(samples: int, ranges: dict = None, seed: int = 0) -> pd.DataFrame:
+    """範囲内のランダムな入力（曜日は one-hot、祝日は 0/1、数値は整数、FEATURE_COLUMNS 順）"""
+    rng = np.random.default_rng(seed)
+    ranges = ranges or DEFAULT_RANGES
+    random = pd.DataFrame(0, index=range(samples), columns=FEATURE_COLUMNS, dtype=float)
+    days = rng.integers(0, len(DAY_CODES), samples)
+    for i, day in enumerate(DAY_CODES):
+        random[day] = (days == i).astype(float)
+    random['public_holiday'] = rng.integers(0, 2, samples)
+    random['public_holiday_previous_day'] = rng.integers(0, 2, samples)
+    for column, (low, high) in ranges.items():
+        random[column] = rng.integers(int(low), int(high) + 1, samples)
+    return random
+
+
+def jittered_inputs(data: pd.DataFrame, samples: int, scale: float = 0.25, seed: int = 0) -> pd.DataFrame:
+    """
+    学習データの実際の行を揺らした入力（FEATURE_COLUMNS 順）
+
+    行をランダムに選び、曜日・祝日はそのままにして、数値特徴量に同じ曜日・祝日の組の標準偏差 × scale の
+    正規ノイズを加える（整数に丸め、組の最小〜最大に収める）。random_inputs と違い、休日に平日並みの
+    外来数のような実際には無い組み合わせを作らない。
+    """
+    rng = np.random.default_rng(seed)
+    data = data[FEATURE_COLUMNS].astype(float).reset_index(drop=True)
+    numeric = list(DEFAULT_RANGES)
+    group = data[DAY_CODES + ['public_holiday']].astype(int).astype(str).agg(''.join, axis=1)
+    grouped = data.groupby(group)[numeric]
+    std = grouped.transform('std').fillna(0.0).to_numpy()
+    low = grouped.transform('min').to_numpy()
+    high = grouped.transform('max').to_numpy()
+
+    rows = rng.integers(0, len(data), samples)
+    jittered = data.iloc[rows].reset_index(drop=True)
+    noise = rng.normal(0.0, 1.0, (samples, len(numeric))) * std[rows] * scale
+    jittered[numeric] = np.clip(np.rint(jittered[numeric].to_numpy() + noise), low[rows], high[rows])
+    return jittered
+
+
+def check_inputs(data_path: str = None, samples: int = 10000, seed: int = 0) -> pd.DataFrame:
+    """比較用の入力（学習データCSVの行 + 範囲内のランダムな入力、FEATURE_COLUMNS 順）"""
+    frames = [pd.DataFrame([SAMPLE_FEATURES])[FEATURE_COLUMNS]]
+    ranges = None
+    if data_path:
+        data = pd.read_csv(data_path)[FEATURE_COLUMNS].dropna()
+        frames.append(data)
+        ranges = input_ranges(data)
+    if samples > 0:
+        frames.append(random_inputs(samples, ranges, seed))
+    return pd.concat(frames, ignore_index=True).astype(float)
+
+
+def compare_predictions(model, predictor: ForestPredictor, inputs: pd.DataFrame) -> dict:
+    """scikit-learn とForestPredictor の予測を比較する"""
+    names = getattr(model, 'feature_names_in_', None)
+    model_input = inputs[[str(c) for c in names]] if names is not None else inputs.to_numpy()
+
+    start = time.perf_counter()
+    expected = np.asarray(model.predict(model_input), dtype=float)
+    sklearn_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    actual = predictor.predict(model_input)
+    numpy_ms = (time.perf_counter() - start) * 1000
+
+    diff = np.abs(expected - actual)
+    return {
+        'rows': len(inputs),
+        'max_abs_diff': float(diff.max()),
+        'mismatched_rows': int((diff > 0).sum()),
+        'sklearn_ms': sklearn_ms,
+        'numpy_ms': numpy_ms
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='RandomForest モデルを配列形式に書き出す')
+    parser.add_argument('--model', default=os.environ.get('RF_MODEL_PATH', '../fixed_rf_model.joblib'),
+                        help='書き出す joblib モデルのパス')
+    parser.add_argument('--output', default='models/fixed_rf_model.npz', help='出力する .npz のパス')
+    parser.add_argument('--compress', action='store_true', help='zip 圧縮して保存する')
+    parser.add_argument('--check-data', help='比較に使う学習データCSV（ultimate_pickup_data.csv）')
+    parser.add_argument('--samples', type=int, default=10000, help='比較に使うランダム入力の行数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=1e-9, help='許容する予測値の差の最大値')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"モデルファイルが見つかりません: {args.model}")
+        return 2
+
+    start = time.perf_counter()
+    model = joblib.load(args.model)
+    joblib_ms = (time.perf_counter() - start) * 1000
+    patch_estimators(model)
+
+    predictor = export_forest(model, args.model)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    predictor.save(args.output, compress=args.compress)
+
+    start = time.perf_counter()
+    loaded = ForestPredictor.load(args.output)
+    npz_ms = (time.perf_counter() - start) * 1000
+
+    print(f"書き出し: {args.output}（木 {loaded.n_estimators} 本、ノード {loaded.meta['node_count']}、"
+          f"最大深さ {loaded.max_depth}）")
+    print(f"ファイルサイズ: {os.path.getsize(args.model) / 1024:.0f} KiB (joblib) -> "
+          f"{os.path.getsize(args.output) / 1024:.0f} KiB (npz)")
+    print(f"ロード時間: {joblib_ms:.0f} ms (joblib) -> {npz_ms:.0f} ms (npz)")
+
+    result = compare_predictions(model, loaded, check_inputs(args.check_data, args.samples, args.seed))
+    print(f"予測の比較: {result['rows']} 行、差の最大値 {result['max_abs_diff']:.3g}、"
+          f"不一致 {result['mismatched_rows']} 行")
+    print(f"推論時間: {result['sklearn_ms']:.1f} ms (scikit-learn) / {result['numpy_ms']:.1f} ms (numpy)")
+    if result['max_abs_diff'] > args.tolerance:
+        print(f"エラー: 予測値の差が許容範囲（{args.tolerance}）を超えています")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+配列形式のランダムフォレスト推論（NumPy のみ）
+
+export_forest.py が scikit-learn の RandomForestRegressor から書き出した .npz
+アーティファクトを読み込み、scikit-learn なしで同じ予測値を計算する。
+サービング時に scikit-learn の import・unpickle（と monotonic_cst の補正）が不要になる。
+1回の呼び出しは軽いが行数に比例して遅くなり、約 1000 行で scikit-learn（Cython）と逆転するため、
+大量行の推論は inference.py が書き出し元の joblib モデルに回す（FOREST_LARGE_BATCH_ROWS）。
+
+アーティファクトの中身（全木のノードを1本の配列に連結）:
+    feature    int32    分割に使う特徴量の列番号（葉は -1）
+    threshold  float64  分割の閾値（x <= threshold なら左）
+    left       int32    左の子ノードの通し番号（葉は自分自身）
+    right      int32    右の子ノードの通し番号（葉は自分自身）
+    value      float64  ノードの予測値（葉のみ使用）
+
+compress_forest.py で圧縮したアーティファクトは feature が int8、threshold と value が float32 になる。
+distill_forest.py の生徒モデル（勾配ブースティング）は meta の aggregation が "sum" で、
+予測値は bias + scale * 葉の値の合計になる（既定の "mean" は葉の値の平均）。
+    roots      int32    各木の根ノードの通し番号
+    meta       str      JSON（特徴量数・特徴量名・最大深さ・書き出し元など）
+"""
+
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+FORMAT_VERSION = 1
+ARTIFACT_SUFFIX = '.npz'
+# 一度に辿る行数（行数 × 木の数 の作業配列の大きさを抑える）
+ROW_BLOCK = 1024
+
+
+class ForestPredictor:
+    """配列化した回帰フォレスト（ランダムフォレストまたは勾配ブースティング）"""
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, left: np.ndarray, right: np.ndarray,
+                 value: np.ndarray, roots: np.ndarray, meta: Dict):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.meta = meta
+        self.feature_names: Optional[List[str]] = meta.get('feature_names')
+        self.n_features = int(meta['n_features'])
+        if self.feature_names:
+            # 特徴量名付きで学習したモデルと同じく、InferenceEngine にその列順で渡してもらう
+            self.feature_names_in_ = np.array(self.feature_names, dtype=object)
+        self.n_estimators = len(roots)
+        self.max_depth = int(meta['max_depth'])
+        self.aggregation = meta.get('aggregation', 'mean')
+        self.bias = float(meta.get('bias', 0.0))
+        self.scale = float(meta.get('scale', 1.0))
+        # 辿る時の作業用: child[2 * node + (x <= threshold)] が次のノード（葉は自分自身に戻る）
+        self._child = np.stack([right, left], axis=1).ravel().astype(np.intp)
+        self._feature = feature.astype(np.intp)
+
+    @classmethod
+    def load(cls, path: str) -> 'ForestPredictor':
+        """.npz アーティファクトを読み込む"""
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('format_version') != FORMAT_VERSION:
+                raise ValueError(f"未対応のアーティファクト形式です: {meta.get('format_version')}")
+            arrays = {name: np.array(data[name]) for name in ('feature', 'threshold', 'left', 'right', 'value', 'roots')}
+        return cls(meta=meta, **arrays)
+
+    def save(self, path: str, compress: bool = False) -> None:
+        """アーティファクトを書き出す（compress=True なら zip 圧縮してファイルを小さくする）"""
+        writer = np.savez_compressed if compress else np.savez
+        with open(path, 'wb') as f:
+            writer(
+                f,
+                feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                value=self.value, roots=self.roots, meta=np.array(json.dumps(self.meta, ensure_ascii=False))
+            )
+
+    def _as_matrix(self, X) -> np.ndarray:
+        # DataFrame なら保存時の特徴量名の順に並べ替える
+        if hasattr(X, 'columns') and self.feature_names:
+            X = X[self.feature_names].to_numpy()
+        X = np.asarray(X)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"特徴量の数が一致しません: {X.shape} (期待値: {self.n_features} 列)")
+        # scikit-learn の決定木は入力を float32 にしてから閾値と比較する（閾値が float32 ならそのまま比較）
+        return X.astype(np.float32).astype(self.threshold.dtype)
+
+    def predict(self, X) -> np.ndarray:
+        """全ての木を同時に辿り、葉の値の平均を返す"""
+        X = self._as_matrix(X)
+        out = np.empty(len(X))
+        for start in range(0, len(X), ROW_BLOCK):
+            out[start:start + ROW_BLOCK] = self._predict_block(X[start:start + ROW_BLOCK])
+        return out
+
+    def _predict_block(self, X: np.ndarray) -> np.ndarray:
+        n_rows, n_trees = len(X), self.n_estimators
+        # (行, 木) の組を1次元に並べ、全ての組を1段ずつ進める。葉は自分自身に戻るので、
+        # 葉に着いた組が半分を超えた時だけ、まだ辿っている組に詰め直す
+        nodes = np.tile(self.roots.astype(np.intp), n_rows)
+        offsets = np.repeat(np.arange(n_rows, dtype=np.intp) * X.shape[1], n_trees)
+        flat = X.ravel()
+        active = None
+        current = nodes
+        while current.size:
+            feature = self._feature[current]
+            inner = feature >= 0
+            n_inner = np.count_nonzero(inner)
+            if n_inner == 0:
+                break
+            if n_inner * 2 < current.size:
+                if active is None:
+                    nodes = current
+                else:
+                    nodes[active] = current
+                keep = np.flatnonzero(inner)
+                active = keep if active is None else active[keep]
+                current, offsets, feature = current[keep], offsets[keep], feature[keep]
+            # 葉（feature = -1）は隣の列を読むが、次のノードは自分自身なので結果に影響しない
+            go_left = (flat[offsets + feature] <= self.threshold[current]).view(np.int8)
+            current = self._child[2 * current + go_left]
+        if active is None:
+            nodes = current
+        else:
+            nodes[active] = current
+        leaves = self.value[nodes].reshape(n_rows, n_trees)
+        if self.aggregation == 'sum':
+            return self.bias + self.scale * leaves.sum(axis=1, dtype=np.float64)
+        return leaves.mean(axis=1, dtype=np.float64)
+
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.feature, self.threshold, self.left, self.right, self.value, self.roots))
+
+
+def is_artifact(path: Optional[str]) -> bool:
+    return bool(path) and path.endswith(ARTIFACT_SUFFIX)
+
+
+def file_sha256(path: str) -> str:
+    """モデルファイルの sha256（アーティファクトと元モデルの対応づけに使う）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
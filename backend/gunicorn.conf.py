@@ -0,0 +1,28 @@
+"""
+gunicorn 設定（カレントディレクトリの gunicorn.conf.py は自動で読み込まれる）
+
+Prometheus メトリクスを全ワーカーで集計するため、マルチプロセス用ディレクトリを
+マスタープロセスで用意し、終了したワーカーの値を片付ける。
+"""
+
+import os
+import shutil
+import tempfile
+
+PROMETHEUS_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'inhospital_prometheus')
+)
+
+
+def on_starting(server):
+    # 前回起動時の値が混ざらないよう空にしてから作り直す
+    shutil.rmtree(PROMETHEUS_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+    except Exception:
+        pass
@@ -0,0 +1,197 @@
+"""
+予測履歴（prediction_logs）の検索条件・カーソル・エクスポート形式
+
+/api/history は created_at・id の降順に並べ、前のページの最後の行の (created_at, id) より
+後ろの行を取る（キーセットページネーション）。OFFSET と違って深いページでも読み飛ばす行が
+無く、ページの間に行が追加されても重複・欠落しない。カーソルは (created_at, id) を
+base64url にした文字列で、クライアントは next_cursor をそのまま次のリクエストに渡す。
+
+エクスポート（format=ndjson / csv）は全件を1ページずつ取り出して逐次返すため、
+数か月分の履歴でもワーカーのメモリに全件を載せない。
+"""
+
+import base64
+import copy
+import csv
+import io
+import json
+import os
+from datetime import date, datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from inference import DAY_CODES
+
+# 取得・エクスポートできる列（columns= で絞り込む）
+HISTORY_COLUMNS = (
+    'id', 'prediction_date', 'predicted_value', 'total_outpatient', 'intro_outpatient', 'er_patients',
+    'bed_count', 'public_holiday', 'day_of_week', 'features', 'model_version', 'fingerprint', 'hit_count',
+    'created_at', 'last_seen_at'
+)
+# カーソルに使う列（列を絞り込んでも必ず返す）
+KEYSET_COLUMNS = ('created_at', 'id')
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# 1ページの最大件数（JSON）とエクスポートで1回に取り出す件数
+HISTORY_MAX_LIMIT = int(os.environ.get('HISTORY_MAX_LIMIT', '1000'))
+HISTORY_EXPORT_PAGE_SIZE = int(os.environ.get('HISTORY_EXPORT_PAGE_SIZE', '1000'))
+
+
+def row_key(row: Dict) -> Tuple[str, int]:
+    """行の (created_at, id)"""
+    created_at = row['created_at']
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    return created_at, int(row['id'])
+
+
+def encode_cursor(row: Dict) -> str:
+    """行の (created_at, id) をカーソル文字列にする"""
+    raw = json.dumps(list(row_key(row)), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """カーソル文字列を (created_at, id) に戻す（不正なら ValueError）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        datetime.fromisoformat(created_at)
+        return created_at, int(row_id)
+    except Exception:
+        raise ValueError(f"不正なカーソルです: {cursor}")
+
+
+def _parse_date(value: Optional[str], name: str) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f"{name} は YYYY-MM-DD で指定してください: {value}")
+
+
+def _parse_list(value: Optional[str]) -> List[str]:
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+class HistoryQuery:
+    """予測履歴の検索条件"""
+
+    def __init__(self, limit: Optional[int] = 100, cursor: Optional[str] = None, date_from: Optional[str] = None,
+                 date_to: Optional[str] = None, days: Optional[Sequence[str]] = None,
+                 columns: Optional[Sequence[str]] = None):
+        """
+        Args:
+            limit: 取得する件数（None なら全件。エクスポート用）
+            cursor: 前のページの next_cursor
+            date_from: 予測日の下限（YYYY-MM-DD、含む）
+            date_to: 予測日の上限（YYYY-MM-DD、含む）
+            days: 予測日の曜日コード（mon ... sun）
+            columns: 返す列（None なら全列）
+        """
+        self.limit = limit
+        self.after = decode_cursor(cursor) if cursor else None
+        self.date_from = _parse_date(date_from, 'date_from')
+        self.date_to = _parse_date(date_to, 'date_to')
+        self.days = list(days or [])
+        unknown = [d for d in self.days if d not in DAY_CODES]
+        if unknown:
+            raise ValueError(f"不明な曜日です: {', '.join(unknown)}（{', '.join(DAY_CODES)}）")
+        self.columns = list(columns) if columns else None
+        unknown = [c for c in self.columns or [] if c not in HISTORY_COLUMNS]
+        if unknown:
+            raise ValueError(f"不明な列です: {', '.join(unknown)}")
+
+    @classmethod
+    def from_args(cls, args, export: bool = False) -> 'HistoryQuery':
+        """
+        リクエストのクエリ文字列から作る（不正な値は ValueError）
+
+        limit は 1 から HISTORY_MAX_LIMIT まで。エクスポートでは limit を省略すると全件。
+        """
+        limit = args.get('limit', None if export else 100, type=int)
+        if limit is not None and not export:
+            limit = min(max(limit, 1), HISTORY_MAX_LIMIT)
+        return cls(
+            limit=limit,
+            cursor=args.get('cursor') or None,
+            date_from=args.get('date_from'),
+            date_to=args.get('date_to'),
+            days=_parse_list(args.get('day_of_week')),
+            columns=_parse_list(args.get('columns')) or None
+        )
+
+    def select_columns(self) -> List[str]:
+        """取得する列（カーソル用の列を含む）"""
+        if self.columns is None:
+            return list(HISTORY_COLUMNS)
+        return self.columns + [c for c in KEYSET_COLUMNS if c not in self.columns]
+
+    def page(self, after: Optional[Tuple[str, int]], limit: Optional[int]) -> 'HistoryQuery':
+        """同じ条件で、after より後ろの limit 件を取る検索条件"""
+        page = copy.copy(self)
+        page.after = after
+        page.limit = limit
+        return page
+
+
+def next_cursor(rows: List[Dict], limit: Optional[int]) -> Optional[str]:
+    """ページが埋まっていれば最後の行のカーソル（続きが無ければ None）"""
+    if not rows or limit is None or len(rows) < limit:
+        return None
+    return encode_cursor(rows[-1])
+
+
+def iter_pages(fetch, query: HistoryQuery, page_size: int = HISTORY_EXPORT_PAGE_SIZE) -> Iterator[Dict]:
+    """
+    fetch(検索条件) を1ページずつ呼び、query.limit 件（None なら全件）まで行を返す
+
+    サーバー側カーソルを使えないバックエンド（PostgREST）のエクスポート用。
+    """
+    remaining = query.limit
+    after = query.after
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        rows = fetch(query.page(after, size))
+        yield from rows
+        if len(rows) < size:
+            return
+        if remaining is not None:
+            remaining -= len(rows)
+        after = row_key(rows[-1])
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def ndjson_lines(rows: Iterable[Dict]) -> Iterator[str]:
+    """1行1件の NDJSON"""
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, default=_json_default) + '\n'
+
+
+def csv_lines(rows: Iterable[Dict], columns: Sequence[str]) -> Iterator[str]:
+    """ヘッダ行付きの CSV（features などの dict は JSON 文字列にする）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values) -> str:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(columns)
+    for row in rows:
+        values = []
+        for column in columns:
+            value = row.get(column)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, ensure_ascii=False)
+            elif isinstance(value, (date, datetime)):
+                value = value.isoformat()
+            values.append(value)
+        yield line(values)
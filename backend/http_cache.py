@@ -0,0 +1,162 @@
+"""
+決定的な予測エンドポイント向けの HTTP 条件付きキャッシュ（ETag / Cache-Control）
+
+同じモデル・同じ祝日カレンダー・同じ入力なら予測結果は変わらないため、
+それらから強い ETag を作り、If-None-Match が一致すれば特徴量作成や推論の前に
+304 を返す。GET でも同じ入力を受け付けられるよう、クエリ文字列からの入力取得も提供する。
+"""
+
+import hashlib
+import json
+import os
+from datetime import date
+from functools import wraps
+from typing import Dict, Iterable, Optional
+
+from flask import request, make_response
+
+from metrics import record_cache
+
+# 同じ入力でも Accept（カラムナ形式など）で表現が変わる
+VARY_HEADERS = 'Accept'
+
+
+def file_signature(path: Optional[str]) -> str:
+    """ファイルのサイズと更新時刻から軽量なバージョン文字列を作る"""
+    if not path or not os.path.exists(path):
+        return 'none'
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+_digest_cache: Dict[str, str] = {}
+
+
+def file_digest(path: Optional[str]) -> str:
+    """ファイル内容の sha256（先頭16桁）。サイズ・更新時刻が変わらない間は再計算しない"""
+    signature = file_signature(path)
+    if signature == 'none':
+        return 'none'
+    digest = _digest_cache.get(f"{path}|{signature}")
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()[:16]
+        _digest_cache[f"{path}|{signature}"] = digest
+    return digest
+
+
+def calendar_version() -> str:
+    """祝日判定ロジックのバージョン（jpholiday のバージョン、なければ簡易版）"""
+    try:
+        import jpholiday  # type: ignore
+        return f"jpholiday-{getattr(jpholiday, '__version__', 'unknown')}"
+    except Exception:
+        return 'builtin-2025'
+
+
+def _coerce(value: str):
+    """クエリ文字列の値を JSON ボディと同じ型に寄せる"""
+    lowered = value.lower()
+    if lowered in ('true', 'false'):
+        return lowered == 'true'
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            continue
+    return value
+
+
+def request_payload() -> Dict:
+    """
+    リクエストの入力を取得する
+
+    POST は JSON ボディ、GET はクエリ文字列（format などの表示用パラメータを除く）を使う。
+    """
+    if request.method == 'GET':
+        return {k: _coerce(v) for k, v in request.args.items() if k != 'format'}
+    return request.get_json(silent=True) or {}
+
+
+def compute_etag(endpoint: str, version: str, payload: Dict, date_keys: Iterable[str] = ()) -> str:
+    """
+    エンドポイント・バージョン・正規化した入力から強い ETag を作る
+
+    日付系の入力が省略された場合は「今日」が既定値になるため、当日の日付も含める。
+    """
+    canonical = {
+        'endpoint': endpoint,
+        'version': version,
+        'inputs': payload,
+        'format': request.args.get('format', ''),
+        'accept': request.headers.get('Accept', '')
+    }
+    if any(key not in payload for key in date_keys):
+        canonical['today'] = date.today().isoformat()
+    body = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+# 圧縮時に ETag へ付くエンコーディングのサフィックス（compression.py）
+ENCODING_SUFFIXES = ('-gzip"', '-br"')
+
+
+def _normalize_etag(tag: str) -> str:
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    for suffix in ENCODING_SUFFIXES:
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+def etag_matches(etag: str) -> bool:
+    """If-None-Match ヘッダがこの ETag（圧縮表現を含む）に一致するか"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    candidates = [_normalize_etag(c) for c in header.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def conditional(version_func, max_age: int, date_keys: Iterable[str] = ()):
+    """
+    ビュー関数に ETag / Cache-Control を付けるデコレータ
+
+    Args:
+        version_func (callable): モデル・カレンダー等のバージョン文字列を返す関数
+        max_age (int): Cache-Control の max-age（秒）。環境変数 CACHE_MAX_AGE_<ENDPOINT> で上書き可能
+        date_keys (iterable): 省略時に「今日」が既定値になる入力キー
+    """
+    date_keys = tuple(date_keys)
+
+    def decorator(view):
+        env_key = f"CACHE_MAX_AGE_{view.__name__.upper()}"
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            age = int(os.environ.get(env_key, max_age))
+            cache_control = f"public, max-age={age}" if age > 0 else 'no-cache'
+            etag = compute_etag(request.endpoint or view.__name__, version_func(), request_payload(), date_keys)
+
+            hit = etag_matches(etag)
+            record_cache('http_etag', hit)
+            if hit:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = cache_control
+            response.headers['Vary'] = VARY_HEADERS
+            return response
+
+        return wrapper
+
+    return decorator
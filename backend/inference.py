@@ -0,0 +1,522 @@
+"""
+推論コア（app.py・simple_server.py・raw_model_server.py・ModelService で共通）
+
+HTTP 層は特徴量の dict を作ってここを呼ぶだけにし、モデルのロード・古い
+scikit-learn で保存したモデルの補正（monotonic_cst）・代替モデル・ベクトル化した
+推論・予測キャッシュ・メトリクスをこのモジュールに集約する。
+
+環境変数:
+    PREDICTION_CACHE_SIZE  特徴量行ごとの予測キャッシュの最大件数（0 で無効、既定: 4096）
+    PREDICT_CHUNK_SIZE     大量行の一括推論で1回の model.predict に渡す最大行数（既定: 5000）
+    PREDICT_PARALLEL_WORKERS  大量行をチャンクに分けて並列推論するスレッド数（既定: CPU数、1 で逐次）
+    PREDICT_PARALLEL_MIN_ROWS 並列推論に分割する最小行数（既定: 2000。これ未満は1回で推論）
+    PREDICTION_GRID_PATH   build_prediction_grid.py で作った予測グリッド（.npy）。ロードしたモデルと同じ
+                           モデルから作ったものなら、格子点の行はグリッドから引き、それ以外はモデルで推論する
+    PREDICTION_GRID_MODE   exact（既定、格子点ちょうどの値だけ）/ nearest（範囲内なら最も近い格子点）
+    FOREST_LARGE_BATCH_ROWS  .npz のモデルで、この行数以上の推論を書き出し元の joblib モデルで行う
+                           （既定: 1000。0 で無効。NumPy の推論はこの付近から scikit-learn より遅くなる）
+    FOREST_SOURCE_MODEL_PATH 書き出し元の joblib モデル（既定: .npz と同じディレクトリか1つ上にある meta の source）
+
+決定木の推論は GIL を解放するため、チャンクの並列実行はスレッドでも複数コアを使える。
+起動を速くするため joblib（scikit-learn）と pandas は必要になった時点で import する。
+"""
+
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from batching import BatchDispatcher
+from forest_predictor import ForestPredictor, file_sha256, is_artifact
+from metrics import record_cache, record_cache_rows, record_prediction_rows, register_queue, stage
+from prediction_grid import PredictionGrid
+
+DAY_CODES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# モデルの特徴量（学習データCSVの列順）
+FEATURE_COLUMNS = DAY_CODES + [
+    'public_holiday', 'public_holiday_previous_day',
+    'total_outpatient', 'intro_outpatient', 'ER', 'bed_count'
+]
+
+# ロード時の動作確認に使う特徴量（木曜・平日・標準的な入力）
+SAMPLE_FEATURES = {
+    'mon': 0, 'tue': 0, 'wed': 0, 'thu': 1, 'fri': 0, 'sat': 0, 'sun': 0,
+    'public_holiday': 0, 'public_holiday_previous_day': 0,
+    'total_outpatient': 500, 'intro_outpatient': 20, 'ER': 15, 'bed_count': 280
+}
+
+_COLUMN_INDEX = {name: i for i, name in enumerate(FEATURE_COLUMNS)}
+
+# チャンク並列推論用のスレッドプール（プロセスごとに1つ、初回利用時に作成）
+_parallel_pool: Optional[ThreadPoolExecutor] = None
+_parallel_pool_lock = threading.Lock()
+
+
+def parallel_workers() -> int:
+    return max(1, int(os.environ.get('PREDICT_PARALLEL_WORKERS', os.cpu_count() or 1)))
+
+
+def _get_parallel_pool() -> ThreadPoolExecutor:
+    global _parallel_pool
+    with _parallel_pool_lock:
+        if _parallel_pool is None:
+            _parallel_pool = ThreadPoolExecutor(max_workers=parallel_workers(), thread_name_prefix='predict-chunk')
+        return _parallel_pool
+
+
+class FeatureError(ValueError):
+    """特徴量 dict が不正（欠損・数値でない値）"""
+
+
+def feature_values(row) -> List[float]:
+    """特徴量 dict を検証し、FEATURE_COLUMNS 順の float のリストにする"""
+    if not isinstance(row, dict):
+        raise FeatureError("特徴量は dict で指定してください")
+    missing = [c for c in FEATURE_COLUMNS if c not in row]
+    if missing:
+        raise FeatureError(f"特徴量がありません: {', '.join(missing)}")
+    values = []
+    for column in FEATURE_COLUMNS:
+        try:
+            value = float(row[column])
+        except (TypeError, ValueError):
+            raise FeatureError(f"特徴量 '{column}' が数値ではありません: {row[column]!r}")
+        if not math.isfinite(value):
+            raise FeatureError(f"特徴量 '{column}' が有限の値ではありません: {row[column]!r}")
+        values.append(value)
+    return values
+
+
+def day_features(day_code: str) -> Dict[str, int]:
+    """曜日の one-hot エンコーディング"""
+    return {day: 1 if day == day_code else 0 for day in DAY_CODES}
+
+
+def build_features(day_code: str, public_holiday=0, public_holiday_previous_day=0, total_outpatient=500,
+                   intro_outpatient=20, ER=15, bed_count=280) -> Dict:
+    """モデル入力の特徴量 dict を学習データの列順で作る（値の型変換は呼び出し側で行う）"""
+    return {
+        **day_features(day_code),
+        'public_holiday': public_holiday,
+        'public_holiday_previous_day': public_holiday_previous_day,
+        'total_outpatient': total_outpatient,
+        'intro_outpatient': intro_outpatient,
+        'ER': ER,
+        'bed_count': bed_count
+    }
+
+
+class FallbackModel:
+    """
+    モデルファイルが無い・ロードできない場合の代替モデル
+
+    外来・救急・紹介患者数、祝日、週末の影響を線形に足し合わせた簡易推定。
+    FEATURE_COLUMNS 順の行列を受け取り、複数行をまとめて計算する。
+    """
+
+    def predict(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype=float)
+        col = _COLUMN_INDEX
+        pred = (
+            3.5
+            + (X[:, col['total_outpatient']] - 500) / 500 * 1.0    # 外来患者の影響
+            + (X[:, col['ER']] - 15) / 15 * 0.5                    # 救急患者の影響
+            + (X[:, col['intro_outpatient']] - 20) / 20 * 0.3      # 紹介患者の影響
+            - 0.5 * (X[:, col['public_holiday']] > 0)              # 祝日の影響
+            - np.where(X[:, col['sat']] > 0, 0.2, np.where(X[:, col['sun']] > 0, 0.3, 0.0))  # 曜日の影響
+        )
+        return np.maximum(0.5, pred)  # 最低値を0.5に制限
+
+
+def patch_estimators(model) -> None:
+    """古い scikit-learn で保存した決定木に monotonic_cst 属性を補う"""
+    for estimator in getattr(model, 'estimators_', []):
+        if not hasattr(estimator, 'monotonic_cst'):
+            estimator.monotonic_cst = None
+
+
+def n_estimators(model) -> int:
+    """木の数（scikit-learn のフォレストと配列形式の ForestPredictor の両方に対応）"""
+    return getattr(model, 'n_estimators', 0) if isinstance(model, ForestPredictor) else len(getattr(model, 'estimators_', []))
+
+
+def find_model_file(candidates: Iterable[str]) -> Optional[str]:
+    """候補パスのうち最初に存在するものを返す"""
+    for path in candidates:
+        if path and os.path.exists(path):
+            return os.path.abspath(path)
+    return None
+
+
+class InferenceEngine:
+    """モデル1つ分の推論窓口（ベクトル化推論・予測キャッシュ・マイクロバッチ）"""
+
+    def __init__(self, model, model_path: Optional[str] = None, name: str = 'randomforest',
+                 cache_size: Optional[int] = None):
+        """
+        Args:
+            model: predict を持つモデル（学習済みモデルまたは FallbackModel）
+            model_path (str): ロード元のファイル（代替モデルなら None）
+            name (str): メトリクスのラベル
+            cache_size (int): 予測キャッシュの最大件数（None なら PREDICTION_CACHE_SIZE）
+        """
+        self.model = model
+        self.model_path = model_path
+        self.name = name
+        self.is_fallback = isinstance(model, FallbackModel)
+        # 特徴量名付きで学習したモデルにはその列順の DataFrame を渡す
+        names = getattr(model, 'feature_names_in_', None)
+        self.input_columns = [str(c) for c in names] if names is not None else None
+
+        if cache_size is None:
+            cache_size = int(os.environ.get('PREDICTION_CACHE_SIZE', 4096))
+        self.cache_size = max(0, cache_size)
+        self._cache: "OrderedDict[tuple, float]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self.dispatcher: Optional[BatchDispatcher] = None
+        self.grid: Optional[PredictionGrid] = None
+        # 大量行用のモデル（.npz の書き出し元。初めて必要になった時にバックグラウンドでロードする）
+        self.large_batch_rows = 0
+        self.large_batch_model = None
+        self._large_batch_loader: Optional[threading.Thread] = None
+        self._large_batch_lock = threading.Lock()
+
+    # --- 推論 ---
+
+    def to_matrix(self, rows: Sequence[Dict]) -> np.ndarray:
+        """特徴量 dict のリストを FEATURE_COLUMNS 順の float 行列にする"""
+        return np.array([[row[c] for c in FEATURE_COLUMNS] for row in rows], dtype=float).reshape(-1, len(FEATURE_COLUMNS))
+
+    def predict_matrix(self, X: np.ndarray) -> np.ndarray:
+        """FEATURE_COLUMNS 順の行列を推論する（予測グリッドがあれば引き、残りを1回の model.predict で推論）"""
+        if len(X) == 0:
+            return np.empty(0)
+        if self.grid is None:
+            return self._predict_model(X)
+        predictions, hit = self.grid.lookup(X)
+        hits = int(hit.sum())
+        record_cache_rows('prediction_grid', hits, len(X) - hits)
+        if hits < len(X):
+            predictions[~hit] = self._predict_model(X[~hit])
+        return predictions
+
+    def _predict_model(self, X: np.ndarray) -> np.ndarray:
+        model_input = X
+        if self.input_columns is not None:
+            import pandas as pd
+            model_input = pd.DataFrame(X, columns=FEATURE_COLUMNS)[self.input_columns]
+        model = self.model
+        if self.large_batch_rows and len(X) >= self.large_batch_rows:
+            model = self._get_large_batch_model() or model
+        predictions = np.asarray(model.predict(model_input), dtype=float)
+        record_prediction_rows(self.name, len(X))
+        return predictions
+
+    def encode_rows(self, rows: Sequence[Dict]) -> Tuple[np.ndarray, np.ndarray, Dict[int, str]]:
+        """
+        複数行を検証しながら1つの行列にエンコードする
+
+        Returns:
+            (行列, 有効な行のマスク, 行番号 -> エラーメッセージ)
+            不正な行は行列上 0 で埋め、マスクを False にする
+        """
+        X = np.zeros((len(rows), len(FEATURE_COLUMNS)), dtype=float)
+        valid = np.ones(len(rows), dtype=bool)
+        errors: Dict[int, str] = {}
+        for i, row in enumerate(rows):
+            try:
+                X[i] = feature_values(row)
+            except FeatureError as e:
+                valid[i] = False
+                errors[i] = str(e)
+        return X, valid, errors
+
+    def iter_chunks(self, X: np.ndarray, chunk_size: Optional[int] = None,
+                    parallel: bool = True) -> Iterator[Tuple[int, int, Optional[np.ndarray], Optional[Exception]]]:
+        """
+        行列をチャンクに分けて推論し、(開始行, 終了行, 予測値, 例外) を行順に返す
+
+        PREDICT_PARALLEL_MIN_ROWS 未満なら1回で推論する。それ以上なら CPU 数程度に
+        分割し（上限 PREDICT_CHUNK_SIZE 行）、スレッドプールで並列に推論する。
+        失敗したチャンクは予測値 None と例外を返し、他のチャンクは続行する。
+        """
+        total = len(X)
+        if total == 0:
+            return
+        max_chunk = max(1, chunk_size or int(os.environ.get('PREDICT_CHUNK_SIZE', 5000)))
+        workers = parallel_workers() if parallel else 1
+        if workers > 1 and total >= int(os.environ.get('PREDICT_PARALLEL_MIN_ROWS', 2000)):
+            size = min(max_chunk, max(1, math.ceil(total / workers)))
+        else:
+            workers = 1
+            size = max_chunk
+        bounds = [(start, min(start + size, total)) for start in range(0, total, size)]
+
+        if workers == 1 or len(bounds) == 1:
+            for start, end in bounds:
+                try:
+                    yield start, end, self.predict_matrix(X[start:end]), None
+                except Exception as e:
+                    yield start, end, None, e
+            return
+
+        pool = _get_parallel_pool()
+        futures = [pool.submit(self.predict_matrix, X[start:end]) for start, end in bounds]
+        for (start, end), future in zip(bounds, futures):
+            try:
+                yield start, end, future.result(), None
+            except Exception as e:
+                yield start, end, None, e
+
+    def predict_many(self, rows: Sequence[Dict], chunk_size: Optional[int] = None) -> Tuple[List[Optional[float]], Dict[int, str]]:
+        """
+        大量の行を一括で予測する（キャッシュは使わない）
+
+        全行を検証して1つの行列にし、有効な行だけをチャンクに分けて推論する。
+        不正な行や失敗したチャンクは予測値 None とし、行番号ごとのエラーを返す。
+
+        Returns:
+            (予測値のリスト, 行番号 -> エラーメッセージ)
+        """
+        X, valid, errors = self.encode_rows(rows)
+        predictions: List[Optional[float]] = [None] * len(rows)
+        indices = np.flatnonzero(valid)
+        with stage('inference'):
+            for start, end, values, error in self.iter_chunks(X[indices], chunk_size):
+                chunk = indices[start:end].tolist()
+                if error is not None:
+                    for i in chunk:
+                        errors[i] = f"推論に失敗しました: {error}"
+                    continue
+                for i, value in zip(chunk, values.tolist()):
+                    predictions[i] = value
+        return predictions, errors
+
+    def predict_uncached(self, rows: Sequence[Dict]) -> List[float]:
+        return self.predict_matrix(self.to_matrix(rows)).tolist()
+
+    def predict_rows(self, rows: Sequence[Dict]) -> List[float]:
+        """
+        複数行を予測する
+
+        キャッシュに無い行だけをまとめて1回で推論する。
+        """
+        keys = [self._key(row) for row in rows]
+        results: List[Optional[float]] = [self._cache_get(key) for key in keys]
+        missing = [i for i, value in enumerate(results) if value is None]
+        if missing:
+            with stage('inference'):
+                values = self.predict_matrix(self.to_matrix([rows[i] for i in missing]))
+            for i, value in zip(missing, values):
+                results[i] = float(value)
+                self._cache_put(keys[i], float(value))
+        return results
+
+    def predict_one(self, features: Dict) -> float:
+        """1行を予測する（マイクロバッチが有効ならディスパッチャ経由）"""
+        if self.dispatcher is None:
+            return self.predict_rows([features])[0]
+        key = self._key(features)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        with stage('inference'):
+            value = self.dispatcher.predict(features)
+        self._cache_put(key, value)
+        return value
+
+    def attach_grid(self, grid: PredictionGrid) -> None:
+        """予測グリッドを使うようにする（同じモデルから作ったものであることは呼び出し側で確認する）"""
+        self.grid = grid
+
+    def enable_large_batch_model(self, min_rows: int) -> None:
+        """min_rows 行以上の推論を書き出し元の joblib モデルで行う（export_forest.py で書き出したままの .npz のみ）"""
+        if not isinstance(self.model, ForestPredictor) or self.model_path is None:
+            return
+        # 圧縮したものや生徒モデルは書き出し元と予測値が違うため対象外
+        meta = self.model.meta
+        if meta.get('source_sha256') and 'compression' not in meta:
+            self.large_batch_rows = max(0, min_rows)
+
+    def _get_large_batch_model(self):
+        # ロードが終わるまで（失敗したら以後も）None を返し、呼び出し側は NumPy で推論する
+        if self.large_batch_model is not None:
+            return self.large_batch_model
+        with self._large_batch_lock:
+            if self._large_batch_loader is None:
+                self._large_batch_loader = threading.Thread(
+                    target=self._load_large_batch_model, name='large-batch-model-loader', daemon=True
+                )
+                self._large_batch_loader.start()
+        return None
+
+    def _load_large_batch_model(self) -> None:
+        model = load_source_model(self.model, self.model_path)
+        if model is None:
+            self.large_batch_rows = 0
+        else:
+            self.large_batch_model = model
+
+    def enable_batching(self, max_batch_size: int = 32, max_wait_ms: float = 2.0) -> BatchDispatcher:
+        """同時に届いた単日予測を1回の推論にまとめるディスパッチャを有効化する"""
+        if self.dispatcher is None:
+            self.dispatcher = BatchDispatcher(self.predict_uncached, max_batch_size, max_wait_ms)
+            register_queue('predict_batch', self.dispatcher.queue_depth)
+        return self.dispatcher
+
+    # --- キャッシュ ---
+
+    @staticmethod
+    def _key(row: Dict) -> tuple:
+        return tuple(float(row[c]) for c in FEATURE_COLUMNS)
+
+    def _cache_get(self, key: tuple) -> Optional[float]:
+        if not self.cache_size:
+            return None
+        with self._cache_lock:
+            value = self._cache.get(key)
+            if value is None:
+                self._cache_misses += 1
+            else:
+                self._cache.move_to_end(key)
+                self._cache_hits += 1
+        record_cache('prediction', value is not None)
+        return value
+
+    def _cache_put(self, key: tuple, value: float) -> None:
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear_cache(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict:
+        """モデルとキャッシュ・マイクロバッチの状態"""
+        with self._cache_lock:
+            cache = {
+                'size': len(self._cache),
+                'max_size': self.cache_size,
+                'hits': self._cache_hits,
+                'misses': self._cache_misses
+            }
+        return {
+            'model': type(self.model).__name__,
+            'model_path': self.model_path,
+            'fallback': self.is_fallback,
+            'n_estimators': n_estimators(self.model) or None,
+            'cache': cache,
+            'batching': self.dispatcher.stats() if self.dispatcher is not None else None,
+            'grid': self.grid.stats() if self.grid is not None else None,
+            'large_batch': {
+                'min_rows': self.large_batch_rows,
+                'model': type(self.large_batch_model).__name__ if self.large_batch_model is not None else None
+            } if isinstance(self.model, ForestPredictor) else None
+        }
+
+
+def attach_configured_grid(engine: InferenceEngine) -> Optional[PredictionGrid]:
+    """PREDICTION_GRID_PATH の予測グリッドが engine のモデルから作ったものなら使うようにする"""
+    path = os.environ.get('PREDICTION_GRID_PATH')
+    if not path or engine.model_path is None:
+        return None
+    try:
+        grid = PredictionGrid.load(path, os.environ.get('PREDICTION_GRID_MODE', 'exact'))
+        if grid.meta.get('model_sha256') != file_sha256(engine.model_path):
+            print(f"警告: 予測グリッド {path} は別のモデルから作られているため使用しません")
+            return None
+    except Exception as e:
+        print(f"予測グリッドのロードに失敗しました: {e}")
+        return None
+    engine.attach_grid(grid)
+    print(f"予測グリッドを使用します: {path}（{grid.table.size} 点、{grid.mode}）")
+    return grid
+
+
+def load_source_model(predictor: ForestPredictor, artifact_path: str):
+    """
+    .npz の書き出し元の joblib モデルをロードする（大量行の推論用）
+
+    NumPy で木を辿る推論は1回の呼び出しが軽い代わりに行数に比例して遅くなり、
+    約 1000 行を超えると scikit-learn（Cython）の方が速い。書き出し元のファイルが
+    sha256 で一致し、試し予測がアーティファクトと同じ値の場合だけ返す（それ以外は None）。
+    """
+    source = predictor.meta.get('source')
+    path = os.environ.get('FOREST_SOURCE_MODEL_PATH')
+    if not path and source:
+        directory = os.path.dirname(artifact_path)
+        path = find_model_file([os.path.join(directory, source), os.path.join(directory, '..', source)])
+    if not path or not os.path.exists(path):
+        print(f"大量行用の書き出し元モデルが見つからないため、NumPy で推論します: {source}")
+        return None
+    try:
+        if file_sha256(path) != predictor.meta.get('source_sha256'):
+            print(f"警告: {path} はアーティファクトの書き出し元と異なるため、大量行にも使用しません")
+            return None
+        import joblib
+        model = joblib.load(path)
+        patch_estimators(model)
+        X = np.array([[SAMPLE_FEATURES[c] for c in FEATURE_COLUMNS]], dtype=float)
+        if n_estimators(model) != predictor.n_estimators or not np.array_equal(model.predict(X), predictor.predict(X)):
+            print(f"警告: {path} の予測値がアーティファクトと一致しないため、大量行にも使用しません")
+            return None
+    except Exception as e:
+        print(f"大量行用の書き出し元モデルのロードに失敗しました: {e}")
+        return None
+    print(f"大量行の推論に書き出し元モデルを使用します: {path}")
+    return model
+
+
+def load_engine(candidates: Iterable[str], name: str = 'randomforest', fallback: bool = True) -> Optional[InferenceEngine]:
+    """
+    候補パスからモデルをロードして InferenceEngine を返す
+
+    .npz（export_forest.py で書き出した配列形式）は scikit-learn なしで ForestPredictor として、
+    それ以外は joblib でロードして monotonic_cst を補正する。ロード後に標準的な入力で試し予測をする。
+    ファイルが無い・ロードや試し予測に失敗した場合は、fallback=True なら代替モデル、
+    False なら None を返す。
+
+    Args:
+        candidates (list): モデルファイルの候補パス（先頭から順に探す）
+        name (str): メトリクスのラベル
+        fallback (bool): 失敗時に代替モデルを使うか
+    """
+    candidates = list(candidates)
+    model_path = find_model_file(candidates)
+    if model_path is None:
+        print(f"警告: どのパスにもモデルファイルが見つかりません: {candidates}")
+    else:
+        print(f"ローカルファイルからモデルをロード中: {model_path}")
+        try:
+            if is_artifact(model_path):
+                model = ForestPredictor.load(model_path)
+            else:
+                import joblib
+                model = joblib.load(model_path)
+                patch_estimators(model)
+            engine = InferenceEngine(model, model_path, name)
+            test_pred = engine.predict_uncached([SAMPLE_FEATURES])[0]
+            print(f"モデルを正常にロードしました: {type(model).__name__}"
+                  f"（推定器の数: {n_estimators(model)}、テスト予測値: {test_pred:.3f}）")
+            attach_configured_grid(engine)
+            engine.enable_large_batch_model(int(os.environ.get('FOREST_LARGE_BATCH_ROWS', 1000)))
+            return engine
+        except Exception as e:
+            print(f"モデルのロード中にエラーが発生しました: {e}")
+
+    if not fallback:
+        return None
+    print("代替のカスタムモデルを使用します。")
+    return InferenceEngine(FallbackModel(), None, name)
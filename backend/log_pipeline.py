@@ -0,0 +1,144 @@
+"""
+ノンブロッキングな構造化ログ
+
+リクエストスレッドはログレコードをキューに積むだけ（QueueHandler）にして、
+ファイル書き込み・ローテーション・コンソール出力はプロセスごとに1つの
+QueueListener スレッドで行う。ファイルには1行1JSONの構造化レコードを書く。
+
+gunicorn の複数ワーカーが同じ logs/app.log をローテーションし合わないよう、
+既定ではワーカー（プロセス）ごとに別ファイル（app.<pid>.log）に書く。
+
+環境変数:
+    LOG_PER_WORKER        0 で全プロセス共通の1ファイルに書く（既定: 1）
+    LOG_BODY_MAX_CHARS    リクエストボディのログに残す最大文字数（既定: 500）
+    LOG_BODY_SAMPLE_RATE  ボディをログに残すリクエストの割合 0.0-1.0（既定: 1.0）
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+# LogRecord の標準属性（これ以外は extra として JSON に含める）
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[QueueListener] = None
+_listener_pid: Optional[int] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコード1行の JSON に整形する"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                payload[key] = value
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def _log_file_path(log_dir: str, file_name: str) -> str:
+    if os.environ.get('LOG_PER_WORKER', '1') == '1':
+        base, ext = os.path.splitext(file_name)
+        file_name = f"{base}.{os.getpid()}{ext}"
+    return os.path.join(log_dir, file_name)
+
+
+def setup_logging(flask_app, log_dir: str, file_name: str = 'app.log') -> None:
+    """
+    ルートロガーに QueueHandler を設定し、ファイル・コンソール出力をリスナースレッドに任せる
+
+    Args:
+        flask_app (Flask): 対象の Flask アプリ
+        log_dir (str): ログディレクトリ
+        file_name (str): ログファイル名
+    """
+    try:
+        root_logger = logging.getLogger()
+        root_logger.setLevel(logging.INFO)
+
+        # 同一プロセスで再設定された場合（リロード等）は既存のリスナーをそのまま使う
+        if _listener is None or _listener_pid != os.getpid():
+            _start_listener(root_logger, log_dir, file_name)
+
+        # Flask のロガーはルートへ伝播させるだけにする（二重出力を防ぐ）
+        flask_app.logger.handlers = []
+        flask_app.logger.propagate = True
+        flask_app.logger.setLevel(logging.INFO)
+        flask_app.logger.info('Logging initialized')
+    except Exception as log_err:
+        # As a last resort, print to stdout; do not raise
+        print(f"Failed to setup logging: {log_err}")
+
+
+def _start_listener(root_logger: logging.Logger, log_dir: str, file_name: str) -> None:
+    global _listener, _listener_pid
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = RotatingFileHandler(
+        _log_file_path(log_dir, file_name), maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    file_handler.setLevel(logging.INFO)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
+    console_handler.setLevel(logging.INFO)
+
+    log_queue: "queue.Queue" = queue.Queue(-1)
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, (QueueHandler, RotatingFileHandler, logging.StreamHandler)):
+            root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """キューに残ったレコードを書き出してリスナーを停止する"""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        try:
+            _listener.stop()
+        except Exception:
+            pass
+        for handler in _listener.handlers:
+            try:
+                handler.flush()
+            except Exception:
+                pass
+        _listener = None
+
+
+def request_body_preview(request) -> Optional[str]:
+    """
+    ログ用のリクエストボディを取得する
+
+    シリアライズ前に生のボディを最大文字数で切り詰め、サンプリング対象外なら None を返す。
+    """
+    if not request.is_json:
+        return ''
+    sample_rate = float(os.environ.get('LOG_BODY_SAMPLE_RATE', 1.0))
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return None
+    max_chars = int(os.environ.get('LOG_BODY_MAX_CHARS', 500))
+    raw = request.get_data(cache=True)[:max_chars * 4]
+    preview = raw.decode('utf-8', errors='replace')
+    if len(preview) > max_chars or request.content_length and request.content_length > len(raw):
+        preview = preview[:max_chars] + '...'
+    return preview
@@ -0,0 +1,210 @@
+"""
+メトリクス（Prometheus テキスト形式）
+
+- ルートごとのレイテンシヒストグラム
+- 処理段階ごとの時間（特徴量作成・祝日判定・推論・シリアライズ・Supabaseログ）
+- キャッシュのヒット/ミス、キュー深さ、モデルバージョン
+- Supabase 呼び出しの操作ごとのレイテンシ（成功・失敗・リトライ・ブレーカーによる遮断）
+
+gunicorn の複数ワーカーで正しく集計するため、環境変数 PROMETHEUS_MULTIPROC_DIR が
+設定されていれば prometheus_client のマルチプロセスモードで集計する
+（gunicorn.conf.py が起動時に設定する）。
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict
+
+from flask import Flask, Response, g, has_request_context, request
+
+# prometheus_client（任意）
+try:
+    from prometheus_client import (  # type: ignore
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    )
+    from prometheus_client import multiprocess  # type: ignore
+    HAS_PROMETHEUS = True
+except Exception:
+    HAS_PROMETHEUS = False
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# キュー深さを返すコールバック（名前 -> 関数）
+_queue_sources: Dict[str, Callable[[], int]] = {}
+
+if HAS_PROMETHEUS:
+    REQUEST_LATENCY = Histogram(
+        'http_request_duration_seconds', 'HTTP request latency by route',
+        ['route', 'method', 'status'], buckets=LATENCY_BUCKETS
+    )
+    STAGE_LATENCY = Histogram(
+        'forecast_stage_duration_seconds', 'Time spent per processing stage within a request',
+        ['route', 'stage'], buckets=LATENCY_BUCKETS
+    )
+    CACHE_REQUESTS = Counter(
+        'cache_requests_total', 'Cache lookups by cache and result',
+        ['cache', 'result']
+    )
+    PREDICTION_ROWS = Counter(
+        'model_prediction_rows_total', 'Rows passed to model.predict',
+        ['model']
+    )
+    BATCH_SIZE = Histogram(
+        'predict_batch_size', 'Rows per micro-batch inference call', buckets=BATCH_SIZE_BUCKETS
+    )
+    QUEUE_DEPTH = Gauge(
+        'queue_depth', 'Items waiting in internal queues',
+        ['queue'], multiprocess_mode='livesum'
+    )
+    SUPABASE_CALLS = Histogram(
+        'supabase_call_duration_seconds', 'Supabase call latency by operation and result',
+        ['operation', 'result'], buckets=LATENCY_BUCKETS
+    )
+    MODEL_INFO = Gauge(
+        'model_info', 'Loaded model version',
+        ['version'], multiprocess_mode='max'
+    )
+
+
+def enabled() -> bool:
+    return HAS_PROMETHEUS and os.environ.get('METRICS_DISABLED', '0') != '1'
+
+
+def _route() -> str:
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'background'
+
+
+@contextmanager
+def stage(name: str):
+    """
+    処理段階の時間を計測するコンテキストマネージャ
+
+    リクエスト中は段階ごとに時間を合算し、レスポンス時に1回だけ記録する
+    （月間予測のように日ごとのループ内で何度も呼ばれても1リクエスト1サンプルになる）。
+    段階の中で別の段階を計測した場合（feature_build 中の holiday_lookup など）、内側の時間は
+    外側から差し引くため、段階ごとの時間は重ならず、合計がリクエストの時間を超えない。
+    """
+    start = time.perf_counter()
+    nested = enabled() and has_request_context()
+    if nested:
+        # 内側の段階の時間の合計（外側から差し引く）
+        stack = g.setdefault('_stage_stack', [])
+        stack.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if nested:
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            totals = g.setdefault('_stage_totals', {})
+            totals[name] = totals.get(name, 0.0) + elapsed - inner
+        elif enabled():
+            STAGE_LATENCY.labels(route='background', stage=name).observe(elapsed)
+
+
+def timed(name: str):
+    """関数呼び出しを stage(name) として計測するデコレータ"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    if enabled():
+        CACHE_REQUESTS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def record_supabase_call(operation: str, result: str, seconds: float) -> None:
+    """Supabase 呼び出しの所要時間を記録する（result: ok / error / retry / open）"""
+    if enabled():
+        SUPABASE_CALLS.labels(operation=operation, result=result).observe(seconds)
+
+
+def record_cache_rows(cache: str, hits: int, misses: int) -> None:
+    """行単位で引くキャッシュ（予測グリッドなど）のヒット・ミス件数をまとめて記録する"""
+    if enabled():
+        if hits:
+            CACHE_REQUESTS.labels(cache=cache, result='hit').inc(hits)
+        if misses:
+            CACHE_REQUESTS.labels(cache=cache, result='miss').inc(misses)
+
+
+def record_prediction_rows(model: str, rows: int) -> None:
+    if enabled():
+        PREDICTION_ROWS.labels(model=model).inc(rows)
+
+
+def record_batch_size(size: int) -> None:
+    if enabled():
+        BATCH_SIZE.observe(size)
+
+
+def register_queue(name: str, depth_func: Callable[[], int]) -> None:
+    """キュー深さの取得関数を登録する（リクエスト終了時とスクレイプ時に更新）"""
+    _queue_sources[name] = depth_func
+
+
+def set_model_version(version: str) -> None:
+    if enabled():
+        MODEL_INFO.labels(version=version).set(1)
+
+
+def _refresh_queues() -> None:
+    for name, depth_func in _queue_sources.items():
+        try:
+            QUEUE_DEPTH.labels(queue=name).set(depth_func())
+        except Exception:
+            pass
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+
+
+def _after_request(response):
+    if not enabled():
+        return response
+    try:
+        route = _route()
+        if route == '/metrics':
+            return response
+        elapsed = time.perf_counter() - getattr(g, '_metrics_start', time.perf_counter())
+        REQUEST_LATENCY.labels(route=route, method=request.method, status=str(response.status_code)).observe(elapsed)
+        for name, total in g.get('_stage_totals', {}).items():
+            STAGE_LATENCY.labels(route=route, stage=name).observe(total)
+        _refresh_queues()
+    except Exception:
+        pass
+    return response
+
+
+def metrics_endpoint():
+    """Prometheus のスクレイプ用エンドポイント"""
+    if not enabled():
+        return Response('metrics disabled\n', status=503, mimetype='text/plain')
+    _refresh_queues()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        data = generate_latest(registry)
+    else:
+        data = generate_latest()
+    return Response(data, mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(flask_app: Flask) -> None:
+    """Flask アプリにメトリクス計測フックと /metrics を登録する"""
+    flask_app.before_request(_before_request)
+    flask_app.after_request(_after_request)
+    flask_app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
@@ -1,8 +1,4 @@
-import joblib
-import pandas as pd
-import numpy as np
-from datetime import datetime
-import os
+from inference import build_features, load_engine
 
 class ModelService:
     def __init__(self, model_path='models/fixed_rf_model.joblib'):
@@ -10,51 +6,57 @@ class ModelService:
         モデルサービスを初期化
         """
         self.model_path = model_path
-        self.model = self.load_model()
+        self.engine = self.load_model()
+        self.model = self.engine.model
     
     def load_model(self):
         """
-        モデルをロードする
+        モデルをロードする（失敗時は推論コアの代替モデル）
         """
-        try:
-            model = joblib.load(self.model_path)
-            print(f"モデルを正常にロードしました: {self.model_path}")
-            
-            # モデルの修正（必要な場合）
-            for estimator in model.estimators_:
-                if not hasattr(estimator, 'monotonic_cst'):
-                    estimator.monotonic_cst = None
-            
-            return model
-        except Exception as e:
-            print(f"モデルのロードに失敗しました: {e}")
-            # ダミーモデルを返す
-            class DummyModel:
-                def predict(self, X):
-                    return np.zeros(len(X))
-            return DummyModel()
+        return load_engine([self.model_path])
     
     def predict(self, features):
         """
         単一のデータセットに対する予測を行う
         """
         try:
-            df = pd.DataFrame([features])
-            prediction = self.model.predict(df)
-            return float(prediction[0])
+            return self.engine.predict_one(features)
         except Exception as e:
             print(f"予測に失敗しました: {e}")
             return 0.0
     
-    def predict_batch(self, features_list):
+    def predict_batch(self, features_list, chunk_size=None):
         """
         複数のデータセットに対する予測を行う
+
+        全行を1つの行列にまとめ、chunk_size 行ずつ（既定: PREDICT_CHUNK_SIZE）推論する。
+        不正な行の予測値は predict と同じく 0.0（行ごとのエラーは predict_batch_report）。
+
+        Returns:
+            list: 入力順の予測値
+        """
+        predictions, errors = self.engine.predict_many(features_list, chunk_size)
+        for i in sorted(errors):
+            print(f"予測に失敗しました（{i}行目）: {errors[i]}")
+        return [0.0 if p is None else p for p in predictions]
+
+    def predict_batch_report(self, features_list, chunk_size=None):
         """
-        predictions = []
-        for features in features_list:
-            prediction = self.predict(features)
-            predictions.append(prediction)
-        return predictions
+        predict_batch と同じ推論をし、行ごとのエラーも返す
+
+        不正な行があってもバッチ全体は失敗させず、その行の予測値を None にしてエラーを返す。
+
+        Returns:
+            dict: predictions（入力順の予測値、失敗した行は None）、
+                  errors（[{"index": 行番号, "error": メッセージ}]）、count、failed
+        """
+        predictions, errors = self.engine.predict_many(features_list, chunk_size)
+        return {
+            "predictions": predictions,
+            "errors": [{"index": i, "error": errors[i]} for i in sorted(errors)],
+            "count": len(predictions),
+            "failed": len(errors)
+        }
     
     def get_default_scenarios(self):
         """
@@ -118,20 +120,13 @@ class ModelService:
         """
         シナリオからモデル用の特徴量を作成
         """
-        # 曜日の1-hotエンコーディング
-        days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
-        day_of_week = scenario.get('day_of_week', 'mon')
-        day_features = {day: 1 if day == day_of_week else 0 for day in days}
-        
-        # 特徴量の作成
-        features = {
-            **day_features,
-            'public_holiday': int(scenario.get('public_holiday', False)),
-            'public_holiday_previous_day': int(scenario.get('public_holiday_previous_day', False)),
-            'total_outpatient': int(scenario.get('total_outpatient', 500)),
-            'intro_outpatient': int(scenario.get('intro_outpatient', 20)),
-            'ER': int(scenario.get('er', 15)),
-            'bed_count': int(scenario.get('bed_count', 280))
-        }
-        
-        return features 
\ No newline at end of file
+        # 曜日の1-hotエンコーディングと特徴量の作成
+        return build_features(
+            scenario.get('day_of_week', 'mon'),
+            public_holiday=int(scenario.get('public_holiday', False)),
+            public_holiday_previous_day=int(scenario.get('public_holiday_previous_day', False)),
+            total_outpatient=int(scenario.get('total_outpatient', 500)),
+            intro_outpatient=int(scenario.get('intro_outpatient', 20)),
+            ER=int(scenario.get('er', 15)),
+            bed_count=int(scenario.get('bed_count', 280))
+        ) 
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+事前計算した予測グリッド（NumPy のみ）
+
+モデルの入力は曜日の one-hot・祝日フラグ2つと、範囲の限られた4つの整数
+（total_outpatient・intro_outpatient・ER・bed_count）だけなので、整数をステップで
+量子化した格子点の予測値を build_prediction_grid.py で全て計算しておき、推論を配列の
+添字引きに置き換える。レイテンシは木の数や深さに依存しない。
+
+ファイル:
+    <path>.npy   予測値の配列。形状は (28, n_total, n_intro, n_er, n_bed)。
+                 先頭の軸は 曜日 * 4 + 祝日 * 2 + 前日祝日。np.load の mmap_mode='r' で開くため、
+                 同じサーバーのワーカー間でページキャッシュを共有する
+    <path>.json  各軸の (開始, 終了, ステップ)、作成元モデルの sha256 など
+
+格子の外（範囲外・格子点でない値・one-hot でない曜日）の行は引けないため、呼び出し側で
+ライブモデルにフォールバックする。
+"""
+
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+GRID_VERSION = 1
+DAY_COLUMNS = 7
+FLAG_COMBINATIONS = DAY_COLUMNS * 4
+# 量子化する整数の特徴量（FEATURE_COLUMNS の列番号と既定の軸）
+COUNT_COLUMNS = ['total_outpatient', 'intro_outpatient', 'ER', 'bed_count']
+COUNT_INDEX = {'total_outpatient': 9, 'intro_outpatient': 10, 'ER': 11, 'bed_count': 12}
+DEFAULT_AXES = {
+    'total_outpatient': (0, 1200, 10),
+    'intro_outpatient': (0, 60, 2),
+    'ER': (0, 60, 2),
+    'bed_count': (200, 340, 20)
+}
+PUBLIC_HOLIDAY = 7
+PUBLIC_HOLIDAY_PREVIOUS_DAY = 8
+LOOKUP_MODES = ('exact', 'nearest')
+
+
+def axis_values(start: float, stop: float, step: float) -> np.ndarray:
+    """軸の格子点（stop を含む）"""
+    return start + step * np.arange(int(round((stop - start) / step)) + 1)
+
+
+def meta_path(path: str) -> str:
+    return path[:-len('.npy')] + '.json' if path.endswith('.npy') else path + '.json'
+
+
+def flag_features(flag: int) -> List[float]:
+    """先頭の軸の番号から、曜日 one-hot と祝日フラグ2つ（FEATURE_COLUMNS の先頭9列）を作る"""
+    day, holiday, previous = flag // 4, (flag // 2) % 2, flag % 2
+    return [1.0 if i == day else 0.0 for i in range(DAY_COLUMNS)] + [float(holiday), float(previous)]
+
+
+class PredictionGrid:
+    """メモリマップした予測グリッド"""
+
+    def __init__(self, table: np.ndarray, meta: Dict, path: Optional[str] = None, mode: str = 'exact'):
+        """
+        Args:
+            table: 予測値の配列（メモリマップ可）
+            meta: 軸やモデルの情報
+            path: 読み込んだファイル
+            mode: exact（格子点ちょうどの値だけ引く）/ nearest（範囲内なら最も近い格子点に丸める）
+        """
+        if mode not in LOOKUP_MODES:
+            raise ValueError(f"不明な参照方法です: {mode}（{', '.join(LOOKUP_MODES)}）")
+        self.table = table
+        self.meta = meta
+        self.path = path
+        self.mode = mode
+        self.axes: List[Tuple[float, float, float]] = [tuple(meta['axes'][c]) for c in COUNT_COLUMNS]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path: str, mode: str = 'exact') -> 'PredictionGrid':
+        with open(meta_path(path), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('grid_version') != GRID_VERSION:
+            raise ValueError(f"未対応の予測グリッド形式です: {meta.get('grid_version')}")
+        table = np.load(path, mmap_mode='r')
+        expected = (FLAG_COMBINATIONS,) + tuple(len(axis_values(*axis)) for axis in (meta['axes'][c] for c in COUNT_COLUMNS))
+        if table.shape != expected:
+            raise ValueError(f"予測グリッドの形状が軸の定義と一致しません: {table.shape} != {expected}")
+        return cls(table, meta, path, mode)
+
+    def lookup(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        FEATURE_COLUMNS 順の行列の予測値を引く
+
+        Returns:
+            (予測値, 引けた行のマスク)。引けなかった行の予測値は NaN
+        """
+        X = np.asarray(X, dtype=float)
+        days = X[:, :DAY_COLUMNS]
+        flags = X[:, [PUBLIC_HOLIDAY, PUBLIC_HOLIDAY_PREVIOUS_DAY]]
+        hit = (np.isin(days, (0.0, 1.0)).all(axis=1) & (days.sum(axis=1) == 1)
+               & np.isin(flags, (0.0, 1.0)).all(axis=1))
+        index = [days.argmax(axis=1) * 4 + flags[:, 0].astype(int) * 2 + flags[:, 1].astype(int)]
+        for column, (start, stop, step) in zip(COUNT_COLUMNS, self.axes):
+            values = X[:, COUNT_INDEX[column]]
+            position = (values - start) / step
+            rounded = np.rint(position)
+            hit &= (values >= start) & (values <= stop)
+            if self.mode == 'exact':
+                hit &= np.abs(position - rounded) < 1e-9
+            index.append(np.clip(rounded, 0, None).astype(np.int64))
+
+        predictions = np.full(len(X), np.nan)
+        if hit.any():
+            predictions[hit] = self.table[tuple(i[hit] for i in index)]
+        hits = int(hit.sum())
+        with self._lock:
+            self.hits += hits
+            self.misses += len(X) - hits
+        return predictions, hit
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            'path': self.path,
+            'mode': self.mode,
+            'shape': list(self.table.shape),
+            'cells': int(self.table.size),
+            'axes': {c: list(axis) for c, axis in zip(COUNT_COLUMNS, self.axes)},
+            'model_sha256': self.meta.get('model_sha256'),
+            'hits': hits,
+            'misses': misses
+        }
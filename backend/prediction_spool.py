@@ -0,0 +1,504 @@
+"""
+予測ログのローカルスプール（write-behind）
+
+log_prediction はレコードをローカルの追記専用ファイル（1行1JSON）に書くだけで返り、
+バックグラウンドのリプレイヤーが未送信の行をまとめてデータベースに一括挿入する。
+リクエストの経路にネットワークへの書き込みが入らず、データベースが落ちている間の
+レコードもファイルに残って、復旧後に送られる。
+
+- 書き込みは O_APPEND の write 1回。fsync は専用スレッドが SPOOL_FSYNC_MS ごとにまとめて行う
+  （プロセスが落ちても書いた行は残る。マシンごと落ちた場合に失うのは最後の間隔分だけ）
+- 各レコードには idempotency_key を付け、送信側は受け取り済みのキーの行を無視する
+  （送信後・送信済み位置の保存前に落ちて同じ行を再送しても重複しない）
+- 送信済みの位置はセグメントごとの .offset に保存し、再起動後はそこから再開する
+- 不正な行（validate が理由を返す行）は追記せず、送信先がデータの誤り（SQLSTATE 22xxx / 23xxx）で
+  拒否したバッチは二分して送り直し、拒否された行だけを dead_letter/ に移す（1行のせいでスプール全体が
+  止まらない）。データの誤りはサーキットブレーカーの失敗に数えない
+
+ファイル（SPOOL_DIR/<送信先>/ 以下。送信先は supabase / postgres）:
+    <pid>-<seq>.ndjson   セグメント。SPOOL_SEGMENT_BYTES を超えると次のセグメントに切り替える
+    <pid>-<seq>.offset   送信済みのバイト位置
+    dead_letter/<pid>.ndjson  拒否された行（{"record", "error", "failed_at"}、自動では再送しない）
+
+gunicorn のワーカーはそれぞれ自分の pid のセグメントに書き、自分のセグメントを送る。
+終了したプロセスのセグメントは、生きているワーカーが rename で引き取って送る。
+
+環境変数:
+    SPOOL_DIR             スプールのディレクトリ（空文字で無効、既定: backend/logs/spool）
+    SPOOL_FSYNC_MS        fsync をまとめる間隔（既定: 50）
+    SPOOL_BATCH_SIZE      1回の一括挿入の最大行数（既定: 500）
+    SPOOL_SEGMENT_BYTES   セグメントを切り替えるサイズ（既定: 4 MiB）
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from inference import DAY_CODES
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.ndjson'
+OFFSET_SUFFIX = '.offset'
+DEAD_LETTER_DIR = 'dead_letter'
+# 1回に読むセグメントの最大バイト数
+READ_CHUNK_BYTES = 1 << 20
+# 行の値が原因の失敗（data_exception / integrity_constraint_violation）。再送しても成功しない
+DATA_ERROR_CLASSES = ('22', '23')
+# prediction_logs の整数列
+INTEGER_COLUMNS = ('total_outpatient', 'intro_outpatient', 'er_patients', 'bed_count', 'hit_count')
+
+
+def is_data_error(error: Exception) -> bool:
+    """行の値が原因でデータベースが拒否したエラーか（psycopg2 の pgcode / PostgREST の code）"""
+    code = getattr(error, 'pgcode', None) or getattr(error, 'code', None)
+    return isinstance(code, str) and code[:2] in DATA_ERROR_CLASSES
+
+
+def prediction_fingerprint(model_version: Optional[str], date: Optional[str], features: Dict) -> str:
+    """モデルのバージョン・予測日・特徴量の指紋（同じ入力の予測ログを1行にまとめるキー）"""
+    payload = json.dumps([model_version, date, features], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def day_code(prediction_date, day=None) -> Optional[str]:
+    """予測日の曜日コード（月間予測の day は日にちなので、日付から求める）"""
+    if isinstance(day, str) and day in DAY_CODES:
+        return day
+    try:
+        return DAY_CODES[date.fromisoformat(str(prediction_date)).weekday()]
+    except ValueError:
+        return None
+
+
+def _integer(value):
+    """整数値の float（500.0 など）を int にする（INTEGER 列は "500.0" を受け付けない）"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _reject_constant(name: str):
+    raise ValueError(f"{name} は JSONB に入りません")
+
+
+def validate_log_row(row: Dict) -> Optional[str]:
+    """prediction_logs に入らない行なら理由を返す（問題なければ None）"""
+    try:
+        date.fromisoformat(str(row.get('prediction_date')))
+    except ValueError:
+        return f"prediction_date が日付ではありません: {row.get('prediction_date')!r}"
+    value = row.get('predicted_value')
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return f"predicted_value が数値ではありません: {value!r}"
+    for column in INTEGER_COLUMNS:
+        value = row.get(column)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+            return f"{column} が整数ではありません: {value!r}"
+    if not row.get('fingerprint'):
+        return "fingerprint がありません"
+    features = row.get('features')
+    try:
+        json.loads(features if isinstance(features, str) else json.dumps(features), parse_constant=_reject_constant)
+    except (TypeError, ValueError) as e:
+        return f"features が JSON ではありません: {e}"
+    return None
+
+
+def valid_log_rows(rows: List[Dict]) -> List[Dict]:
+    """prediction_logs に入る行だけを返す（スプールを使わずに直接書くときに、1行のせいで全体が失敗しないように）"""
+    valid = []
+    for row in rows:
+        error = validate_log_row(row)
+        if error is None:
+            valid.append(row)
+        else:
+            logger.error(f"Dropping invalid prediction log row: {error}")
+    return valid
+
+
+def prediction_log_row(prediction_data: Dict, model_version: Optional[str] = None) -> Dict:
+    """予測データを prediction_logs の1行にする（スプールのレコード形式）"""
+    features = prediction_data.get('features', {})
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        'prediction_date': prediction_data.get('date'),
+        'predicted_value': prediction_data.get('prediction'),
+        'total_outpatient': _integer(features.get('total_outpatient')),
+        'intro_outpatient': _integer(features.get('intro_outpatient')),
+        'er_patients': _integer(features.get('ER')),
+        'bed_count': _integer(features.get('bed_count')),
+        'public_holiday': features.get('public_holiday', False),
+        'day_of_week': day_code(prediction_data.get('date'), prediction_data.get('day')),
+        'features': json.dumps(features),
+        'model_version': model_version,
+        'fingerprint': prediction_fingerprint(model_version, prediction_data.get('date'), features),
+        'hit_count': 1,
+        'created_at': now,
+        'last_seen_at': now
+    }
+
+
+def merge_duplicates(rows: List[Dict]) -> List[Dict]:
+    """同じ指紋の行を1行にまとめる（hit_count を合計し、last_seen_at は最新）"""
+    merged: Dict[str, Dict] = {}
+    for row in rows:
+        current = merged.get(row['fingerprint'])
+        if current is None:
+            merged[row['fingerprint']] = dict(row)
+            continue
+        current['hit_count'] += row.get('hit_count', 1)
+        current['last_seen_at'] = max(current['last_seen_at'], row['last_seen_at'])
+    return list(merged.values())
+
+
+def _segment_id(path: str) -> Tuple[int, int]:
+    pid, _, seq = os.path.basename(path)[:-len(SEGMENT_SUFFIX)].partition('-')
+    return int(pid), int(seq)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class PredictionSpool:
+    """追記専用ファイルに書き、バックグラウンドでデータベースに送るスプール"""
+
+    def __init__(self, directory: str, sink: Callable[[List[Dict]], None], batch_size: int = 500,
+                 fsync_ms: float = 50.0, segment_bytes: int = 4 << 20, max_backoff: float = 30.0,
+                 validate: Optional[Callable[[Dict], Optional[str]]] = None):
+        """
+        Args:
+            directory (str): スプールのディレクトリ
+            sink: レコードのリストを一括挿入する関数（失敗時は例外。idempotency_key が同じ行は無視すること）
+            batch_size (int): 1回の一括挿入の最大行数
+            fsync_ms (float): fsync をまとめる間隔
+            segment_bytes (int): セグメントを切り替えるサイズ
+            max_backoff (float): 送信失敗時に待つ最大秒数
+            validate: 送れない行なら理由を返す関数（その行は追記せず dead_letter/ に書く）
+        """
+        self.directory = directory
+        self.dead_letter_directory = os.path.join(directory, DEAD_LETTER_DIR)
+        self.sink = sink
+        self.validate = validate
+        self.batch_size = max(1, int(batch_size))
+        self.fsync_interval = max(0.0, float(fsync_ms)) / 1000.0
+        self.segment_bytes = int(segment_bytes)
+        self.max_backoff = float(max_backoff)
+        os.makedirs(directory, exist_ok=True)
+        self._pid = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self) -> None:
+        """プロセス（pid）ごとの状態を作り直し、スレッドを起動する（fork 後の子でも呼ぶ）"""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._fd: Optional[int] = None
+        self._active: Optional[str] = None
+        self._size = 0
+        self._dirty = False
+        seqs = [_segment_id(p)[1] for p in self._segments() if _segment_id(p)[0] == self._pid]
+        self._seq = max(seqs, default=0)
+        self._stats = {'appended': 0, 'sent': 0, 'batches': 0, 'failures': 0, 'corrupt': 0, 'adopted': 0,
+                       'invalid': 0, 'dead_lettered': 0}
+        self.last_error: Optional[str] = None
+        self.last_sent_at: Optional[float] = None
+        self._failures = 0
+        # 前回のプロセス（同じ pid を含む）が残したセグメントもすぐに送る
+        self._pending.set()
+        for target, name in ((self._sync_loop, 'spool-fsync'), (self._replay_loop, 'spool-replay')):
+            threading.Thread(target=target, name=name, daemon=True).start()
+
+    # --- 書き込み ---
+
+    def append(self, record: Dict) -> str:
+        """レコードを追記し、idempotency_key を返す"""
+        return self.extend([record])[0]
+
+    def extend(self, records: List[Dict]) -> List[str]:
+        """レコードをまとめて（write 1回で）追記し、idempotency_key のリストを返す"""
+        if self._pid != os.getpid():
+            self._reset()
+        keys = []
+        lines = []
+        invalid = []
+        for record in records:
+            record = dict(record)
+            keys.append(record.setdefault('idempotency_key', uuid.uuid4().hex))
+            record.setdefault('created_at', datetime.now(timezone.utc).isoformat())
+            error = self.validate(record) if self.validate is not None else None
+            if error is not None:
+                invalid.append((record, error))
+                continue
+            lines.append(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        if invalid:
+            self._stats['invalid'] += len(invalid)
+            self._dead_letter(invalid)
+        if not lines:
+            return keys
+        data = ''.join(lines).encode('utf-8')
+        with self._lock:
+            if self._fd is None or self._size >= self.segment_bytes:
+                self._rotate()
+            os.write(self._fd, data)
+            self._size += len(data)
+            self._dirty = True
+            self._stats['appended'] += len(lines)
+        self._pending.set()
+        return keys
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _rotate(self) -> None:
+        """新しいセグメントに切り替える（self._lock を持って呼ぶ）"""
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+        self._active = os.path.join(self.directory, f"{self._pid}-{self._next_seq():08d}{SEGMENT_SUFFIX}")
+        self._fd = os.open(self._active, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = 0
+        self._dirty = False
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._fd is not None and self._dirty:
+                os.fsync(self._fd)
+                self._dirty = False
+
+    def _sync_loop(self) -> None:
+        pid = self._pid
+        while not self._stop.is_set() and pid == os.getpid():
+            time.sleep(self.fsync_interval or 0.05)
+            try:
+                self.sync()
+            except OSError as e:
+                logger.error(f"Spool fsync failed: {e}")
+
+    def _dead_letter(self, failed: List[Tuple[Dict, str]]) -> None:
+        """送れない行を dead_letter/<pid>.ndjson に書く（自動では再送しない）"""
+        failed_at = datetime.now(timezone.utc).isoformat()
+        data = ''.join(
+            json.dumps({'record': record, 'error': error, 'failed_at': failed_at}, ensure_ascii=False, default=str) + '\n'
+            for record, error in failed
+        ).encode('utf-8')
+        os.makedirs(self.dead_letter_directory, exist_ok=True)
+        fd = os.open(os.path.join(self.dead_letter_directory, f"{self._pid}{SEGMENT_SUFFIX}"),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._stats['dead_lettered'] += len(failed)
+        for record, error in failed[:3]:
+            logger.error(f"Dead-lettered spool record {record.get('idempotency_key')}: {error}")
+
+    # --- 送信 ---
+
+    def _segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, f"*{SEGMENT_SUFFIX}")), key=_segment_id)
+
+    @staticmethod
+    def _offset_path(segment: str) -> str:
+        return segment[:-len(SEGMENT_SUFFIX)] + OFFSET_SUFFIX
+
+    def _read_offset(self, segment: str) -> int:
+        try:
+            with open(self._offset_path(segment)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_offset(self, segment: str, offset: int) -> None:
+        path = self._offset_path(segment)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, path)
+
+    def _adopt_orphans(self) -> None:
+        """終了したプロセスのセグメントを自分の名前に rename して引き取る"""
+        for segment in self._segments():
+            pid, _ = _segment_id(segment)
+            if pid == self._pid or _pid_alive(pid):
+                continue
+            with self._lock:
+                target = os.path.join(self.directory, f"{self._pid}-{self._next_seq():08d}{SEGMENT_SUFFIX}")
+            try:
+                os.rename(segment, target)
+            except FileNotFoundError:
+                continue  # 別のワーカーが先に引き取った
+            if os.path.exists(self._offset_path(segment)):
+                os.replace(self._offset_path(segment), self._offset_path(target))
+            self._stats['adopted'] += 1
+            logger.info(f"Adopted spool segment {os.path.basename(segment)} -> {os.path.basename(target)}")
+
+    def _read_batch(self, segment: str, offset: int) -> Tuple[List[Dict], int]:
+        """offset から最大 batch_size 行を読み、(レコード, 読み終えた位置) を返す（書きかけの最終行は読まない）"""
+        with open(segment, 'rb') as f:
+            f.seek(offset)
+            data = f.read(READ_CHUNK_BYTES)
+        end = data.rfind(b'\n')
+        if end < 0:
+            return [], offset
+        records = []
+        consumed = 0
+        for line in data[:end + 1].splitlines(keepends=True):
+            if len(records) >= self.batch_size:
+                break
+            consumed += len(line)
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                self._stats['corrupt'] += 1
+                logger.warning(f"Skipping corrupt spool record in {os.path.basename(segment)}")
+        return records, offset + consumed
+
+    def _send(self, records: List[Dict]) -> None:
+        """
+        レコードを送る（データの誤りで拒否されたら二分して送り直し、拒否された行を dead_letter/ に書く）
+
+        データの誤り以外（接続・タイムアウトなど）の失敗は例外のまま返し、同じバッチを後で送り直す。
+        """
+        try:
+            self.sink(records)
+        except Exception as e:
+            if not is_data_error(e):
+                raise
+            if len(records) == 1:
+                self._dead_letter([(records[0], str(e))])
+                return
+            middle = len(records) // 2
+            self._send(records[:middle])
+            self._send(records[middle:])
+            return
+        self._stats['sent'] += len(records)
+
+    def replay_once(self) -> int:
+        """自分のセグメントの未送信の行を1バッチ送り、処理した行数を返す（送信失敗は例外）"""
+        for segment in self._segments():
+            if _segment_id(segment)[0] != self._pid:
+                continue
+            offset = self._read_offset(segment)
+            while True:
+                records, end = self._read_batch(segment, offset)
+                if records:
+                    self._send(records)
+                if end != offset:
+                    self._write_offset(segment, end)
+                if records:
+                    return len(records)
+                if end == offset:
+                    break
+                offset = end  # 壊れた行だけだった
+            # 読み切った切り替え済みのセグメントは削除する（書き込むプロセスがいないため、書きかけの最終行も捨てる）
+            with self._lock:
+                active = segment == self._active
+            if not active:
+                leftover = os.path.getsize(segment) - offset
+                if leftover:
+                    self._stats['corrupt'] += 1
+                    logger.warning(f"Discarding {leftover} bytes of incomplete record in {os.path.basename(segment)}")
+                os.remove(segment)
+                if os.path.exists(self._offset_path(segment)):
+                    os.remove(self._offset_path(segment))
+        return 0
+
+    def _replay_loop(self) -> None:
+        pid = self._pid
+        last_adopt = 0.0
+        while not self._stop.is_set() and pid == os.getpid():
+            if time.monotonic() - last_adopt > 30:
+                last_adopt = time.monotonic()
+                try:
+                    self._adopt_orphans()
+                except OSError as e:
+                    logger.error(f"Failed to adopt spool segments: {e}")
+            try:
+                sent = self.replay_once()
+            except Exception as e:
+                self._failures += 1
+                self._stats['failures'] += 1
+                self.last_error = str(e)
+                delay = min(self.max_backoff, 0.5 * 2 ** (self._failures - 1)) * random.uniform(0.5, 1.0)
+                logger.warning(f"Spool replay failed ({self._failures} in a row), retrying in {delay:.1f}s: {e}")
+                self._stop.wait(delay)
+                continue
+            if sent:
+                self._failures = 0
+                self._stats['batches'] += 1
+                self.last_sent_at = time.time()
+                continue
+            self._pending.wait(5.0)
+            self._pending.clear()
+
+    # --- 状態 ---
+
+    def pending_bytes(self) -> int:
+        total = 0
+        for segment in self._segments():
+            try:
+                total += max(0, os.path.getsize(segment) - self._read_offset(segment))
+            except OSError:
+                pass
+        return total
+
+    def stats(self) -> Dict:
+        return {
+            'directory': self.directory,
+            'pending_bytes': self.pending_bytes(),
+            'segments': len(self._segments()),
+            'consecutive_failures': self._failures,
+            'last_error': self.last_error,
+            'last_sent_at': datetime.fromtimestamp(self.last_sent_at, tz=timezone.utc).isoformat()
+            if self.last_sent_at else None,
+            **self._stats
+        }
+
+    def close(self) -> None:
+        """スレッドを止めて fsync する（未送信の行はファイルに残り、次の起動で送る）"""
+        self._stop.set()
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+
+def spool_from_env(sink: Callable[[List[Dict]], None], name: str) -> Optional[PredictionSpool]:
+    """
+    環境変数の設定でスプールを作る（SPOOL_DIR が空文字なら None）
+
+    Args:
+        sink: 一括挿入する関数
+        name (str): SPOOL_DIR 以下のサブディレクトリ（送信先ごとに分ける）
+    """
+    base = os.environ.get('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'spool'))
+    if not base:
+        return None
+    return PredictionSpool(
+        os.path.join(base, name), sink,
+        batch_size=int(os.environ.get('SPOOL_BATCH_SIZE', '500')),
+        fsync_ms=float(os.environ.get('SPOOL_FSYNC_MS', '50')),
+        segment_bytes=int(os.environ.get('SPOOL_SEGMENT_BYTES', str(4 << 20))),
+        validate=validate_log_row
+    )
@@ -0,0 +1,201 @@
+"""
+オンデマンドのリクエストプロファイリング
+
+本番でモデルやライブラリ更新後にレイテンシが悪化したとき、計測用ビルドを
+デプロイし直さずに「どこで時間を使っているか」を取るための仕組み。
+
+環境変数 PROFILE_TOKEN が設定されている場合のみ有効になる（未設定ならフックを
+一切登録しないため、オーバーヘッドはゼロ）。
+
+- ヘッダ `X-Profile-Token: <token>` 付きのリクエストはそのリクエストだけをプロファイルする
+- `POST /api/admin/profile` で「指定ルートの次の N リクエスト」をプロファイルする
+  （ワーカープロセスごとの設定。複数ワーカーではヘッダ方式が確実）
+- 結果は PROFILE_DIR（既定: logs/profiles）に保存し、`GET /api/admin/profiles` で一覧、
+  `GET /api/admin/profiles/<name>` で取得できる
+  - sampling: フレームグラフ用の folded 形式（flamegraph.pl / speedscope で読める）
+  - cprofile: pstats 形式（snakeviz / flameprof で読める）
+
+環境変数:
+    PROFILE_TOKEN                 管理用トークン（未設定なら無効）
+    PROFILE_DIR                   保存先ディレクトリ
+    PROFILE_SAMPLE_INTERVAL_MS    サンプリング間隔（既定: 1ms）
+"""
+
+import cProfile
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+from flask import Flask, g, jsonify, request, send_from_directory
+
+PROFILE_MODES = ('sampling', 'cprofile')
+
+
+class SamplingProfiler:
+    """対象スレッドのスタックを一定間隔でサンプリングし、folded 形式で集計する"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common()) + '\n'
+
+
+class RequestProfiler:
+    """プロファイル対象リクエストの判定・計測・保存を行う"""
+
+    def __init__(self, profile_dir: str, token: str, interval_ms: float):
+        self.profile_dir = profile_dir
+        self.token = token
+        self.interval = interval_ms / 1000.0
+        # ルート -> {'remaining': 残り回数, 'mode': モード}
+        self.armed: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def authorized(self) -> bool:
+        supplied = request.headers.get('X-Profile-Token', '')
+        return bool(supplied) and hmac.compare_digest(supplied, self.token)
+
+    def _take(self, path: str) -> Optional[str]:
+        """このリクエストをプロファイルするならモードを返す"""
+        if self.armed:
+            with self._lock:
+                entry = self.armed.get(path)
+                if entry is not None:
+                    entry['remaining'] -= 1
+                    if entry['remaining'] <= 0:
+                        del self.armed[path]
+                    return entry['mode']
+        if 'X-Profile-Token' in request.headers and self.authorized():
+            mode = request.headers.get('X-Profile-Mode', 'sampling')
+            return mode if mode in PROFILE_MODES else 'sampling'
+        return None
+
+    def before_request(self):
+        if request.path.startswith('/api/admin/profile'):
+            return
+        mode = self._take(request.path)
+        if mode is None:
+            return
+        g._profile_mode = mode
+        g._profile_start = time.perf_counter()
+        if mode == 'cprofile':
+            g._profiler = cProfile.Profile()
+            g._profiler.enable()
+        else:
+            g._profiler = SamplingProfiler(threading.get_ident(), self.interval)
+            g._profiler.start()
+
+    def teardown_request(self, exc=None):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return
+        mode = g.pop('_profile_mode')
+        elapsed_ms = int((time.perf_counter() - g.pop('_profile_start')) * 1000)
+        route = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        base = f"{route}-{stamp}-{os.getpid()}-{elapsed_ms}ms"
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            if mode == 'cprofile':
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{base}.prof"))
+            else:
+                profiler.stop()
+                with open(os.path.join(self.profile_dir, f"{base}.folded"), 'w', encoding='utf-8') as f:
+                    f.write(profiler.folded())
+        except Exception as e:
+            print(f"プロファイルの保存に失敗しました: {e}")
+
+    # --- 管理用エンドポイント ---
+
+    def arm(self):
+        """指定ルートの次の N リクエストをプロファイルする"""
+        if not self.authorized():
+            return jsonify({"error": "unauthorized"}), 403
+        data = request.get_json(silent=True) or {}
+        route = data.get('route')
+        if not route:
+            return jsonify({"error": "route を指定してください"}), 400
+        mode = data.get('mode', 'sampling')
+        if mode not in PROFILE_MODES:
+            return jsonify({"error": f"mode は {', '.join(PROFILE_MODES)} のいずれかです"}), 400
+        count = max(0, int(data.get('count', 1)))
+        with self._lock:
+            if count == 0:
+                self.armed.pop(route, None)
+            else:
+                self.armed[route] = {'remaining': count, 'mode': mode}
+            armed = {k: dict(v) for k, v in self.armed.items()}
+        return jsonify({"armed": armed, "pid": os.getpid()})
+
+    def list_profiles(self):
+        if not self.authorized():
+            return jsonify({"error": "unauthorized"}), 403
+        files = []
+        if os.path.isdir(self.profile_dir):
+            for name in sorted(os.listdir(self.profile_dir), reverse=True):
+                path = os.path.join(self.profile_dir, name)
+                files.append({"name": name, "bytes": os.path.getsize(path)})
+        with self._lock:
+            armed = {k: dict(v) for k, v in self.armed.items()}
+        return jsonify({"profiles": files, "armed": armed, "pid": os.getpid()})
+
+    def get_profile(self, name):
+        if not self.authorized():
+            return jsonify({"error": "unauthorized"}), 403
+        return send_from_directory(self.profile_dir, name, as_attachment=True)
+
+
+def init_profiling(flask_app: Flask, default_dir: str) -> Optional[RequestProfiler]:
+    """
+    PROFILE_TOKEN が設定されていればプロファイリングのフックと管理用エンドポイントを登録する
+
+    Args:
+        flask_app (Flask): 対象の Flask アプリ
+        default_dir (str): PROFILE_DIR 未設定時の保存先
+    """
+    token = os.environ.get('PROFILE_TOKEN')
+    if not token:
+        return None
+
+    profiler = RequestProfiler(
+        os.environ.get('PROFILE_DIR', default_dir),
+        token,
+        float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 1))
+    )
+    flask_app.before_request(profiler.before_request)
+    flask_app.teardown_request(profiler.teardown_request)
+    flask_app.add_url_rule('/api/admin/profile', 'profile_arm', profiler.arm, methods=['POST'])
+    flask_app.add_url_rule('/api/admin/profiles', 'profile_list', profiler.list_profiles, methods=['GET'])
+    flask_app.add_url_rule('/api/admin/profiles/<path:name>', 'profile_get', profiler.get_profile, methods=['GET'])
+    flask_app.logger.info('Request profiling enabled')
+    return profiler
@@ -0,0 +1,171 @@
+"""
+直近の予測のリングバッファ（ワーカーごと、NumPy）
+
+ワーカーが記録した予測ログの行を固定長の配列に循環して書き込み、曜日ごとの件数・合計・
+最小・最大を逐次更新する。ダッシュボードが定期的に取る小さい limit の /api/history と
+/api/stats の直近の部分は Supabase に問い合わせずにここから返す。
+
+バッファに入るのはそのワーカーが処理した予測だけ。データベースと同じく同じ指紋の予測は1行にまとめ
+（hit_count・last_seen_at・予測値を更新し、並び順は最初の予測のまま）、行には id が無い。
+カーソル付き・バッファより深い履歴はデータベースから取る。
+
+環境変数:
+    RECENT_PREDICTIONS_SIZE   バッファの行数（既定: 1000、0 で無効）
+    RECENT_HISTORY_LIMIT      バッファから返す /api/history の最大 limit（既定: 100）
+"""
+
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from history_query import HistoryQuery
+from inference import DAY_CODES
+from prediction_spool import merge_duplicates, prediction_log_row
+
+# バッファから返す /api/history の最大 limit（これより大きい limit はデータベースから取る）
+RECENT_HISTORY_LIMIT = int(os.environ.get('RECENT_HISTORY_LIMIT', '100'))
+
+
+class RecentPredictions:
+    """直近 capacity 件の予測と、曜日ごとの集計"""
+
+    def __init__(self, capacity: int = 1000):
+        self.capacity = max(0, int(capacity))
+        self.clear()
+        if hasattr(os, 'register_at_fork'):
+            # fork 後の子プロセスは親の予測を引き継がない
+            os.register_at_fork(after_in_child=self.clear)
+
+    def clear(self) -> None:
+        self._lock = threading.Lock()
+        self._rows: List[Optional[Dict]] = [None] * self.capacity
+        self._values = np.zeros(self.capacity)
+        # 指紋 -> バッファ内の位置
+        self._slots: Dict[str, int] = {}
+        self._next = 0
+        self._size = 0
+        # 記録を始めてからの曜日ごとの集計（バッファから押し出された行も含む）
+        self._count = np.zeros(len(DAY_CODES), dtype=np.int64)
+        self._sum = np.zeros(len(DAY_CODES))
+        self._min = np.full(len(DAY_CODES), np.inf)
+        self._max = np.full(len(DAY_CODES), -np.inf)
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def record(self, predictions: List[Dict], model_version: Optional[str] = None) -> None:
+        """1リクエスト分の予測を記録する（行は prediction_logs と同じ形、features は dict）"""
+        if not self.enabled:
+            return
+        rows = []
+        for prediction in predictions:
+            row = prediction_log_row(prediction, model_version)
+            if row['predicted_value'] is None or row['day_of_week'] not in DAY_CODES:
+                continue
+            row['features'] = json.loads(row['features'])
+            rows.append(row)
+        with self._lock:
+            for row in merge_duplicates(rows):
+                value = float(row['predicted_value'])
+                day = DAY_CODES.index(row['day_of_week'])
+                slot = self._slots.get(row['fingerprint'])
+                if slot is not None:
+                    # 既にある行は回数・最後の時刻・予測値だけを更新する（upsert_prediction_logs と同じ）
+                    current = self._rows[slot]
+                    current['hit_count'] += row['hit_count']
+                    current['last_seen_at'] = max(current['last_seen_at'], row['last_seen_at'])
+                    current['predicted_value'] = row['predicted_value']
+                    self._values[slot] = value
+                else:
+                    evicted = self._rows[self._next]
+                    if evicted is not None and self._slots.get(evicted['fingerprint']) == self._next:
+                        del self._slots[evicted['fingerprint']]
+                    self._rows[self._next] = row
+                    self._values[self._next] = value
+                    self._slots[row['fingerprint']] = self._next
+                    self._next = (self._next + 1) % self.capacity
+                    self._size = min(self._size + 1, self.capacity)
+                # 曜日ごとの集計はリクエスト数（hit_count）で数える
+                self._count[day] += row['hit_count']
+                self._sum[day] += value * row['hit_count']
+                self._min[day] = min(self._min[day], value)
+                self._max[day] = max(self._max[day], value)
+
+    def _latest_rows(self) -> List[Dict]:
+        """新しい順の行（ロックを持って呼ぶ）"""
+        order = [(self._next - 1 - i) % self.capacity for i in range(self._size)]
+        return [self._rows[i] for i in order]
+
+    def latest(self, limit: int = 5) -> List[Dict]:
+        """新しい順に limit 件"""
+        with self._lock:
+            return [dict(row) for row in self._latest_rows()[:limit]]
+
+    def history(self, query: HistoryQuery, max_limit: int = RECENT_HISTORY_LIMIT) -> Optional[List[Dict]]:
+        """
+        バッファで答えられる履歴の検索なら新しい順の行を返す（答えられなければ None）
+
+        カーソル付き・limit が max_limit を超える・条件に合う行が limit 件に満たない（それより前は
+        データベースにしか無い）場合は None。
+        """
+        if not self.enabled or query.after is not None or query.limit is None or query.limit > max_limit:
+            return None
+        # データベースと同じく、列を絞り込んでもカーソル用の列（created_at, id）は返す
+        columns = query.select_columns()
+        matched = []
+        with self._lock:
+            for row in self._latest_rows():
+                if query.date_from and row['prediction_date'] < query.date_from:
+                    continue
+                if query.date_to and row['prediction_date'] > query.date_to:
+                    continue
+                if query.days and row['day_of_week'] not in query.days:
+                    continue
+                matched.append({c: row.get(c) for c in columns})
+                if len(matched) == query.limit:
+                    break
+        if len(matched) < query.limit:
+            return None
+        return matched
+
+    def stats(self) -> Dict:
+        """バッファ内の予測値の集計と、記録を始めてからの曜日ごとの件数・平均・最小・最大"""
+        with self._lock:
+            values = self._values[:self._size].copy()
+            count, total = self._count.copy(), self._sum.copy()
+            low, high = self._min.copy(), self._max.copy()
+
+        def rounded(value: float) -> Optional[float]:
+            return round(float(value), 2) if np.isfinite(value) else None
+
+        n = int(count.sum())
+        return {
+            'capacity': self.capacity,
+            'size': int(len(values)),
+            'window': {
+                'mean': rounded(values.mean()) if len(values) else None,
+                'min': rounded(values.min()) if len(values) else None,
+                'max': rounded(values.max()) if len(values) else None
+            },
+            'count': n,
+            'mean': rounded(total.sum() / n) if n else None,
+            'by_weekday': [
+                {
+                    'day_of_week': day,
+                    'count': int(count[i]),
+                    'mean': rounded(total[i] / count[i]) if count[i] else None,
+                    'min': rounded(low[i]),
+                    'max': rounded(high[i])
+                }
+                for i, day in enumerate(DAY_CODES)
+            ]
+        }
+
+
+def recent_from_env() -> RecentPredictions:
+    """RECENT_PREDICTIONS_SIZE の大きさのバッファ"""
+    return RecentPredictions(int(os.environ.get('RECENT_PREDICTIONS_SIZE', '1000')))
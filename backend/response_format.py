@@ -0,0 +1,102 @@
+"""
+予測レスポンスのフォーマット変換
+
+週間・月間予測は日ごとに同じ形の dict を繰り返すため、ホライズンが長くなるほど
+ペイロードと jsonify の時間が膨らむ。ここでは opt-in のカラムナ形式
+（日付・予測値・信頼区間・フラグの並列配列 + 共通入力を1回だけ）への変換と、
+高速 JSON エンコーダによるシリアライズを提供する。
+"""
+
+import json
+from typing import Dict, List
+
+from flask import Response, request
+
+# 高速JSONエンコーダ（任意）
+try:
+    import orjson  # type: ignore
+    HAS_ORJSON = True
+except Exception:
+    HAS_ORJSON = False
+
+COLUMNAR_FORMAT = 'columnar'
+COLUMNAR_MIMETYPE = 'application/vnd.inhospital.columnar+json'
+
+# クライアント側で日付から復元できる表示用フィールド（カラムナ形式では送らない）
+DERIVED_FIELDS = ('day_label', 'day_name')
+
+
+def wants_columnar() -> bool:
+    """クエリ（?format=columnar）または Accept ヘッダでカラムナ形式が要求されたか"""
+    fmt = request.args.get('format', '').lower()
+    if fmt:
+        return fmt == COLUMNAR_FORMAT
+    return COLUMNAR_MIMETYPE in request.headers.get('Accept', '')
+
+
+def _flatten(record: Dict, prefix: str = '') -> Dict:
+    """ネストした dict をドット区切りのキーに平坦化する"""
+    flat = {}
+    for key, value in record.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}."))
+        else:
+            flat[name] = value
+    return flat
+
+
+def to_columnar(result: Dict, rows_key: str = 'predictions') -> Dict:
+    """
+    日ごとのレコード配列を並列配列に変換する
+
+    全レコードで値が同じフィールドは `shared` に1回だけ置き、
+    それ以外は `columns` にフィールドごとの配列として置く。
+    `rows_key` 以外のトップレベル項目（statistics など）はそのまま残す。
+
+    Args:
+        result (dict): 既定形式のレスポンス
+        rows_key (str): 日ごとのレコード配列のキー
+
+    Returns:
+        dict: カラムナ形式のレスポンス
+    """
+    rows: List[Dict] = result.get(rows_key, [])
+    flat_rows = [_flatten({k: v for k, v in row.items() if k not in DERIVED_FIELDS}) for row in rows]
+
+    # フィールド順は最初のレコードに合わせる（欠けているフィールドは None で埋める）
+    fields: List[str] = []
+    for row in flat_rows:
+        for name in row:
+            if name not in fields:
+                fields.append(name)
+
+    columns = {}
+    shared = {}
+    for name in fields:
+        values = [row.get(name) for row in flat_rows]
+        if values and all(v == values[0] for v in values[1:]):
+            shared[name] = values[0]
+        else:
+            columns[name] = values
+
+    columnar = {k: v for k, v in result.items() if k != rows_key}
+    columnar.update({
+        'format': COLUMNAR_FORMAT,
+        'length': len(flat_rows),
+        'columns': columns,
+        'shared': shared
+    })
+    return columnar
+
+
+def dumps(payload) -> bytes:
+    """orjson があれば使い、なければ標準 json でコンパクトにシリアライズする"""
+    if HAS_ORJSON:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def columnar_response(result: Dict, rows_key: str = 'predictions') -> Response:
+    """既定形式のレスポンスをカラムナ形式の Response に変換する"""
+    return Response(dumps(to_columnar(result, rows_key)), mimetype=COLUMNAR_MIMETYPE)
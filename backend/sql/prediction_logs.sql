@@ -0,0 +1,220 @@
+-- 予測ログの冪等キー・まとめ書き込みの関数と、集計テーブル・トリガー（Supabase・PostgreSQL 共通）
+--
+-- Supabase では supabase_schema.sql の後に SQL エディタで実行する。PostgreSQL 版（backend/database.py）は
+-- 起動時にこのファイルを実行する。何度実行しても同じ結果になるように書く（IF NOT EXISTS・CREATE OR REPLACE）。
+
+-- 受け取り済みの予測ログの冪等キー（スプールからの再送で hit_count を二重に数えない）
+CREATE TABLE IF NOT EXISTS prediction_log_receipts (
+    idempotency_key VARCHAR(32) PRIMARY KEY,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_prediction_log_receipts_received_at ON prediction_log_receipts(received_at);
+-- ポリシーを作らず、anon・authenticated から読み書きさせない（upsert_prediction_logs だけが書く）
+ALTER TABLE prediction_log_receipts ENABLE ROW LEVEL SECURITY;
+
+-- 予測ログのまとめ書き込み（supabase_client.py は rpc、database.py は SELECT で呼ぶ）
+-- 受け取り済みの冪等キーの行は無視し、同じ指紋の行はまとめて hit_count を加算、last_seen_at を更新する
+CREATE OR REPLACE FUNCTION upsert_prediction_logs(payload JSONB) RETURNS INTEGER
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    WITH incoming AS (
+        SELECT * FROM jsonb_to_recordset(payload) AS r(
+            idempotency_key VARCHAR(32), fingerprint VARCHAR(32), model_version VARCHAR(64),
+            prediction_date DATE, predicted_value FLOAT, total_outpatient INTEGER, intro_outpatient INTEGER,
+            er_patients INTEGER, bed_count INTEGER, public_holiday BOOLEAN, day_of_week VARCHAR(10),
+            features TEXT, hit_count INTEGER, created_at TIMESTAMPTZ, last_seen_at TIMESTAMPTZ
+        )
+    ),
+    fresh AS (
+        INSERT INTO prediction_log_receipts (idempotency_key)
+        SELECT DISTINCT idempotency_key FROM incoming
+        ON CONFLICT DO NOTHING
+        RETURNING idempotency_key
+    ),
+    merged AS (
+        SELECT DISTINCT ON (i.fingerprint) i.*,
+               SUM(i.hit_count) OVER (PARTITION BY i.fingerprint) AS hits,
+               MIN(i.created_at) OVER (PARTITION BY i.fingerprint) AS first_seen,
+               MAX(i.last_seen_at) OVER (PARTITION BY i.fingerprint) AS last_seen
+        FROM incoming i JOIN fresh f ON f.idempotency_key = i.idempotency_key
+        ORDER BY i.fingerprint, i.last_seen_at DESC
+    )
+    INSERT INTO prediction_logs (
+        prediction_date, predicted_value, total_outpatient, intro_outpatient, er_patients, bed_count,
+        public_holiday, day_of_week, features, model_version, fingerprint, hit_count, created_at, last_seen_at
+    )
+    SELECT prediction_date, predicted_value, total_outpatient, intro_outpatient, er_patients, bed_count,
+           public_holiday, day_of_week, features::JSONB, model_version, fingerprint, hits, first_seen, last_seen
+    FROM merged
+    ON CONFLICT (fingerprint) DO UPDATE SET
+        hit_count = prediction_logs.hit_count + EXCLUDED.hit_count,
+        last_seen_at = GREATEST(prediction_logs.last_seen_at, EXCLUDED.last_seen_at),
+        predicted_value = EXCLUDED.predicted_value;
+    GET DIAGNOSTICS affected = ROW_COUNT;
+
+    -- スプールの再送はすぐに終わるため、古い冪等キーは捨てる
+    DELETE FROM prediction_log_receipts WHERE received_at < NOW() - INTERVAL '7 days';
+    RETURN affected;
+END;
+$$;
+
+-- 予測ログの集計（prediction_logs のトリガーで増分更新し、/api/stats は全件を数えずにここを読む）
+-- requests はリクエスト数（hit_count の合計）、unique_predictions は指紋の数
+CREATE TABLE IF NOT EXISTS prediction_stats_daily (
+    day DATE PRIMARY KEY,
+    requests BIGINT NOT NULL DEFAULT 0,
+    unique_predictions BIGINT NOT NULL DEFAULT 0,
+    predicted_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    predicted_min DOUBLE PRECISION,
+    predicted_max DOUBLE PRECISION
+);
+
+CREATE TABLE IF NOT EXISTS prediction_stats_by_model (
+    model_version VARCHAR(64) PRIMARY KEY,
+    requests BIGINT NOT NULL DEFAULT 0,
+    unique_predictions BIGINT NOT NULL DEFAULT 0,
+    predicted_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    predicted_min DOUBLE PRECISION,
+    predicted_max DOUBLE PRECISION,
+    first_seen_at TIMESTAMP WITH TIME ZONE,
+    last_seen_at TIMESTAMP WITH TIME ZONE
+);
+
+-- 予測日の曜日（ISO: 1 = 月曜 ... 7 = 日曜）
+CREATE TABLE IF NOT EXISTS prediction_stats_by_weekday (
+    weekday SMALLINT PRIMARY KEY,
+    requests BIGINT NOT NULL DEFAULT 0,
+    unique_predictions BIGINT NOT NULL DEFAULT 0,
+    predicted_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    predicted_min DOUBLE PRECISION,
+    predicted_max DOUBLE PRECISION
+);
+
+-- 集計は誰でも読めるが、書くのはトリガーと refresh_prediction_stats だけ
+ALTER TABLE prediction_stats_daily ENABLE ROW LEVEL SECURITY;
+ALTER TABLE prediction_stats_by_model ENABLE ROW LEVEL SECURITY;
+ALTER TABLE prediction_stats_by_weekday ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Public read access" ON prediction_stats_daily;
+DROP POLICY IF EXISTS "Public read access" ON prediction_stats_by_model;
+DROP POLICY IF EXISTS "Public read access" ON prediction_stats_by_weekday;
+CREATE POLICY "Public read access" ON prediction_stats_daily FOR SELECT USING (true);
+CREATE POLICY "Public read access" ON prediction_stats_by_model FOR SELECT USING (true);
+CREATE POLICY "Public read access" ON prediction_stats_by_weekday FOR SELECT USING (true);
+
+-- 集計の増分更新（予測ログの行の追加・hit_count の更新ごと）
+CREATE OR REPLACE FUNCTION update_prediction_stats() RETURNS TRIGGER
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+DECLARE
+    hits BIGINT := NEW.hit_count - CASE WHEN TG_OP = 'UPDATE' THEN OLD.hit_count ELSE 0 END;
+    new_rows BIGINT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE 0 END;
+BEGIN
+    IF hits = 0 AND new_rows = 0 THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO prediction_stats_daily AS s
+        (day, requests, unique_predictions, predicted_sum, predicted_min, predicted_max)
+    VALUES (COALESCE(NEW.last_seen_at, NOW())::DATE, hits, new_rows, NEW.predicted_value * hits,
+            NEW.predicted_value, NEW.predicted_value)
+    ON CONFLICT (day) DO UPDATE SET
+        requests = s.requests + EXCLUDED.requests,
+        unique_predictions = s.unique_predictions + EXCLUDED.unique_predictions,
+        predicted_sum = s.predicted_sum + EXCLUDED.predicted_sum,
+        predicted_min = LEAST(s.predicted_min, EXCLUDED.predicted_min),
+        predicted_max = GREATEST(s.predicted_max, EXCLUDED.predicted_max);
+
+    INSERT INTO prediction_stats_by_model AS s
+        (model_version, requests, unique_predictions, predicted_sum, predicted_min, predicted_max,
+         first_seen_at, last_seen_at)
+    VALUES (COALESCE(NEW.model_version, 'unknown'), hits, new_rows, NEW.predicted_value * hits,
+            NEW.predicted_value, NEW.predicted_value, NEW.created_at, NEW.last_seen_at)
+    ON CONFLICT (model_version) DO UPDATE SET
+        requests = s.requests + EXCLUDED.requests,
+        unique_predictions = s.unique_predictions + EXCLUDED.unique_predictions,
+        predicted_sum = s.predicted_sum + EXCLUDED.predicted_sum,
+        predicted_min = LEAST(s.predicted_min, EXCLUDED.predicted_min),
+        predicted_max = GREATEST(s.predicted_max, EXCLUDED.predicted_max),
+        first_seen_at = LEAST(s.first_seen_at, EXCLUDED.first_seen_at),
+        last_seen_at = GREATEST(s.last_seen_at, EXCLUDED.last_seen_at);
+
+    INSERT INTO prediction_stats_by_weekday AS s
+        (weekday, requests, unique_predictions, predicted_sum, predicted_min, predicted_max)
+    VALUES (EXTRACT(ISODOW FROM NEW.prediction_date)::SMALLINT, hits, new_rows, NEW.predicted_value * hits,
+            NEW.predicted_value, NEW.predicted_value)
+    ON CONFLICT (weekday) DO UPDATE SET
+        requests = s.requests + EXCLUDED.requests,
+        unique_predictions = s.unique_predictions + EXCLUDED.unique_predictions,
+        predicted_sum = s.predicted_sum + EXCLUDED.predicted_sum,
+        predicted_min = LEAST(s.predicted_min, EXCLUDED.predicted_min),
+        predicted_max = GREATEST(s.predicted_max, EXCLUDED.predicted_max);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS prediction_logs_stats ON prediction_logs;
+CREATE TRIGGER prediction_logs_stats
+AFTER INSERT OR UPDATE OF hit_count ON prediction_logs
+FOR EACH ROW EXECUTE FUNCTION update_prediction_stats();
+
+-- 集計を prediction_logs から作り直す（既存データの取り込み・ずれた場合の修復）
+CREATE OR REPLACE FUNCTION refresh_prediction_stats() RETURNS VOID
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+    DELETE FROM prediction_stats_daily;
+    DELETE FROM prediction_stats_by_model;
+    DELETE FROM prediction_stats_by_weekday;
+    -- 行ごとの日付は最後のリクエストの日にまとめる（トリガーと同じ）
+    INSERT INTO prediction_stats_daily
+    SELECT COALESCE(last_seen_at, created_at)::DATE, SUM(hit_count), COUNT(*), SUM(predicted_value * hit_count),
+           MIN(predicted_value), MAX(predicted_value)
+    FROM prediction_logs GROUP BY 1;
+    INSERT INTO prediction_stats_by_model
+    SELECT COALESCE(model_version, 'unknown'), SUM(hit_count), COUNT(*), SUM(predicted_value * hit_count),
+           MIN(predicted_value), MAX(predicted_value), MIN(created_at), MAX(COALESCE(last_seen_at, created_at))
+    FROM prediction_logs GROUP BY 1;
+    INSERT INTO prediction_stats_by_weekday
+    SELECT EXTRACT(ISODOW FROM prediction_date)::SMALLINT, SUM(hit_count), COUNT(*), SUM(predicted_value * hit_count),
+           MIN(predicted_value), MAX(predicted_value)
+    FROM prediction_logs GROUP BY 1;
+END;
+$$;
+
+-- /api/stats 用の集計（1回の往復で返す。supabase_client.py は rpc、database.py は SELECT で呼ぶ）
+CREATE OR REPLACE FUNCTION get_prediction_stats(days INTEGER DEFAULT 30) RETURNS JSONB
+LANGUAGE sql STABLE SECURITY DEFINER SET search_path = public AS $$
+    SELECT jsonb_build_object(
+        'total_requests', (SELECT COALESCE(SUM(requests), 0) FROM prediction_stats_by_model),
+        'unique_predictions', (SELECT COALESCE(SUM(unique_predictions), 0) FROM prediction_stats_by_model),
+        'daily', (SELECT COALESCE(jsonb_agg(to_jsonb(d) ORDER BY d.day DESC), '[]'::JSONB) FROM (
+            SELECT * FROM prediction_stats_daily ORDER BY day DESC LIMIT days) d),
+        'by_model_version', (SELECT COALESCE(jsonb_agg(to_jsonb(m) ORDER BY m.last_seen_at DESC), '[]'::JSONB)
+                             FROM prediction_stats_by_model m),
+        'by_weekday', (SELECT COALESCE(jsonb_agg(to_jsonb(w) ORDER BY w.weekday), '[]'::JSONB)
+                       FROM prediction_stats_by_weekday w),
+        'recent_predictions', (SELECT COALESCE(jsonb_agg(to_jsonb(r) ORDER BY r.created_at DESC), '[]'::JSONB) FROM (
+            SELECT * FROM prediction_logs ORDER BY created_at DESC LIMIT 5) r)
+    );
+$$;
+
+-- 関数の実行権限。SECURITY DEFINER の関数は所有者の権限で動くため、既定の PUBLIC への EXECUTE を外し、
+-- アプリが呼ぶ関数だけをアプリのキーのロールに与える（update_prediction_stats はトリガー専用で誰にも与えない）
+REVOKE EXECUTE ON FUNCTION upsert_prediction_logs(JSONB) FROM PUBLIC;
+REVOKE EXECUTE ON FUNCTION update_prediction_stats() FROM PUBLIC;
+REVOKE EXECUTE ON FUNCTION refresh_prediction_stats() FROM PUBLIC;
+REVOKE EXECUTE ON FUNCTION get_prediction_stats(INTEGER) FROM PUBLIC;
+DO $$
+BEGIN
+    -- Supabase のロール（PostgreSQL 版はテーブルと関数の所有者として呼ぶため不要）
+    IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'anon') THEN
+        -- Supabase は public スキーマの関数に anon・authenticated・service_role の EXECUTE を既定で与える
+        REVOKE EXECUTE ON FUNCTION upsert_prediction_logs(JSONB), update_prediction_stats(),
+            refresh_prediction_stats(), get_prediction_stats(INTEGER) FROM anon, authenticated, service_role;
+        -- SUPABASE_KEY（anon キーまたは service_role キー）で呼ぶ関数
+        GRANT EXECUTE ON FUNCTION upsert_prediction_logs(JSONB), get_prediction_stats(INTEGER) TO anon, service_role;
+        -- 集計の作り直しは管理者だけ
+        GRANT EXECUTE ON FUNCTION refresh_prediction_stats() TO service_role;
+    END IF;
+END;
+$$;
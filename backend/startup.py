@@ -0,0 +1,122 @@
+"""
+起動パイプライン（バックグラウンドのウォームアップと準備状態）
+
+app.py の import ではルートの登録など軽い処理だけを行い、モデルのロードや重い
+ライブラリ（scikit-learn・pandas・supabase）の import は登録したステップとして
+バックグラウンドスレッドで順に実行する。ワーカーはすぐにリクエストを受け付け、
+/api/health はウォームアップが終わるまで "starting"（503）を返す。
+
+ウォームアップ中に届いた予測リクエストは完了を最大 STARTUP_WAIT_TIMEOUT 秒待ち、
+間に合わなければ 503 と Retry-After を返す。
+
+環境変数:
+    STARTUP_MODE          background（既定）: バックグラウンドでウォームアップ / sync: import 中に完了させる
+    STARTUP_WAIT_TIMEOUT  ウォームアップ中のリクエストが完了を待つ最大秒数（既定: 30）
+"""
+
+import os
+import threading
+import time
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+from flask import jsonify
+
+
+class Warmup:
+    """登録した起動ステップを順に実行し、準備状態を管理する"""
+
+    def __init__(self):
+        self.steps: List[Tuple[str, Callable]] = []
+        self.state = 'pending'
+        self.timings: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        # 完了前に fork された（gunicorn --preload など）子プロセスではスレッドが引き継がれないため、やり直す
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._restart_in_child)
+
+    def step(self, name: str):
+        """起動ステップを登録するデコレータ（登録順に実行）"""
+        def decorator(func):
+            self.steps.append((name, func))
+            return func
+        return decorator
+
+    def start(self, background: Optional[bool] = None) -> None:
+        """ウォームアップを開始する（background=None なら STARTUP_MODE に従う）"""
+        if background is None:
+            background = os.environ.get('STARTUP_MODE', 'background') != 'sync'
+        self.state = 'starting'
+        self.started_at = time.time()
+        self._pid = os.getpid()
+        self._ready.clear()
+        if not background:
+            self._run()
+            return
+        self._thread = threading.Thread(target=self._run, name='warmup', daemon=True)
+        self._thread.start()
+
+    def _restart_in_child(self) -> None:
+        if self._pid is not None and self._pid != os.getpid() and self.state == 'starting':
+            self._ready = threading.Event()
+            self.timings = {}
+            self.start(background=True)
+
+    def _run(self) -> None:
+        try:
+            for name, func in self.steps:
+                step_start = time.perf_counter()
+                func()
+                self.timings[name] = round((time.perf_counter() - step_start) * 1000, 1)
+            self.state = 'ready'
+        except Exception as e:
+            print(f"起動処理に失敗しました: {e}")
+            self.error = str(e)
+            self.state = 'failed'
+        finally:
+            self.finished_at = time.time()
+            self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == 'ready'
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ウォームアップの完了を待ち、準備ができていれば True を返す"""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def status(self) -> Dict:
+        end = self.finished_at or time.time()
+        return {
+            'state': self.state,
+            'elapsed_ms': round((end - self.started_at) * 1000, 1) if self.started_at else None,
+            'steps': dict(self.timings),
+            'error': self.error
+        }
+
+
+def requires_warmup(warmup: Warmup, timeout: Optional[float] = None):
+    """ウォームアップの完了を待ってからルートを実行するデコレータ（間に合わなければ 503）"""
+    if timeout is None:
+        timeout = float(os.environ.get('STARTUP_WAIT_TIMEOUT', 30))
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not warmup.wait(timeout):
+                response = jsonify({
+                    "error": "サーバーを起動中です。しばらくしてから再試行してください",
+                    "startup": warmup.status()
+                })
+                response.status_code = 503
+                response.headers['Retry-After'] = '1'
+                return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
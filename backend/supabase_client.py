@@ -1,41 +1,205 @@
+"""
+Supabase への予測ログ・設定・キャッシュの読み書き
+
+HTTP クライアント（httpx.Client）をプロセスで1つ作って接続を使い回し、呼び出しごとにタイムアウトを
+かける。冪等な読み取りは失敗時にジッタ付きの指数バックオフでリトライし、連続して失敗すると
+サーキットブレーカー（circuit_breaker.py）が開いて、復旧を確認するまで呼び出さずに即座に失敗する。
+Supabase が遅い・落ちている間も、予測リクエストがタイムアウトまで待たされない。
+
+attach_spool でスプール（prediction_spool.py）を設定すると、予測ログはローカルファイルに
+書くだけで返り、バックグラウンドで idempotency_key 付きの一括 upsert として送られる。
+
+環境変数:
+    SUPABASE_TIMEOUT            1回の呼び出しのタイムアウト秒数（既定: 3）
+    SUPABASE_CONNECT_TIMEOUT    接続のタイムアウト秒数（既定: 1）
+    SUPABASE_MAX_CONNECTIONS    接続プールの最大接続数（既定: 20）
+    SUPABASE_READ_RETRIES       読み取りのリトライ回数（既定: 2、書き込みはリトライしない）
+    SUPABASE_BREAKER_FAILURES   ブレーカーを開く連続失敗回数（既定: 5）
+    SUPABASE_BREAKER_RESET      ブレーカーが開いてから試し呼び出しをするまでの秒数（既定: 30）
+    STATS_CACHE_TTL             get_stats の結果をプロセス内に保持する秒数（既定: 10、0 で無効）
+"""
+
 import os
 import json
+import threading
+import time
+import uuid
 from datetime import datetime
-from typing import Optional, Dict, List
-from supabase import create_client, Client
+from typing import Callable, Iterator, Optional, Dict, List
 import logging
 
+from circuit_breaker import CircuitBreaker, CircuitOpenError, LatencyWindow, backoff_delays
+from history_query import HistoryQuery, iter_pages
+from metrics import record_supabase_call
+from prediction_spool import PredictionSpool, is_data_error, merge_duplicates, prediction_log_row, valid_log_rows
+
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class SupabaseService:
-    def __init__(self):
-        """Supabaseクライアントを初期化"""
+    def __init__(self, connect: bool = True):
+        """
+        Supabaseクライアントを初期化
+
+        Args:
+            connect (bool): False ならクライアントの作成（supabase パッケージの import）を connect() まで遅らせる
+        """
         self.supabase_url = os.environ.get('SUPABASE_URL')
         self.supabase_key = os.environ.get('SUPABASE_KEY')
-
+        self.timeout = float(os.environ.get('SUPABASE_TIMEOUT', '3'))
+        self.connect_timeout = float(os.environ.get('SUPABASE_CONNECT_TIMEOUT', '1'))
+        self.max_connections = int(os.environ.get('SUPABASE_MAX_CONNECTIONS', '20'))
+        self.read_retries = int(os.environ.get('SUPABASE_READ_RETRIES', '2'))
+        self.breaker = CircuitBreaker(
+            int(os.environ.get('SUPABASE_BREAKER_FAILURES', '5')),
+            float(os.environ.get('SUPABASE_BREAKER_RESET', '30'))
+        )
+        self._latency: Dict[str, LatencyWindow] = {}
+        self.stats_cache_ttl = float(os.environ.get('STATS_CACHE_TTL', '10'))
+        self._stats_lock = threading.Lock()
+        self._stats_cache: Optional[Dict] = None
+        self._stats_cached_at = 0.0
+        self.client = None
+        self.http_client = None
+        self.spool: Optional[PredictionSpool] = None
+        if hasattr(os, 'register_at_fork'):
+            # fork 後の子プロセスで親の接続プールを共有しない
+            os.register_at_fork(after_in_child=self._reconnect_in_child)
+        if connect:
+            self.connect()
+
+    def connect(self) -> bool:
+        """Supabaseクライアントを作成する（作成済みなら何もしない）"""
+        if self.client is not None:
+            return True
         if not self.supabase_url or not self.supabase_key:
             logger.warning("Supabase credentials not found. Database features disabled.")
+            return False
+        try:
+            import httpx
+            from supabase import create_client
+            from supabase.lib.client_options import SyncClientOptions
+            self.http_client = httpx.Client(
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                follow_redirects=True
+            )
+            self.client = create_client(self.supabase_url, self.supabase_key,
+                                        options=SyncClientOptions(httpx_client=self.http_client))
+            logger.info("Supabase client initialized successfully")
+            return True
+        except (ImportError, TypeError) as e:
+            # SyncClientOptions(httpx_client=...) は supabase 2.16.0 から
+            logger.error(f"Failed to initialize Supabase client (requires supabase>=2.16.0 and httpx, "
+                         f"see requirements.txt); prediction logging is disabled: {e}")
             self.client = None
-        else:
+            self.http_client = None
+            return False
+        except Exception as e:
+            logger.error(f"Failed to initialize Supabase client: {e}")
+            self.client = None
+            self.http_client = None
+            return False
+
+    def _reconnect_in_child(self) -> None:
+        if self.client is not None:
+            self.client = None
+            self.http_client = None
+            self.connect()
+
+    def _execute(self, operation: str, build: Callable, idempotent: bool = False):
+        """
+        クエリを実行する（ブレーカーが開いていれば CircuitOpenError）
+
+        Args:
+            operation (str): 統計・メトリクスのラベル
+            build: 実行するクエリを組み立てる関数（リトライのたびに呼ぶ）
+            idempotent (bool): True なら失敗時にバックオフしてリトライする（読み取り・idempotency_key 付きの挿入）
+        """
+        delays = backoff_delays(self.read_retries if idempotent else 0)
+        while True:
+            if not self.breaker.allow():
+                self._record(operation, 'open', None)
+                raise CircuitOpenError(f"Supabase circuit breaker is open ({operation})")
+            start = time.perf_counter()
             try:
-                self.client: Client = create_client(self.supabase_url, self.supabase_key)
-                logger.info("Supabase client initialized successfully")
+                result = build().execute()
             except Exception as e:
-                logger.error(f"Failed to initialize Supabase client: {e}")
-                self.client = None
+                elapsed = time.perf_counter() - start
+                if is_data_error(e):
+                    # Supabase は応答している（行の値が悪い）。ブレーカーの失敗に数えず、リトライもしない
+                    self.breaker.record_success()
+                    self._record(operation, 'rejected', elapsed)
+                    raise
+                self.breaker.record_failure()
+                delay = next(delays, None)
+                self._record(operation, 'error' if delay is None else 'retry', elapsed)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self._record(operation, 'ok', time.perf_counter() - start)
+            return result
+
+    def _record(self, operation: str, result: str, seconds: Optional[float]) -> None:
+        window = self._latency.get(operation)
+        if window is None:
+            window = self._latency.setdefault(operation, LatencyWindow())
+        window.record(seconds * 1000 if seconds is not None else None, result)
+        record_supabase_call(operation, result, seconds or 0.0)
+
+    def _log_failure(self, message: str, e: Exception) -> None:
+        # ブレーカーが開いている間はエラーログを出し続けない
+        if isinstance(e, CircuitOpenError):
+            logger.debug(f"{message}: {e}")
+        else:
+            logger.error(f"{message}: {e}")
+
+    def stats(self) -> Dict:
+        """ブレーカーの状態と操作ごとの呼び出し件数・レイテンシ"""
+        return {
+            'available': self.is_available(),
+            'breaker': self.breaker.stats(),
+            'timeout_s': self.timeout,
+            'read_retries': self.read_retries,
+            'operations': {name: window.stats() for name, window in sorted(self._latency.items())},
+            'spool': self.spool.stats() if self.spool is not None else None
+        }
+
+    def attach_spool(self, spool: PredictionSpool) -> None:
+        """予測ログをスプール経由で書き込むようにする"""
+        self.spool = spool
 
     def is_available(self) -> bool:
         """Supabaseが利用可能かチェック"""
         return self.client is not None
 
-    def log_prediction(self, prediction_data: Dict) -> bool:
+    def log_prediction(self, prediction_data: Dict, model_version: Optional[str] = None) -> bool:
         """
         予測結果をSupabaseに記録
 
         Args:
             prediction_data (dict): 予測データ
+            model_version (str): 予測したモデルのバージョン（指紋に含める）
+
+        Returns:
+            bool: 記録成功かどうか
+        """
+        return self.log_predictions([prediction_data], model_version)
+
+    def log_predictions(self, predictions: List[Dict], model_version: Optional[str] = None) -> bool:
+        """
+        1リクエスト分の予測結果をまとめてSupabaseに記録
+
+        同じ指紋（モデルのバージョン・予測日・特徴量）の予測は1行にまとめ、既にある行は
+        hit_count と last_seen_at を更新する。
+
+        Args:
+            predictions (list): 予測データのリスト
+            model_version (str): 予測したモデルのバージョン
 
         Returns:
             bool: 記録成功かどうか
@@ -45,34 +209,43 @@ class SupabaseService:
             return False
 
         try:
-            # 予測ログデータを準備
-            log_data = {
-                'prediction_date': prediction_data.get('date'),
-                'predicted_value': prediction_data.get('prediction'),
-                'total_outpatient': prediction_data.get('features', {}).get('total_outpatient'),
-                'intro_outpatient': prediction_data.get('features', {}).get('intro_outpatient'),
-                'er_patients': prediction_data.get('features', {}).get('ER'),
-                'bed_count': prediction_data.get('features', {}).get('bed_count'),
-                'public_holiday': prediction_data.get('features', {}).get('public_holiday', False),
-                'day_of_week': prediction_data.get('day'),
-                'features': json.dumps(prediction_data.get('features', {}))
-            }
-
-            # Supabaseに挿入
-            result = self.client.table('prediction_logs').insert(log_data).execute()
-            logger.info("Prediction logged to Supabase successfully")
+            rows = merge_duplicates([prediction_log_row(p, model_version) for p in predictions])
+            if self.spool is not None:
+                # ローカルに書くだけで返り、バックグラウンドで一括 upsert する
+                self.spool.extend(rows)
+                return True
+
+            rows = valid_log_rows(rows)
+            if not rows:
+                return False
+            self.insert_prediction_logs(rows)
+            logger.info(f"Logged {len(rows)} predictions to Supabase")
             return True
 
         except Exception as e:
-            logger.error(f"Error logging prediction to Supabase: {e}")
+            self._log_failure("Error logging prediction to Supabase", e)
             return False
 
-    def get_prediction_history(self, limit: int = 100) -> List[Dict]:
+    def insert_prediction_logs(self, rows: List[Dict]) -> None:
+        """
+        予測ログをまとめて upsert する（スプールの送信先。失敗時は例外）
+
+        sql/prediction_logs.sql の upsert_prediction_logs 関数を呼ぶ。受け取り済みの idempotency_key の行は
+        無視するため、同じ行を再送しても hit_count は二重に数えない。
+        """
+        if not self.client:
+            raise RuntimeError("Supabase not available")
+        rows = [row if 'idempotency_key' in row else {**row, 'idempotency_key': uuid.uuid4().hex} for row in rows]
+        self._execute('insert_prediction_logs', lambda: self.client.rpc('upsert_prediction_logs', {'payload': rows}),
+                      idempotent=True)
+
+    def get_prediction_history(self, limit: int = 100, query: Optional[HistoryQuery] = None) -> List[Dict]:
         """
-        予測履歴を取得
+        予測履歴を取得（created_at・id の降順）
 
         Args:
-            limit (int): 取得する件数
+            limit (int): 取得する件数（query を指定しない場合）
+            query (HistoryQuery): カーソル・予測日の範囲・曜日・列の指定
 
         Returns:
             list: 予測履歴のリスト
@@ -81,18 +254,40 @@ class SupabaseService:
             return []
 
         try:
-            result = self.client.table('prediction_logs') \
-                .select('*') \
-                .order('created_at', desc=True) \
-                .limit(limit) \
-                .execute()
-
-            return result.data
+            return self._fetch_history(query or HistoryQuery(limit=limit))
 
         except Exception as e:
-            logger.error(f"Error fetching prediction history: {e}")
+            self._log_failure(f"Error fetching prediction history", e)
             return []
 
+    def iter_prediction_history(self, query: HistoryQuery) -> Iterator[Dict]:
+        """
+        予測履歴を1ページずつ取り出して返す（エクスポート用、失敗は例外のまま呼び出し元へ）
+
+        PostgREST にはサーバー側カーソルが無いため、キーセットで HISTORY_EXPORT_PAGE_SIZE 件ずつ取る。
+        """
+        if not self.client:
+            raise RuntimeError("Supabase not available")
+        return iter_pages(self._fetch_history, query)
+
+    def _fetch_history(self, query: HistoryQuery) -> List[Dict]:
+        def build():
+            request = self.client.table('prediction_logs').select(','.join(query.select_columns()))
+            if query.date_from:
+                request = request.gte('prediction_date', query.date_from)
+            if query.date_to:
+                request = request.lte('prediction_date', query.date_to)
+            if query.days:
+                request = request.in_('day_of_week', query.days)
+            if query.after:
+                created_at, row_id = query.after
+                request = request.or_(f'created_at.lt."{created_at}",'
+                                      f'and(created_at.eq."{created_at}",id.lt.{row_id})')
+            request = request.order('created_at', desc=True).order('id', desc=True)
+            return request.limit(query.limit) if query.limit is not None else request
+
+        return self._execute('get_prediction_history', build, idempotent=True).data
+
     def get_app_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
         """
         アプリケーション設定を取得
@@ -108,17 +303,16 @@ class SupabaseService:
             return default
 
         try:
-            result = self.client.table('app_settings') \
-                .select('setting_value') \
-                .eq('setting_key', key) \
-                .execute()
+            result = self._execute('get_app_setting', lambda: self.client.table('app_settings')
+                                   .select('setting_value')
+                                   .eq('setting_key', key), idempotent=True)
 
             if result.data:
                 return result.data[0]['setting_value']
             return default
 
         except Exception as e:
-            logger.error(f"Error getting app setting {key}: {e}")
+            self._log_failure(f"Error getting app setting {key}", e)
             return default
 
     def set_app_setting(self, key: str, value: str, description: str = None) -> bool:
@@ -138,10 +332,9 @@ class SupabaseService:
 
         try:
             # 既存の設定があるかチェック
-            existing = self.client.table('app_settings') \
-                .select('id') \
-                .eq('setting_key', key) \
-                .execute()
+            existing = self._execute('set_app_setting', lambda: self.client.table('app_settings')
+                                     .select('id')
+                                     .eq('setting_key', key), idempotent=True)
 
             data = {
                 'setting_key': key,
@@ -154,20 +347,17 @@ class SupabaseService:
 
             if existing.data:
                 # 更新
-                result = self.client.table('app_settings') \
-                    .update(data) \
-                    .eq('setting_key', key) \
-                    .execute()
+                self._execute('set_app_setting', lambda: self.client.table('app_settings')
+                              .update(data)
+                              .eq('setting_key', key))
             else:
                 # 新規作成
-                result = self.client.table('app_settings') \
-                    .insert(data) \
-                    .execute()
+                self._execute('set_app_setting', lambda: self.client.table('app_settings').insert(data))
 
             return True
 
         except Exception as e:
-            logger.error(f"Error setting app setting {key}: {e}")
+            self._log_failure(f"Error setting app setting {key}", e)
             return False
 
     def cache_scenario_data(self, scenario_data: List[Dict], data_hash: str) -> bool:
@@ -192,27 +382,23 @@ class SupabaseService:
             }
 
             # 既存データがあるかチェック
-            existing = self.client.table('scenario_cache') \
-                .select('id') \
-                .eq('data_hash', data_hash) \
-                .execute()
+            existing = self._execute('cache_scenario_data', lambda: self.client.table('scenario_cache')
+                                     .select('id')
+                                     .eq('data_hash', data_hash), idempotent=True)
 
             if existing.data:
                 # 更新
-                result = self.client.table('scenario_cache') \
-                    .update(data) \
-                    .eq('data_hash', data_hash) \
-                    .execute()
+                self._execute('cache_scenario_data', lambda: self.client.table('scenario_cache')
+                              .update(data)
+                              .eq('data_hash', data_hash))
             else:
                 # 新規作成
-                result = self.client.table('scenario_cache') \
-                    .insert(data) \
-                    .execute()
+                self._execute('cache_scenario_data', lambda: self.client.table('scenario_cache').insert(data))
 
             return True
 
         except Exception as e:
-            logger.error(f"Error caching scenario data: {e}")
+            self._log_failure(f"Error caching scenario data", e)
             return False
 
     def get_cached_scenario_data(self, data_hash: str) -> Optional[List[Dict]]:
@@ -229,48 +415,52 @@ class SupabaseService:
             return None
 
         try:
-            result = self.client.table('scenario_cache') \
-                .select('scenario_data') \
-                .eq('data_hash', data_hash) \
-                .execute()
+            result = self._execute('get_cached_scenario_data', lambda: self.client.table('scenario_cache')
+                                   .select('scenario_data')
+                                   .eq('data_hash', data_hash), idempotent=True)
 
             if result.data:
                 return json.loads(result.data[0]['scenario_data'])
             return None
 
         except Exception as e:
-            logger.error(f"Error getting cached scenario data: {e}")
+            self._log_failure(f"Error getting cached scenario data", e)
             return None
 
     def get_stats(self) -> Dict:
         """
         統計情報を取得
 
+        件数や日別・モデル別・曜日別の集計は、prediction_logs のトリガーが増分更新する集計テーブルを
+        get_prediction_stats 関数（sql/prediction_logs.sql）で1回の往復で読む。結果は STATS_CACHE_TTL 秒
+        プロセス内に保持し、同時に来たリクエストは1件だけが問い合わせる。
+
         Returns:
             dict: 統計情報
         """
         if not self.client:
             return {"error": "Supabase not available"}
 
-        try:
-            # 予測ログの統計
-            total_predictions = self.client.table('prediction_logs') \
-                .select('id', count='exact') \
-                .execute()
-
-            # 直近の予測
-            recent_predictions = self.client.table('prediction_logs') \
-                .select('*') \
-                .order('created_at', desc=True) \
-                .limit(5) \
-                .execute()
-
-            return {
-                "total_predictions": total_predictions.count if hasattr(total_predictions, 'count') else 0,
-                "recent_predictions": recent_predictions.data,
-                "database_status": "connected"
-            }
-
-        except Exception as e:
-            logger.error(f"Error getting stats: {e}")
-            return {"error": str(e)}
\ No newline at end of file
+        with self._stats_lock:
+            if self._stats_cache is not None and time.monotonic() - self._stats_cached_at < self.stats_cache_ttl:
+                return self._stats_cache
+            try:
+                result = self._execute('get_stats', lambda: self.client.rpc('get_prediction_stats', {}),
+                                       idempotent=True)
+                summary = result.data or {}
+                stats = {
+                    # リクエスト数（まとめた予測の hit_count の合計）
+                    "total_predictions": summary.get('total_requests', 0),
+                    "unique_predictions": summary.get('unique_predictions', 0),
+                    "recent_predictions": summary.get('recent_predictions', []),
+                    "daily": summary.get('daily', []),
+                    "by_model_version": summary.get('by_model_version', []),
+                    "by_weekday": summary.get('by_weekday', []),
+                    "database_status": "connected"
+                }
+            except Exception as e:
+                self._log_failure(f"Error getting stats", e)
+                return {"error": str(e)}
+            self._stats_cache = stats
+            self._stats_cached_at = time.monotonic()
+            return stats
\ No newline at end of file
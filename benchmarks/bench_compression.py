@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+レスポンス圧縮のベンチマーク（CPU時間 と 転送バイト数のトレードオフ）
+
+月間予測（既定形式・カラムナ形式）と予測履歴の代表的なペイロードを
+ultimate_pickup_data.csv から組み立て、gzip / brotli の各レベルで
+圧縮後サイズと圧縮・展開時間を計測する。モデルファイルは不要。
+
+使い方:
+    python benchmarks/bench_compression.py [--repeat 50] [--json out.json]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import pandas as pd  # noqa: E402
+
+from compression import HAS_BROTLI, compress_bytes  # noqa: E402
+from response_format import dumps, to_columnar  # noqa: E402
+
+DAY_CODES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+DAY_LABELS = ['月', '火', '水', '木', '金', '土', '日']
+
+
+def build_month_payload(df: pd.DataFrame) -> dict:
+    """CSVの実測値から月間予測と同じ形のレスポンスを作る"""
+    rows = df.head(31)
+    predictions = []
+    for day, (_, row) in enumerate(rows.iterrows(), start=1):
+        weekday = [row[c] for c in DAY_CODES].index(1)
+        is_weekend = weekday >= 5
+        predictions.append({
+            'date': f"2025-05-{day:02d}",
+            'day': day,
+            'day_of_week': weekday,
+            'day_label': DAY_LABELS[weekday],
+            'prediction': float(row['y']),
+            'is_weekend': is_weekend,
+            'is_holiday': bool(row['public_holiday']),
+            'model_used': 'randomforest',
+            'features': {
+                'total_outpatient': int(row['total_outpatient']),
+                'intro_outpatient': int(row['intro_outpatient']),
+                'ER': int(row['ER']),
+                'bed_count': int(row['bed_count']),
+                'public_holiday': int(row['public_holiday'])
+            }
+        })
+    return {'year': 2025, 'month': 5, 'month_name': '2025年5月', 'predictions': predictions}
+
+
+def build_history_payload(df: pd.DataFrame, limit: int = 1000) -> dict:
+    """prediction_logs の行と同じ形の履歴レスポンスを作る"""
+    history = []
+    for i, (_, row) in enumerate(df.head(limit).iterrows(), start=1):
+        features = {k: int(row[k]) for k in df.columns if k not in ('date', 'y')}
+        history.append({
+            'id': i,
+            'prediction_date': str(row['date']),
+            'predicted_value': float(row['y']),
+            'total_outpatient': features['total_outpatient'],
+            'intro_outpatient': features['intro_outpatient'],
+            'er_patients': features['ER'],
+            'bed_count': features['bed_count'],
+            'public_holiday': bool(features['public_holiday']),
+            'day_of_week': None,
+            'features': json.dumps(features),
+            'created_at': '2025-05-01T09:00:00.000000+00:00'
+        })
+    return {'history': history, 'count': len(history)}
+
+
+def measure(data: bytes, encoding: str, level: int, repeat: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        compressed = compress_bytes(data, encoding, level=level, br_quality=level)
+    compress_ms = (time.perf_counter() - start) * 1000 / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if encoding == 'br':
+            import brotli  # type: ignore
+            brotli.decompress(compressed)
+        else:
+            gzip.decompress(compressed)
+    decompress_ms = (time.perf_counter() - start) * 1000 / repeat
+
+    return {
+        'encoding': encoding,
+        'level': level,
+        'bytes': len(compressed),
+        'ratio': round(len(data) / len(compressed), 2),
+        'compress_ms': round(compress_ms, 3),
+        'decompress_ms': round(decompress_ms, 3)
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='レスポンス圧縮ベンチマーク')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    df = pd.read_csv(os.path.join(ROOT, 'ultimate_pickup_data.csv')).dropna()
+    month = build_month_payload(df)
+    payloads = {
+        'month': dumps(month),
+        'month_columnar': dumps(to_columnar(month)),
+        'history_1000': dumps(build_history_payload(df))
+    }
+
+    settings = [('gzip', 1), ('gzip', 6), ('gzip', 9)]
+    if HAS_BROTLI:
+        settings += [('br', 1), ('br', 4), ('br', 11)]
+
+    results = {}
+    for name, data in payloads.items():
+        results[name] = {'raw_bytes': len(data), 'runs': [measure(data, enc, lvl, args.repeat) for enc, lvl in settings]}
+        print(f"\n{name}: {len(data)} bytes")
+        print(f"  {'encoding':<8} {'level':>5} {'bytes':>8} {'ratio':>6} {'comp ms':>8} {'decomp ms':>9}")
+        for run in results[name]['runs']:
+            print(f"  {run['encoding']:<8} {run['level']:>5} {run['bytes']:>8} {run['ratio']:>6} "
+                  f"{run['compress_ms']:>8} {run['decompress_ms']:>9}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ホットパスのベンチマーク（レイテンシ・スループット・割り当て量）
+
+backend/app.py と simple_server.py を Flask のテストクライアントで直接呼び出し、
+単日・週間・月間予測（RandomForest / Prophet）、シナリオ一覧、一括予測、
+特徴量エンコード、祝日判定を計測する。ネットワークや Supabase には依存しない。
+
+モデルファイルはリポジトリに含まれないため、--model か RF_MODEL_PATH で
+fixed_rf_model.joblib のパスを指定する（Prophet は PROPHET_MODEL_PATH があれば計測）。
+
+結果を --save-baseline で保存しておき、変更後に --baseline で比較すると、
+p95 が --threshold（既定 20%）を超えて悪化したケースがあれば終了コード 1 を返す。
+
+使い方:
+    python benchmarks/bench_hotpaths.py --model fixed_rf_model.joblib --save-baseline benchmarks/results/baseline.json
+    python benchmarks/bench_hotpaths.py --model fixed_rf_model.joblib --baseline benchmarks/results/baseline.json
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import date, timedelta
+
+from harness import BACKEND_DIR, ROOT, compare, load_results, print_table, quiet, run_case, save_results
+
+SCENARIO_COUNT = 100
+
+
+def load_apps(model_path: str):
+    """backend/app.py と simple_server.py を読み込み、同じモデルを使うようにする"""
+    os.environ['RF_MODEL_PATH'] = model_path
+    # 同じ入力を繰り返すため、予測キャッシュは切って毎回の推論を測る
+    os.environ.setdefault('PREDICTION_CACHE_SIZE', '0')
+    # backend/app.py は backend/ をカレントディレクトリとして相対パスを解決する
+    os.chdir(BACKEND_DIR)
+    sys.path.insert(0, BACKEND_DIR)
+    sys.path.insert(0, ROOT)
+    with quiet():
+        import app as backend_app
+        import simple_server
+        simple_server.load_model()
+        # モデルは起動ステップでバックグラウンドにロードされるため、完了を待ってから計測する
+        backend_app.warmup.wait()
+    # 計測中のリクエストログはノイズになるため止める
+    logging.disable(logging.CRITICAL)
+    return backend_app, simple_server
+
+
+def build_cases(backend_app, simple_server) -> dict:
+    backend = backend_app.app.test_client()
+    simple = simple_server.app.test_client()
+
+    def check(response):
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.request.path} -> {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+    single = {
+        'date': '2025-05-12', 'total_outpatient': 520, 'intro_outpatient': 22,
+        'ER': 16, 'bed_count': 280, 'public_holiday': 0
+    }
+    start = date(2025, 5, 1)
+    scenarios = [
+        {
+            'name': f'シナリオ{i + 1}',
+            'date': (start + timedelta(days=i)).isoformat(),
+            'total_outpatient': 400 + i, 'intro_outpatient': 15 + i % 10,
+            'ER': 10 + i % 20, 'bed_count': 260 + i % 40
+        }
+        for i in range(SCENARIO_COUNT)
+    ]
+    year_dates = [(date(2025, 1, 1) + timedelta(days=i)).isoformat() for i in range(365)]
+
+    cases = {
+        'predict_single': (lambda: check(backend.post('/api/predict', json=single)), 1),
+        'predict_week_rf': (lambda: check(backend.post('/api/predict_week', json={'start_date': '2025-05-12'})), 7),
+        'predict_month_rf': (
+            lambda: check(backend.post('/api/predict_month', json={'year': 2025, 'month': 5, 'model_type': 'randomforest'})),
+            31
+        ),
+        'scenarios': (lambda: check(backend.get('/api/scenarios')), 1),
+        'simple_predict_batch': (
+            lambda: check(simple.post('/api/predict_batch', json={'scenarios': scenarios})), SCENARIO_COUNT
+        ),
+        'feature_encoding': (lambda: encode_features(simple_server, year_dates), len(year_dates)),
+        'holiday_lookup': (lambda: lookup_holidays(backend_app, year_dates), len(year_dates))
+    }
+    if backend_app.prophet_model is not None:
+        cases['predict_month_prophet'] = (
+            lambda: check(backend.post('/api/predict_month', json={'year': 2025, 'month': 5, 'model_type': 'prophet'})),
+            31
+        )
+    return cases
+
+
+def encode_features(simple_server, dates):
+    """日付ごとの曜日エンコードと DataFrame 化（一括予測の前処理に相当）"""
+    import pandas as pd
+    rows = []
+    for date_str in dates:
+        day_features, _ = simple_server.get_day_features(date_str)
+        rows.append({**day_features, 'public_holiday': 0, 'public_holiday_previous_day': 0,
+                     'total_outpatient': 500, 'intro_outpatient': 20, 'ER': 15, 'bed_count': 280})
+    return pd.DataFrame(rows)
+
+
+def lookup_holidays(backend_app, dates):
+    for date_str in dates:
+        backend_app.is_japanese_holiday(date_str)
+        backend_app.is_previous_day_holiday(date_str)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='ホットパスのベンチマーク')
+    parser.add_argument('--model', default=os.environ.get('RF_MODEL_PATH', os.path.join(ROOT, 'fixed_rf_model.joblib')),
+                        help='RandomForest モデル（fixed_rf_model.joblib）のパス')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='計測するケース名')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    parser.add_argument('--save-baseline', help='結果をベースラインとして保存するJSONファイル')
+    parser.add_argument('--baseline', help='比較するベースラインJSONファイル')
+    parser.add_argument('--threshold', type=float, default=float(os.environ.get('BENCH_REGRESSION_THRESHOLD', 0.2)),
+                        help='許容する p95 の悪化率（既定: 0.2 = 20%%）')
+    args = parser.parse_args()
+
+    model_path = os.path.abspath(args.model)
+    if not os.path.exists(model_path):
+        print(f"モデルファイルが見つかりません: {model_path}（--model か RF_MODEL_PATH で指定してください）")
+        return 2
+    # 出力ファイルは chdir 前の相対パスで解決する
+    outputs = {k: os.path.abspath(v) if v else None for k, v in
+               (('json', args.json), ('save_baseline', args.save_baseline), ('baseline', args.baseline))}
+
+    backend_app, simple_server = load_apps(model_path)
+    cases = build_cases(backend_app, simple_server)
+    if args.only:
+        cases = {name: case for name, case in cases.items() if name in args.only}
+
+    results = {}
+    for name, (func, units) in cases.items():
+        print(f"running {name} ...", file=sys.stderr)
+        results[name] = run_case(func, args.iterations, warmup=args.warmup, units=units)
+    print_table(results)
+
+    for key in ('json', 'save_baseline'):
+        if outputs[key]:
+            save_results(outputs[key], results)
+
+    if outputs['baseline']:
+        baseline = load_results(outputs['baseline'])
+        if baseline is None:
+            print(f"ベースラインが見つかりません: {outputs['baseline']}")
+            return 2
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n性能の劣化を検出しました（閾値 {args.threshold:.0%}）:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nベースラインとの比較: 劣化なし（閾値 {args.threshold:.0%}）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
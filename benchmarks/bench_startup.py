@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+起動時間の計測と予算チェック
+
+新しい Python プロセスで backend/app.py を import し、
+- import にかかった時間（ワーカーがリクエストを受け付けられるまで）
+- 起動ステップ（モデルのロードなど）が終わり /api/health が healthy になるまでの時間
+- import 時点で読み込まれてしまった重いモジュール（scikit-learn・pandas・supabase など）
+を --runs 回計測して中央値を表示する。-X importtime の結果から、import に時間のかかった
+モジュールの上位も表示する。
+
+import 時間が --import-budget-ms、準備完了までの時間が --ready-budget-ms を超えるか、
+--forbid のモジュールが import 時点で読み込まれていたら終了コード 1 を返す（CI で起動時間の劣化を検出する）。
+
+使い方:
+    python benchmarks/bench_startup.py --model fixed_rf_model.joblib
+    python benchmarks/bench_startup.py --model backend/models/fixed_rf_model.npz --import-budget-ms 500 --ready-budget-ms 1000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from harness import BACKEND_DIR, ROOT, environment
+
+# import 時点で読み込まれていてはいけない重いモジュール（起動ステップか初回利用時に import する）
+DEFAULT_FORBID = 'sklearn,scipy,pandas,supabase,joblib'
+
+# 子プロセスで実行する計測スクリプト
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+forbid = [m for m in sys.argv[1].split(',') if m]
+loaded = [m for m in forbid if m in sys.modules]
+ready = app.warmup.wait(float(sys.argv[2]))
+finished = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'ready_ms': (finished - start) * 1000,
+    'ready': ready,
+    'loaded_at_import': loaded,
+    'startup': app.warmup.status()
+}))
+'''
+
+
+def probe_env(model_path: str) -> dict:
+    return dict(
+        os.environ,
+        RF_MODEL_PATH=model_path,
+        STARTUP_MODE='background',
+        PYTHONWARNINGS='ignore',
+        # 計測中は Supabase に接続しない
+        SUPABASE_URL='',
+        SUPABASE_KEY=''
+    )
+
+
+def run_probe(model_path: str, forbid: str, timeout: float) -> dict:
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE, forbid, str(timeout)],
+        cwd=BACKEND_DIR, env=probe_env(model_path), capture_output=True, text=True, timeout=timeout + 60
+    )
+    lines = [line for line in result.stdout.splitlines() if line.startswith('{')]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"計測プロセスが失敗しました: {result.stderr[-2000:]}")
+    return json.loads(lines[-1])
+
+
+def import_profile(model_path: str, top: int) -> list:
+    """-X importtime の結果から、累積時間の大きいトップレベルの import を返す"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=BACKEND_DIR, env=probe_env(model_path), capture_output=True, text=True, timeout=120
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # 行の形式は "import time: self | cumulative | <1 + 2*深さ 個の空白>モジュール名"
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        # app が直接 import したモジュール（インデント1段）だけを集計する
+        if depth == 1:
+            rows.append({'module': name, 'cumulative_ms': int(cumulative_us) / 1000, 'self_ms': int(self_us) / 1000})
+    return sorted(rows, key=lambda r: r['cumulative_ms'], reverse=True)[:top]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='起動時間の計測と予算チェック')
+    parser.add_argument('--model', default=os.environ.get('RF_MODEL_PATH', os.path.join(ROOT, 'fixed_rf_model.joblib')),
+                        help='RandomForest モデル（.joblib または .npz）のパス')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--import-budget-ms', type=float, default=float(os.environ.get('STARTUP_IMPORT_BUDGET_MS', 800)),
+                        help='app.py の import 時間の上限（中央値、ms）')
+    parser.add_argument('--ready-budget-ms', type=float, default=float(os.environ.get('STARTUP_READY_BUDGET_MS', 0)),
+                        help='準備完了までの時間の上限（中央値、ms。0 でチェックしない）')
+    parser.add_argument('--forbid', default=DEFAULT_FORBID, help='import 時点で読み込まれていてはいけないモジュール（カンマ区切り）')
+    parser.add_argument('--timeout', type=float, default=120.0, help='準備完了を待つ最大秒数')
+    parser.add_argument('--top', type=int, default=10, help='表示する import の上位件数')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    model_path = os.path.abspath(args.model)
+    if not os.path.exists(model_path):
+        print(f"モデルファイルが見つかりません: {model_path}（--model か RF_MODEL_PATH で指定してください）")
+        return 2
+
+    runs = [run_probe(model_path, args.forbid, args.timeout) for _ in range(max(1, args.runs))]
+    import_ms = statistics.median(r['import_ms'] for r in runs)
+    ready_ms = statistics.median(r['ready_ms'] for r in runs)
+    last = runs[-1]
+    profile = import_profile(model_path, args.top)
+
+    print(f"import app:      {import_ms:8.1f} ms（予算 {args.import_budget_ms:.0f} ms）")
+    ready_budget = f"予算 {args.ready_budget_ms:.0f} ms" if args.ready_budget_ms else '予算なし'
+    print(f"準備完了まで:    {ready_ms:8.1f} ms（{ready_budget}、状態: {last['startup']['state']}）")
+    for name, ms in last['startup']['steps'].items():
+        print(f"  step {name:<20} {ms:8.1f} ms")
+    print('\nimport 時間の上位（app が直接 import したモジュール、累積）:')
+    for row in profile:
+        print(f"  {row['module']:<24} {row['cumulative_ms']:8.1f} ms")
+
+    failures = []
+    if import_ms > args.import_budget_ms:
+        failures.append(f"import 時間 {import_ms:.1f} ms が予算 {args.import_budget_ms:.0f} ms を超えています")
+    if args.ready_budget_ms and ready_ms > args.ready_budget_ms:
+        failures.append(f"準備完了までの時間 {ready_ms:.1f} ms が予算 {args.ready_budget_ms:.0f} ms を超えています")
+    if not all(r['ready'] for r in runs):
+        failures.append(f"起動ステップが完了しませんでした: {last['startup']}")
+    loaded = sorted({m for r in runs for m in r['loaded_at_import']})
+    if loaded:
+        failures.append(f"import 時点で重いモジュールが読み込まれています: {', '.join(loaded)}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'environment': environment(),
+                'import_ms': import_ms,
+                'ready_ms': ready_ms,
+                'runs': runs,
+                'import_profile': profile,
+                'budget': {'import_ms': args.import_budget_ms, 'ready_ms': args.ready_budget_ms},
+                'failures': failures
+            }, f, ensure_ascii=False, indent=2)
+
+    if failures:
+        print('\n起動時間の予算を超えました:')
+        for line in failures:
+            print(f"  {line}")
+        return 1
+    print('\n起動時間: 予算内')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
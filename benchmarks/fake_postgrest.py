@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカル用の Supabase/PostgREST 代替サーバー（負荷試験用）
+
+SupabaseService が使う範囲の PostgREST API（/rest/v1/<table> への
+GET/POST/PATCH/DELETE、select・order・limit・offset・eq/neq/gt/gte/lt/lte/in フィルタと or/and、
+Prefer: count=exact の Content-Range、on_conflict と Prefer: resolution による upsert、
+rpc/upsert_prediction_logs・rpc/get_prediction_stats）をメモリ上のテーブルで再現する。
+
+応答ごとに固定レイテンシ＋ジッタ、一定割合の遅延スパイク、エラー応答を注入できるため、
+ネットワーク越しの Supabase の往復がバックエンドに与える影響をオフラインで測れる。
+
+使い方（単体起動）:
+    python benchmarks/fake_postgrest.py --port 54321 --latency-ms 20 --jitter-ms 10 --error-rate 0.01
+    SUPABASE_URL=http://127.0.0.1:54321 SUPABASE_KEY=dummy gunicorn app:app
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+REST_PREFIX = '/rest/v1/'
+FILTER_OPERATORS = ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'in', 'is')
+
+
+class FaultConfig:
+    """レイテンシ・エラー注入の設定"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, spike_rate: float = 0.0, spike_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.spike_rate = spike_rate
+        self.spike_ms = spike_ms
+
+    def delay(self) -> float:
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if self.spike_rate and random.random() < self.spike_rate:
+            delay_ms += self.spike_ms
+        return delay_ms / 1000.0
+
+    def should_fail(self) -> bool:
+        return bool(self.error_rate) and random.random() < self.error_rate
+
+    def to_dict(self) -> Dict:
+        return dict(vars(self))
+
+
+class MemoryStore:
+    """テーブル名 -> 行リストのインメモリストア"""
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict]] = {}
+        self.next_ids: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def insert(self, table: str, rows: List[Dict], on_conflict: Optional[str] = None,
+               resolution: Optional[str] = None) -> List[Dict]:
+        """行を挿入する（on_conflict の列が同じ行があれば resolution に従って無視（ignore）または上書き（merge））"""
+        now = datetime.now(timezone.utc).isoformat()
+        inserted = []
+        with self.lock:
+            target = self.tables.setdefault(table, [])
+            existing = {}
+            if on_conflict:
+                columns = on_conflict.split(',')
+                existing = {tuple(r.get(c) for c in columns): r for r in target}
+            for row in rows:
+                key = tuple(row.get(c) for c in columns) if on_conflict else None
+                if key in existing:
+                    if resolution == 'merge':
+                        existing[key].update(row)
+                        inserted.append(dict(existing[key]))
+                    continue
+                self.next_ids[table] += 1
+                record = {'id': self.next_ids[table], 'created_at': now, **row}
+                target.append(record)
+                inserted.append(dict(record))
+                if on_conflict:
+                    existing[key] = record
+        return inserted
+
+    def upsert_prediction_logs(self, rows: List[Dict]) -> int:
+        """backend/sql/prediction_logs.sql の upsert_prediction_logs 関数と同じ処理（受け取り済みのキーを無視し、指紋でまとめる）"""
+        with self.lock:
+            receipts = self.tables.setdefault('prediction_log_receipts', [])
+            received = {r['idempotency_key'] for r in receipts}
+            logs = self.tables.setdefault('prediction_logs', [])
+            by_fingerprint = {r.get('fingerprint'): r for r in logs if r.get('fingerprint')}
+            affected = 0
+            for row in rows:
+                if row.get('idempotency_key') in received:
+                    continue
+                received.add(row.get('idempotency_key'))
+                receipts.append({'idempotency_key': row.get('idempotency_key')})
+                row = {k: v for k, v in row.items() if k != 'idempotency_key'}
+                current = by_fingerprint.get(row.get('fingerprint'))
+                if current is not None:
+                    current['hit_count'] = current.get('hit_count', 1) + row.get('hit_count', 1)
+                    current['last_seen_at'] = max(current.get('last_seen_at') or '', row.get('last_seen_at') or '')
+                    current['predicted_value'] = row.get('predicted_value')
+                else:
+                    self.next_ids['prediction_logs'] += 1
+                    current = {'id': self.next_ids['prediction_logs'], **row}
+                    logs.append(current)
+                    if row.get('fingerprint'):
+                        by_fingerprint[row['fingerprint']] = current
+                affected += 1
+            return affected
+
+    def prediction_stats(self, days: int = 30) -> Dict:
+        """backend/sql/prediction_logs.sql の get_prediction_stats 関数と同じ形の集計（集計テーブルの代わりに毎回数える）"""
+        with self.lock:
+            logs = [dict(r) for r in self.tables.get('prediction_logs', [])]
+        groups: Dict[str, Dict] = {'daily': {}, 'by_model_version': {}, 'by_weekday': {}}
+        for row in logs:
+            hits = row.get('hit_count', 1)
+            value = row.get('predicted_value') or 0.0
+            keys = {
+                'daily': ('day', (row.get('last_seen_at') or row.get('created_at') or '')[:10]),
+                'by_model_version': ('model_version', row.get('model_version') or 'unknown'),
+                'by_weekday': ('weekday', date.fromisoformat(row['prediction_date']).isoweekday())
+            }
+            for group, (column, key) in keys.items():
+                stats = groups[group].setdefault(key, {column: key, 'requests': 0, 'unique_predictions': 0,
+                                                       'predicted_sum': 0.0, 'predicted_min': value,
+                                                       'predicted_max': value})
+                stats['requests'] += hits
+                stats['unique_predictions'] += 1
+                stats['predicted_sum'] += value * hits
+                stats['predicted_min'] = min(stats['predicted_min'], value)
+                stats['predicted_max'] = max(stats['predicted_max'], value)
+        logs.sort(key=lambda r: r.get('created_at') or '', reverse=True)
+        return {
+            'total_requests': sum(r.get('hit_count', 1) for r in logs),
+            'unique_predictions': len(logs),
+            'daily': sorted(groups['daily'].values(), key=lambda r: r['day'], reverse=True)[:days],
+            'by_model_version': list(groups['by_model_version'].values()),
+            'by_weekday': sorted(groups['by_weekday'].values(), key=lambda r: r['weekday']),
+            'recent_predictions': logs[:5]
+        }
+
+    def select(self, table: str, filters: List[Tuple[str, str, str]]) -> List[Dict]:
+        with self.lock:
+            return [dict(row) for row in self.tables.get(table, []) if _matches(row, filters)]
+
+    def update(self, table: str, filters: List[Tuple[str, str, str]], values: Dict) -> List[Dict]:
+        updated = []
+        with self.lock:
+            for row in self.tables.get(table, []):
+                if _matches(row, filters):
+                    row.update(values)
+                    updated.append(dict(row))
+        return updated
+
+    def delete(self, table: str, filters: List[Tuple[str, str, str]]) -> List[Dict]:
+        with self.lock:
+            rows = self.tables.get(table, [])
+            removed = [row for row in rows if _matches(row, filters)]
+            self.tables[table] = [row for row in rows if not _matches(row, filters)]
+        return removed
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return {table: len(rows) for table, rows in self.tables.items()}
+
+
+def _compare_value(value, operand: str):
+    """PostgREST のフィルタ値（文字列）を行の値の型に合わせる"""
+    if isinstance(value, bool):
+        return operand.lower() == 'true'
+    if isinstance(value, (int, float)):
+        try:
+            return type(value)(operand)
+        except ValueError:
+            return operand
+    return operand
+
+
+def _matches(row: Dict, filters: List[Tuple[str, str, str]]) -> bool:
+    for column, op, operand in filters:
+        if column is None:
+            # or=(...) / and=(...) の条件のリスト
+            results = (_matches(row, [condition]) for condition in operand)
+            if not (any(results) if op == 'or' else all(results)):
+                return False
+            continue
+        value = row.get(column)
+        if op == 'is':
+            if operand == 'null' and value is not None:
+                return False
+            continue
+        if op == 'in':
+            options = [o.strip('"') for o in operand.strip('()').split(',')]
+            if str(value) not in options:
+                return False
+            continue
+        if value is None:
+            return False
+        target = _compare_value(value, operand)
+        try:
+            ok = {
+                'eq': value == target, 'neq': value != target,
+                'gt': value > target, 'gte': value >= target,
+                'lt': value < target, 'lte': value <= target
+            }[op]
+        except TypeError:
+            ok = False
+        if not ok:
+            return False
+    return True
+
+
+def _split_top_level(text: str) -> List[str]:
+    """括弧・ダブルクォートの外のカンマで分割する"""
+    parts, depth, quoted, current = [], 0, False, ''
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and char == ',':
+            parts.append(current)
+            current = ''
+            continue
+        current += char
+    return parts + [current] if current else parts
+
+
+def parse_logic(text: str) -> List[Tuple]:
+    """or/and の値 "(列.演算子.値,and(...))" を条件のリストにする"""
+    conditions = []
+    for part in _split_top_level(text.strip()[1:-1]):
+        if part.startswith(('and(', 'or(')):
+            name, _, rest = part.partition('(')
+            conditions.append((None, name, parse_logic('(' + rest)))
+        else:
+            column, op, operand = part.split('.', 2)
+            conditions.append((column, op, operand.strip('"')))
+    return conditions
+
+
+def parse_query(query: str):
+    """クエリ文字列を select / order / limit / offset / フィルタに分解する"""
+    select, order, limit, offset = None, [], None, 0
+    filters = []
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key == 'select':
+            select = [c.strip() for c in value.split(',') if c.strip()]
+        elif key == 'order':
+            for part in value.split(','):
+                column, _, direction = part.partition('.')
+                order.append((column, direction.startswith('desc')))
+        elif key == 'limit':
+            limit = int(value)
+        elif key == 'offset':
+            offset = int(value)
+        elif key == 'on_conflict' or key == 'columns':
+            continue
+        elif key in ('or', 'and'):
+            filters.append((None, key, parse_logic(value)))
+        else:
+            op, _, operand = value.partition('.')
+            if op in FILTER_OPERATORS:
+                filters.append((key, op, operand))
+    return select, order, limit, offset, filters
+
+
+class FakePostgrestServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults: FaultConfig, verbose: bool = False):
+        super().__init__(address, PostgrestHandler)
+        self.faults = faults
+        self.store = MemoryStore()
+        self.verbose = verbose
+        self.stats: Counter = Counter()
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, key: str) -> None:
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def snapshot(self) -> Dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        return {'requests': stats, 'rows': self.store.counts(), 'faults': self.faults.to_dict()}
+
+
+class PostgrestHandler(BaseHTTPRequestHandler):
+    server: FakePostgrestServer
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- 共通処理 ---
+
+    def _table(self) -> Optional[str]:
+        path = urlsplit(self.path).path
+        if not path.startswith(REST_PREFIX):
+            return None
+        return path[len(REST_PREFIX):].strip('/') or None
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _send(self, status: int, payload=None, headers: Optional[Dict] = None):
+        body = b'' if payload is None else json.dumps(payload, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _prefers(self, token: str) -> bool:
+        return token in self.headers.get('Prefer', '')
+
+    def _handle(self, action):
+        table = self._table()
+        # ボディは注入エラーの有無に関わらず読み切る（keep-alive の接続を壊さない）
+        try:
+            body = self._body()
+        except ValueError:
+            self._send(400, {'message': 'invalid JSON body'})
+            return
+        self.server.record(f"{self.command} {table}")
+        time.sleep(self.server.faults.delay())
+        if table is None:
+            self._send(404, {'message': 'not found'})
+            return
+        if self.server.faults.should_fail():
+            self.server.record('injected_errors')
+            self._send(self.server.faults.error_status, {'message': 'injected failure', 'code': 'FAKE'})
+            return
+        action(table, body)
+
+    # --- メソッド ---
+
+    def do_GET(self):
+        self._handle(self._select)
+
+    def do_HEAD(self):
+        self._handle(self._select)
+
+    def do_POST(self):
+        self._handle(self._insert)
+
+    def do_PATCH(self):
+        self._handle(self._update)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _select(self, table, _body):
+        select, order, limit, offset, filters = parse_query(urlsplit(self.path).query)
+        rows = self.server.store.select(table, filters)
+        for column, desc in reversed(order):
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+        total = len(rows)
+        rows = rows[offset:offset + limit if limit is not None else None]
+        if select and select != ['*']:
+            rows = [{c: r.get(c) for c in select} for r in rows]
+        headers = {}
+        if self._prefers('count=exact'):
+            headers['Content-Range'] = f"{offset}-{offset + len(rows) - 1}/{total}" if rows else f"*/{total}"
+        self._send(200, rows, headers)
+
+    def _insert(self, table, body):
+        if table.startswith('rpc/'):
+            self._rpc(table[len('rpc/'):], body or {})
+            return
+        rows = body if isinstance(body, list) else [body or {}]
+        on_conflict = dict(parse_qsl(urlsplit(self.path).query)).get('on_conflict')
+        resolution = None
+        if self._prefers('resolution=ignore-duplicates'):
+            resolution = 'ignore'
+        elif self._prefers('resolution=merge-duplicates'):
+            resolution = 'merge'
+        if on_conflict is None and resolution:
+            on_conflict = 'id'
+        inserted = self.server.store.insert(table, rows, on_conflict if resolution else None, resolution)
+        if self._prefers('return=minimal'):
+            self._send(201)
+        else:
+            self._send(201, inserted)
+
+    def _rpc(self, name, body):
+        if name == 'upsert_prediction_logs':
+            rows = body.get('payload') or []
+            for row in rows:
+                # 関数の ::DATE と同じく、日付でない行が1行でもあればバッチ全体を拒否する
+                try:
+                    date.fromisoformat(str(row.get('prediction_date')))
+                except ValueError:
+                    value = row.get('prediction_date')
+                    self._send(400, {'code': '22007', 'details': None, 'hint': None,
+                                     'message': f'invalid input syntax for type date: "{value}"'})
+                    return
+            self._send(200, self.server.store.upsert_prediction_logs(rows))
+        elif name == 'get_prediction_stats':
+            self._send(200, self.server.store.prediction_stats(int(body.get('days', 30))))
+        else:
+            self._send(404, {'message': f'function {name} not found'})
+
+    def _update(self, table, body):
+        _, _, _, _, filters = parse_query(urlsplit(self.path).query)
+        updated = self.server.store.update(table, filters, body or {})
+        self._send(200, updated)
+
+    def _delete(self, table, _body):
+        _, _, _, _, filters = parse_query(urlsplit(self.path).query)
+        removed = self.server.store.delete(table, filters)
+        self._send(200, removed)
+
+
+def start_server(host: str = '127.0.0.1', port: int = 0, faults: Optional[FaultConfig] = None,
+                 verbose: bool = False) -> FakePostgrestServer:
+    """バックグラウンドスレッドでサーバーを起動する（port=0 なら空きポート）"""
+    server = FakePostgrestServer((host, port), faults or FaultConfig(), verbose)
+    threading.Thread(target=server.serve_forever, name='fake-postgrest', daemon=True).start()
+    return server
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='応答ごとの固定レイテンシ')
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help='レイテンシに加える一様乱数の上限')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='エラー応答を返す割合 0.0-1.0')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--spike-rate', type=float, default=0.0, help='遅延スパイクを起こす割合 0.0-1.0')
+    parser.add_argument('--spike-ms', type=float, default=1000.0, help='遅延スパイクの追加時間')
+
+
+def faults_from_args(args) -> FaultConfig:
+    return FaultConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status,
+                       args.spike_rate, args.spike_ms)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='ローカル PostgREST 代替サーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=54321)
+    parser.add_argument('--verbose', action='store_true')
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakePostgrestServer((args.host, args.port), faults_from_args(args), args.verbose)
+    print(f"fake PostgREST listening on {server.url} (SUPABASE_URL={server.url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.snapshot(), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+ベンチマーク共通処理
+
+レイテンシのパーセンタイル集計、割り当て量の計測、JSON ベースラインの保存と
+回帰判定をまとめる。各ベンチマークスクリプトから import して使う。
+"""
+
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """ソート済みの値から線形補間でパーセンタイルを求める"""
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(latencies_ms: List[float], wall_seconds: float, units: int = 1) -> Dict:
+    """レイテンシ（ms）の配列から p50/p95/p99 とスループットを計算する"""
+    values = sorted(latencies_ms)
+    count = len(values)
+    return {
+        'count': count,
+        'mean_ms': round(sum(values) / count, 4) if count else 0.0,
+        'p50_ms': round(percentile(values, 50), 4),
+        'p95_ms': round(percentile(values, 95), 4),
+        'p99_ms': round(percentile(values, 99), 4),
+        'max_ms': round(values[-1], 4) if count else 0.0,
+        'throughput_per_s': round(count * units / wall_seconds, 2) if wall_seconds > 0 else 0.0
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """計測中はアプリの print 出力を捨てる"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def run_case(func: Callable[[], None], iterations: int, warmup: int = 3,
+             alloc_iterations: int = 5, units: int = 1) -> Dict:
+    """
+    1つのケースを計測する
+
+    タイミングと割り当て量は tracemalloc のオーバーヘッドが混ざらないよう別々に測る。
+
+    Args:
+        func: 計測対象（引数なし）
+        iterations: タイミング計測の回数
+        warmup: 事前実行の回数
+        alloc_iterations: 割り当て量計測の回数
+        units: 1回の呼び出しで処理する件数（スループットの単位）
+    """
+    with quiet():
+        for _ in range(warmup):
+            func()
+
+        gc.collect()
+        latencies = []
+        wall_start = time.perf_counter()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            func()
+            latencies.append((time.perf_counter() - start) * 1000)
+        wall = time.perf_counter() - wall_start
+
+        tracemalloc.start()
+        peak_total = 0
+        allocated_total = 0
+        for _ in range(alloc_iterations):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            snapshot_before = tracemalloc.take_snapshot()
+            func()
+            snapshot_after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - before
+            allocated_total += sum(
+                stat.size_diff for stat in snapshot_after.compare_to(snapshot_before, 'filename') if stat.size_diff > 0
+            )
+        tracemalloc.stop()
+
+    result = summarize(latencies, wall, units)
+    result['alloc_peak_kib'] = round(peak_total / alloc_iterations / 1024, 1)
+    result['alloc_retained_kib'] = round(allocated_total / alloc_iterations / 1024, 1)
+    return result
+
+
+def environment() -> Dict:
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def save_results(path: str, results: Dict) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'cases': results}, f, ensure_ascii=False, indent=2)
+
+
+def load_results(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('cases', {})
+
+
+def compare(results: Dict, baseline: Dict, threshold: float, metric: str = 'p95_ms') -> List[str]:
+    """
+    ベースラインと比較し、閾値（割合）を超えて遅くなったケースの説明を返す
+
+    Args:
+        threshold: 許容する悪化率（0.2 なら 20% まで）
+        metric: 比較する指標
+    """
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base or not base.get(metric):
+            continue
+        ratio = current[metric] / base[metric]
+        if ratio > 1.0 + threshold:
+            regressions.append(f"{name}: {metric} {base[metric]:.3f} -> {current[metric]:.3f} ({(ratio - 1) * 100:+.1f}%)")
+    return regressions
+
+
+def print_table(results: Dict) -> None:
+    header = f"{'case':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10} {'peak KiB':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, r in results.items():
+        print(f"{name:<28} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['p99_ms']:>9.3f} "
+              f"{r['throughput_per_s']:>10.1f} {r['alloc_peak_kib']:>9.1f}")
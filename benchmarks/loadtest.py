@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+エンドツーエンドの負荷試験
+
+ローカルの PostgREST 代替サーバー（fake_postgrest.py）を起動し、SUPABASE_URL を
+そこへ向けたバックエンド（gunicorn または ASGI/uvicorn）を子プロセスで立ち上げて、
+ダッシュボード相当のトラフィック（単日・週間・月間予測、履歴）を並列に流す。
+エンドポイントごとのスループット・レイテンシのパーセンタイル・エラー率と、
+Supabase 側に届いたリクエスト数を表示する。
+
+Supabase 側のレイテンシやエラーを変えながら、ログ書き込みやプーリングの変更が
+本番相当の往復でどう効くかを測るためのもの。
+
+使い方:
+    python benchmarks/loadtest.py --model fixed_rf_model.joblib --duration 30 --concurrency 16
+    python benchmarks/loadtest.py --model fixed_rf_model.joblib --server asgi --latency-ms 80 --error-rate 0.05
+    python benchmarks/loadtest.py --model fixed_rf_model.joblib --mix predict=70,history=30 --json out.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+from fake_postgrest import add_fault_arguments, faults_from_args, start_server
+from harness import BACKEND_DIR, ROOT, environment, summarize
+
+DEFAULT_MIX = 'predict=55,week=20,month=10,history=15'
+FAKE_SUPABASE_KEY = 'loadtest-anon-key'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def random_date() -> str:
+    return (date(2025, 1, 1) + timedelta(days=random.randrange(365))).isoformat()
+
+
+def random_inputs() -> dict:
+    """学習データの範囲に収まる入力値"""
+    return {
+        'total_outpatient': random.randint(300, 900),
+        'intro_outpatient': random.randint(5, 40),
+        'ER': random.randint(5, 35),
+        'bed_count': random.randint(200, 320)
+    }
+
+
+def request_predict():
+    return 'POST', '/api/predict', {'date': random_date(), **random_inputs()}
+
+
+def request_week():
+    return 'POST', '/api/predict_week', {'start_date': random_date(), **random_inputs()}
+
+
+def request_month():
+    return 'POST', '/api/predict_month', {'year': 2025, 'month': random.randint(1, 12), **random_inputs()}
+
+
+def request_history():
+    return 'GET', f"/api/history?limit={random.choice([20, 50, 100])}", None
+
+
+REQUEST_BUILDERS = {
+    'predict': request_predict,
+    'week': request_week,
+    'month': request_month,
+    'history': request_history
+}
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in REQUEST_BUILDERS:
+            raise ValueError(f"不明なエンドポイント: {name}（{', '.join(REQUEST_BUILDERS)}）")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def start_backend(args, supabase_url: str, port: int, workdir: str) -> subprocess.Popen:
+    """バックエンドを子プロセスで起動する（出力は workdir/backend.log）"""
+    env = dict(
+        os.environ,
+        SUPABASE_URL=supabase_url,
+        SUPABASE_KEY=FAKE_SUPABASE_KEY,
+        RF_MODEL_PATH=os.path.abspath(args.model),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'prometheus'),
+        PYTHONWARNINGS='ignore'
+    )
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(args.workers), '--no-access-log']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(args.workers), '--threads', str(args.threads), '--timeout', '600']
+    log = open(os.path.join(workdir, 'backend.log'), 'wb')
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(port: int, process: subprocess.Popen, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/health')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+class LoadRunner:
+    """固定数のワーカースレッドで、指定の配分に従ってリクエストを送り続ける"""
+
+    def __init__(self, port: int, mix: dict, concurrency: int, timeout: float):
+        self.port = port
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+
+    def _worker(self, deadline: float):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        local_latencies = defaultdict(list)
+        local_errors = defaultdict(lambda: defaultdict(int))
+        while time.perf_counter() < deadline:
+            name = random.choices(self.names, self.weights)[0]
+            method, path, payload = REQUEST_BUILDERS[name]()
+            body = json.dumps(payload) if payload is not None else None
+            headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'} if body else {'Accept-Encoding': 'gzip'}
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                elapsed = (time.perf_counter() - start) * 1000
+                local_latencies[name].append(elapsed)
+                if response.status >= 400:
+                    local_errors[name][str(response.status)] += 1
+            except Exception as e:
+                local_latencies[name].append((time.perf_counter() - start) * 1000)
+                local_errors[name][type(e).__name__] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        conn.close()
+        with self.lock:
+            for name, values in local_latencies.items():
+                self.latencies[name].extend(values)
+            for name, counts in local_errors.items():
+                for key, count in counts.items():
+                    self.errors[name][key] += count
+
+    def run(self, duration: float) -> float:
+        deadline = time.perf_counter() + duration
+        threads = [threading.Thread(target=self._worker, args=(deadline,), daemon=True) for _ in range(self.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def report(self, wall: float) -> dict:
+        endpoints = {}
+        all_latencies = []
+        total_errors = 0
+        for name in self.names:
+            values = self.latencies.get(name, [])
+            if not values:
+                continue
+            errors = sum(self.errors[name].values())
+            total_errors += errors
+            all_latencies.extend(values)
+            endpoints[name] = {
+                **summarize(values, wall),
+                'errors': errors,
+                'error_rate': round(errors / len(values), 4),
+                'error_kinds': dict(self.errors[name])
+            }
+        overall = summarize(all_latencies, wall) if all_latencies else {}
+        if all_latencies:
+            overall.update({'errors': total_errors, 'error_rate': round(total_errors / len(all_latencies), 4)})
+        return {'overall': overall, 'endpoints': endpoints}
+
+
+def print_report(report: dict, supabase: dict) -> None:
+    header = f"{'endpoint':<10} {'count':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}"
+    print(header)
+    print('-' * len(header))
+    rows = list(report['endpoints'].items())
+    if report['overall']:
+        rows.append(('overall', report['overall']))
+    for name, r in rows:
+        print(f"{name:<10} {r['count']:>7} {r['throughput_per_s']:>8.1f} {r['p50_ms']:>9.1f} "
+              f"{r['p95_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['error_rate']:>7.1%}")
+    print('\nSupabase (fake PostgREST) requests:')
+    for key, count in sorted(supabase['requests'].items()):
+        print(f"  {key:<32} {count:>7}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='エンドツーエンド負荷試験')
+    parser.add_argument('--model', default=os.environ.get('RF_MODEL_PATH', os.path.join(ROOT, 'fixed_rf_model.joblib')),
+                        help='RandomForest モデル（fixed_rf_model.joblib）のパス')
+    parser.add_argument('--server', choices=['gunicorn', 'asgi'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='バックエンドのワーカープロセス数')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn のワーカーあたりスレッド数')
+    parser.add_argument('--concurrency', type=int, default=16, help='同時に送るクライアント数')
+    parser.add_argument('--duration', type=float, default=30.0, help='計測時間（秒）')
+    parser.add_argument('--warmup', type=float, default=3.0, help='計測前に流す時間（秒）')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'エンドポイントの配分（既定: {DEFAULT_MIX}）')
+    parser.add_argument('--timeout', type=float, default=30.0, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"モデルファイルが見つかりません: {args.model}（--model か RF_MODEL_PATH で指定してください）")
+        return 2
+    if args.seed is not None:
+        random.seed(args.seed)
+    mix = parse_mix(args.mix)
+
+    fake = start_server(faults=faults_from_args(args))
+    workdir = tempfile.mkdtemp(prefix='inhospital_loadtest_')
+    port = free_port()
+    backend = start_backend(args, fake.url, port, workdir)
+    try:
+        if not wait_ready(port, backend, args.startup_timeout):
+            print(f"バックエンドが起動しませんでした（ログ: {os.path.join(workdir, 'backend.log')}）")
+            return 2
+        print(f"backend={args.server} workers={args.workers} concurrency={args.concurrency} "
+              f"supabase={fake.url} latency={args.latency_ms}ms±{args.jitter_ms} error_rate={args.error_rate}",
+              file=sys.stderr)
+
+        if args.warmup > 0:
+            LoadRunner(port, mix, args.concurrency, args.timeout).run(args.warmup)
+        baseline_requests = fake.snapshot()['requests']
+
+        runner = LoadRunner(port, mix, args.concurrency, args.timeout)
+        wall = runner.run(args.duration)
+        report = runner.report(wall)
+        supabase = fake.snapshot()
+        supabase['requests'] = {k: v - baseline_requests.get(k, 0) for k, v in supabase['requests'].items()
+                                if v - baseline_requests.get(k, 0)}
+        print_report(report, supabase)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'environment': environment(),
+                    'config': {k: v for k, v in vars(args).items() if k != 'json'},
+                    'report': report,
+                    'supabase': supabase
+                }, f, ensure_ascii=False, indent=2)
+    finally:
+        backend.terminate()
+        try:
+            backend.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            backend.kill()
+        fake.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,37 +7,46 @@
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import joblib
 import pandas as pd
 import numpy as np
+import os
+import sys
+import threading
 import warnings
+from collections import OrderedDict
 
 # 警告を非表示
 warnings.filterwarnings("ignore")
 
+# 推論コアとメトリクスは backend と共通
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from inference import FEATURE_COLUMNS, load_engine
+from metrics import init_metrics
+from http_cache import file_digest
+
 app = Flask(__name__)
 CORS(app)
+init_metrics(app)
 
-# グローバル変数
-model = None
+# グローバル変数（推論エンジン）
+engine = None
 
 def load_model():
-    """モデルをロード"""
-    global model
-    try:
-        model = joblib.load('fixed_rf_model.joblib')
-        print("✅ モデルロード完了")
-        return True
-    except Exception as e:
-        print(f"❌ モデルロード失敗: {e}")
+    """モデルをロード（RF_MODEL_PATH で指定可能）"""
+    global engine
+    engine = load_engine([os.environ.get('RF_MODEL_PATH', 'fixed_rf_model.joblib')], fallback=False)
+    if engine is None:
+        print("❌ モデルロード失敗")
         return False
+    print("✅ モデルロード完了")
+    return True
 
 @app.route('/api/health', methods=['GET'])
 def health():
     """ヘルスチェック"""
     return jsonify({
         "status": "ok",
-        "model_loaded": model is not None
+        "model_loaded": engine is not None
     })
 
 @app.route('/api/predict_raw', methods=['POST'])
@@ -47,30 +56,22 @@ def predict_raw():
     受け取った特徴量をそのままモデルに渡す
     """
     try:
-        if model is None:
+        if engine is None:
             return jsonify({"error": "モデルが未ロード"}), 500
         
         data = request.json
         if not data:
             return jsonify({"error": "データなし"}), 400
         
-        # 必要な特徴量（CSVの順序通り）
-        required_features = [
-            'mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun',
-            'public_holiday', 'public_holiday_previous_day',
-            'total_outpatient', 'intro_outpatient', 'ER', 'bed_count'
-        ]
-        
-        # 特徴量を抽出
+        # 特徴量を抽出（CSVの順序通り）
         features = {}
-        for feature in required_features:
+        for feature in FEATURE_COLUMNS:
             if feature not in data:
                 return jsonify({"error": f"特徴量 '{feature}' がありません"}), 400
             features[feature] = data[feature]
         
-        # DataFrameに変換してモデルで予測
-        X = pd.DataFrame([features])
-        prediction = model.predict(X)[0]
+        # モデルで予測
+        prediction = engine.predict_one(features)
         
         return jsonify({
             "prediction": float(prediction),
@@ -81,42 +82,131 @@ def predict_raw():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 評価に使う実データ（CSV）
+EVAL_DATA_PATH = os.environ.get('EVAL_DATA_PATH', 'ultimate_pickup_data.csv')
+# 評価結果をキャッシュする (モデル, データ) の組数
+EVAL_CACHE_SIZE = 4
+MAX_PER_PAGE = 1000
+
+# (モデルのハッシュ, データのハッシュ) -> 全行の評価結果（DataFrame）
+_eval_cache = OrderedDict()
+_eval_lock = threading.Lock()
+
+def evaluate_dataset():
+    """
+    CSV 全行をまとめて1回（大きければチャンク並列）で予測し、行ごとの評価結果を返す
+
+    モデルファイルと CSV の内容ハッシュごとにキャッシュし、どちらかが変わるまで再計算しない。
+
+    Returns:
+        (評価結果の DataFrame, モデルのハッシュ, データのハッシュ, キャッシュヒットか)
+    """
+    key = (file_digest(engine.model_path), file_digest(os.path.abspath(EVAL_DATA_PATH)))
+    with _eval_lock:
+        if key in _eval_cache:
+            _eval_cache.move_to_end(key)
+            return _eval_cache[key], key[0], key[1], True
+
+        data = pd.read_csv(EVAL_DATA_PATH)
+        X = data[FEATURE_COLUMNS].to_numpy(dtype=float)
+        valid = np.isfinite(X).all(axis=1)
+        predicted = np.full(len(data), np.nan)
+        rows = np.flatnonzero(valid)
+        for start, end, values, error in engine.iter_chunks(X[rows]):
+            if error is not None:
+                raise error
+            predicted[rows[start:end]] = values
+
+        result = data.copy()
+        result['parsed_date'] = pd.to_datetime(result['date'], format='%Y/%m/%d', errors='coerce')
+        result['actual'] = result['y'].astype(float)
+        result['predicted'] = predicted
+        result['error'] = (result['predicted'] - result['actual']).abs()
+
+        _eval_cache[key] = result
+        while len(_eval_cache) > EVAL_CACHE_SIZE:
+            _eval_cache.popitem(last=False)
+        return result, key[0], key[1], False
+
+def error_metrics(frame):
+    """予測値と実測値がそろった行の誤差指標"""
+    scored = frame.dropna(subset=['actual', 'predicted'])
+    if scored.empty:
+        return {"count": 0}
+    diff = scored['predicted'] - scored['actual']
+    actual = scored['actual']
+    nonzero = actual != 0
+    total_variance = float(((actual - actual.mean()) ** 2).sum())
+    return {
+        "count": int(len(scored)),
+        "mae": round(float(diff.abs().mean()), 4),
+        "rmse": round(float(np.sqrt((diff ** 2).mean())), 4),
+        "mape": round(float((diff[nonzero].abs() / actual[nonzero]).mean() * 100), 4) if nonzero.any() else None,
+        "bias": round(float(diff.mean()), 4),
+        "max_error": round(float(diff.abs().max()), 4),
+        "r2": round(1 - float((diff ** 2).sum()) / total_variance, 4) if total_variance else None
+    }
+
+def _nullable(value):
+    return None if pd.isna(value) else float(value)
+
 @app.route('/api/test_with_actual', methods=['GET'])
 def test_with_actual():
     """
     実際のCSVデータを使ってテスト
+
+    全行（または start_date〜end_date の範囲、YYYY-MM-DD）の誤差指標と、
+    行ごとの結果をページ単位（page, per_page）で返す。
     """
     try:
-        if model is None:
+        if engine is None:
             return jsonify({"error": "モデルが未ロード"}), 500
         
-        # CSVデータを読み込み
-        data = pd.read_csv('ultimate_pickup_data.csv')
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = min(MAX_PER_PAGE, max(1, request.args.get('per_page', 100, type=int)))
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        
+        # 全行の評価（モデル・データが変わらなければキャッシュから）
+        evaluated, model_hash, data_hash, cached = evaluate_dataset()
         
-        # 最初の5行でテスト
-        results = []
-        for i in range(5):
-            row = data.iloc[i]
-            actual_y = float(row['y'])
-            
-            # 特徴量を抽出
-            features = row.drop(['date', 'y']).to_dict()
-            X = pd.DataFrame([features])
-            
-            # 予測
-            pred = model.predict(X)[0]
-            
-            results.append({
-                "row": i + 1,
+        # 日付範囲で絞り込み
+        frame = evaluated
+        try:
+            if start_date:
+                frame = frame[frame['parsed_date'] >= pd.Timestamp(start_date)]
+            if end_date:
+                frame = frame[frame['parsed_date'] <= pd.Timestamp(end_date)]
+        except ValueError:
+            return jsonify({"error": "start_date / end_date は YYYY-MM-DD 形式で指定してください"}), 400
+        
+        total = len(frame)
+        page_rows = frame.iloc[(page - 1) * per_page: page * per_page]
+        results = [
+            {
+                "row": int(index) + 1,
                 "date": row['date'],
-                "actual": actual_y,
-                "predicted": float(pred),
-                "error": float(abs(pred - actual_y)),
-                "features": {k: float(v) if isinstance(v, np.integer) else v for k, v in features.items()}
-            })
+                "actual": _nullable(row['actual']),
+                "predicted": _nullable(row['predicted']),
+                "error": _nullable(row['error']),
+                "features": {c: float(row[c]) for c in FEATURE_COLUMNS}
+            }
+            for index, row in page_rows.iterrows()
+        ]
         
         return jsonify({
+            "metrics": error_metrics(frame),
             "test_results": results,
+            "pagination": {
+                "page": page,
+                "per_page": per_page,
+                "total": total,
+                "pages": (total + per_page - 1) // per_page
+            },
+            "range": {"start_date": start_date, "end_date": end_date},
+            "model_hash": model_hash,
+            "data_hash": data_hash,
+            "cached": cached,
             "message": "実データとの比較（介入なし）"
         })
         
@@ -133,7 +223,7 @@ if __name__ == '__main__':
     print("🔍 利用可能エンドポイント:")
     print("  GET  /api/health - ヘルスチェック")
     print("  POST /api/predict_raw - 純粋な予測")
-    print("  GET  /api/test_with_actual - 実データテスト")
+    print("  GET  /api/test_with_actual - 実データテスト（?start_date=&end_date=&page=&per_page=）")
     print()
     print("📍 サーバー: http://localhost:9000")
     
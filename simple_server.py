@@ -5,16 +5,15 @@
 ローカルデプロイ用の最小構成
 """
 
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from flask_cors import CORS
-import logging
-from logging.handlers import RotatingFileHandler
-import joblib
 import pandas as pd
 import numpy as np
 from datetime import datetime
+import json
 import time
 import os
+import sys
 import warnings
 
 # 警告を非表示にする（既知の互換性警告のため）
@@ -24,55 +23,38 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 app = Flask(__name__)
 CORS(app)  # 開発用にCORSを有効化
 
-# --- Logging setup: rotating file + console, request/response/error tracing ---
-def setup_logging(flask_app: Flask) -> None:
-    try:
-        log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-        os.makedirs(log_dir, exist_ok=True)
-        log_file_path = os.path.join(log_dir, 'simple_server.log')
-
-        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s')
-        root_logger = logging.getLogger()
-        root_logger.setLevel(logging.INFO)
-
-        file_handler = RotatingFileHandler(
-            log_file_path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'
-        )
-        file_handler.setFormatter(formatter)
-        file_handler.setLevel(logging.INFO)
+# --- Logging setup: queue-based structured logging, request/response/error tracing ---
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from log_pipeline import setup_logging, request_body_preview
 
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        console_handler.setLevel(logging.INFO)
+setup_logging(app, os.path.join(os.path.dirname(__file__), 'logs'), 'simple_server.log')
 
-        if not any(isinstance(h, RotatingFileHandler) for h in root_logger.handlers):
-            root_logger.addHandler(file_handler)
-        if not any(isinstance(h, logging.StreamHandler) and not isinstance(h, RotatingFileHandler) for h in root_logger.handlers):
-            root_logger.addHandler(console_handler)
+# オンデマンドのリクエストプロファイリング（PROFILE_TOKEN 設定時のみ有効）
+from profiling import init_profiling
+init_profiling(app, os.path.join(os.path.dirname(__file__), 'logs', 'profiles'))
 
-        flask_app.logger.handlers = root_logger.handlers
-        flask_app.logger.setLevel(logging.INFO)
-        flask_app.logger.info('Logging initialized (simple_server)')
-    except Exception as log_err:
-        print(f"Failed to setup logging: {log_err}")
-
-
-setup_logging(app)
+# 推論コアとメトリクス（/metrics）は backend と共通
+from inference import build_features, day_features, DAY_CODES, FEATURE_COLUMNS, load_engine
+from metrics import init_metrics
+init_metrics(app)
 
 @app.before_request
 def _log_request():
     g.request_start_time = time.time()
     g.request_id = f"{int(g.request_start_time * 1000)}-{os.getpid()}"
-    body_preview = ''
     try:
-        if request.is_json:
-            body_preview = str(request.get_json(silent=True))
-            if body_preview and len(body_preview) > 500:
-                body_preview = body_preview[:500] + '...'
+        body_preview = request_body_preview(request)
     except Exception:
         body_preview = '<unparsable>'
     app.logger.info(
-        f"[{g.request_id}] {request.method} {request.path} from {request.remote_addr} body={body_preview}"
+        f"[{g.request_id}] {request.method} {request.path} from {request.remote_addr}",
+        extra={
+            'request_id': g.request_id,
+            'method': request.method,
+            'path': request.path,
+            'remote_addr': request.remote_addr,
+            'body': body_preview
+        }
     )
 
 
@@ -81,7 +63,14 @@ def _log_response(response):
     try:
         duration_ms = int((time.time() - getattr(g, 'request_start_time', time.time())) * 1000)
         app.logger.info(
-            f"[{getattr(g, 'request_id', '-')}] {request.method} {request.path} -> {response.status_code} in {duration_ms}ms"
+            f"[{getattr(g, 'request_id', '-')}] {request.method} {request.path} -> {response.status_code} in {duration_ms}ms",
+            extra={
+                'request_id': getattr(g, 'request_id', ''),
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': duration_ms
+            }
         )
         response.headers['X-Request-ID'] = getattr(g, 'request_id', '')
         response.headers['X-Process-Time'] = str(duration_ms)
@@ -95,19 +84,18 @@ def _handle_exception(e):
     app.logger.exception(f"[{getattr(g, 'request_id', '-')}] Unhandled exception: {e}")
     return jsonify({"error": str(e), "request_id": getattr(g, 'request_id', '')}), 500
 
-# グローバル変数でモデルを保持
-model = None
+# グローバル変数でモデル（推論エンジン）を保持
+engine = None
 
 def load_model():
-    """モデルを読み込む"""
-    global model
-    try:
-        model = joblib.load('fixed_rf_model.joblib')
-        print("✅ モデルを正常にロードしました")
-        return True
-    except Exception as e:
-        print(f"❌ モデルのロードに失敗: {e}")
+    """モデルを読み込む（RF_MODEL_PATH で指定可能）"""
+    global engine
+    engine = load_engine([os.environ.get('RF_MODEL_PATH', 'fixed_rf_model.joblib')], fallback=False)
+    if engine is None:
+        print("❌ モデルのロードに失敗")
         return False
+    print("✅ モデルを正常にロードしました")
+    return True
 
 def get_day_features(date_str=None):
     """日付から曜日特徴量を取得"""
@@ -120,21 +108,27 @@ def get_day_features(date_str=None):
         date_obj = datetime.now()
     
     # 曜日のone-hotエンコーディング
-    weekday = date_obj.weekday()  # 0:月曜, 1:火曜, ..., 6:日曜
-    days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
-    
-    day_features = {}
-    for i, day in enumerate(days):
-        day_features[day] = 1 if i == weekday else 0
-    
-    return day_features, days[weekday]
+    day_code = DAY_CODES[date_obj.weekday()]  # 0:月曜, 1:火曜, ..., 6:日曜
+    return day_features(day_code), day_code
+
+def scenario_features(data, day_code):
+    """リクエストの入力値（未指定なら標準値）からモデルの特徴量を作る"""
+    return build_features(
+        day_code,
+        public_holiday=int(data.get('public_holiday', 0)),
+        public_holiday_previous_day=int(data.get('public_holiday_previous_day', 0)),
+        total_outpatient=int(data.get('total_outpatient', 500)),
+        intro_outpatient=int(data.get('intro_outpatient', 20)),
+        ER=int(data.get('ER', 15)),
+        bed_count=int(data.get('bed_count', 280))
+    )
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """ヘルスチェック"""
     return jsonify({
         "status": "healthy",
-        "model_loaded": model is not None,
+        "model_loaded": engine is not None,
         "current_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     })
 
@@ -142,7 +136,7 @@ def health_check():
 def predict():
     """予測API"""
     try:
-        if model is None:
+        if engine is None:
             return jsonify({"error": "モデルがロードされていません"}), 500
         
         # リクエストデータを取得
@@ -152,27 +146,15 @@ def predict():
         
         print(f"受信データ: {data}")
         
-        # 日付から曜日特徴量を取得
+        # 日付から曜日を取得
         date_str = data.get('date', datetime.now().strftime('%Y-%m-%d'))
-        day_features, day_name = get_day_features(date_str)
+        _, day_name = get_day_features(date_str)
         
         # 特徴量を構築
-        features = {
-            **day_features,
-            'public_holiday': int(data.get('public_holiday', 0)),
-            'public_holiday_previous_day': int(data.get('public_holiday_previous_day', 0)),
-            'total_outpatient': int(data.get('total_outpatient', 500)),
-            'intro_outpatient': int(data.get('intro_outpatient', 20)),
-            'ER': int(data.get('ER', 15)),
-            'bed_count': int(data.get('bed_count', 280))
-        }
-        
-        # DataFrameに変換
-        df = pd.DataFrame([features])
+        features = scenario_features(data, day_name)
         
         # 予測実行
-        prediction = model.predict(df)
-        prediction_value = float(prediction[0])
+        prediction_value = engine.predict_one(features)
         
         # 結果を返す
         result = {
@@ -190,11 +172,80 @@ def predict():
         print(f"予測エラー: {e}")
         return jsonify({"error": str(e)}), 500
 
+# 一括予測の1リクエストあたりのシナリオ数の上限
+MAX_BATCH_SCENARIOS = int(os.environ.get('PREDICT_BATCH_MAX_SCENARIOS', 100000))
+
+# シナリオの入力項目と未指定時の標準値
+SCENARIO_DEFAULTS = [
+    ('public_holiday', 0),
+    ('public_holiday_previous_day', 0),
+    ('total_outpatient', 500),
+    ('intro_outpatient', 20),
+    ('ER', 15),
+    ('bed_count', 280)
+]
+
+def encode_scenarios(scenarios):
+    """
+    全シナリオをまとめて特徴量行列にする
+
+    日付は pandas で一括パースし（不正・未指定なら今日の曜日）、入力値は int() と同じく
+    小数部を切り捨てる。数値にできない行は行番号ごとのエラーにする。
+
+    Returns:
+        (特徴量行列, 曜日コードのリスト, 行番号 -> エラーメッセージ)
+    """
+    rows = [s if isinstance(s, dict) else {} for s in scenarios]
+    errors = {i: "シナリオは dict で指定してください" for i, s in enumerate(scenarios) if not isinstance(s, dict)}
+
+    dates = pd.to_datetime(
+        pd.Series([r.get('date') if isinstance(r.get('date'), str) else None for r in rows], dtype=object),
+        format='%Y-%m-%d', errors='coerce'
+    )
+    weekdays = dates.dt.weekday.fillna(datetime.now().weekday()).astype(int).to_numpy()
+
+    X = np.zeros((len(rows), len(FEATURE_COLUMNS)))
+    X[np.arange(len(rows)), weekdays] = 1
+    for column, default in SCENARIO_DEFAULTS:
+        values = pd.to_numeric(
+            pd.Series([r.get(column, default) for r in rows], dtype=object), errors='coerce'
+        ).to_numpy(dtype=float)
+        for i in np.flatnonzero(~np.isfinite(values)):
+            errors.setdefault(int(i), f"'{column}' が数値ではありません: {rows[i].get(column)!r}")
+        X[:, FEATURE_COLUMNS.index(column)] = np.trunc(np.nan_to_num(values))
+    return X, [DAY_CODES[w] for w in weekdays], errors
+
+def iter_batch_results(scenarios, X, day_names, errors):
+    """チャンクごとの推論結果を入力順に1件ずつ返す（大きいバッチはチャンク並列）"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    for start, end, values, chunk_error in engine.iter_chunks(X):
+        for i in range(start, end):
+            scenario = scenarios[i] if isinstance(scenarios[i], dict) else {}
+            result = {
+                "prediction": None,
+                "date": scenario.get('date', today),
+                "day": day_names[i],
+                "scenario_name": scenario.get('name', f'シナリオ{i + 1}')
+            }
+            if i in errors:
+                result["error"] = errors[i]
+            elif chunk_error is not None:
+                result["error"] = f"推論に失敗しました: {chunk_error}"
+            else:
+                result["prediction"] = round(float(values[i - start]), 2)
+            yield result
+
 @app.route('/api/predict_batch', methods=['POST'])
 def predict_batch():
-    """複数の予測を一括実行"""
+    """
+    複数の予測を一括実行
+
+    全シナリオをまとめてエンコードし、小さいバッチは1回、大きいバッチはチャンクに分けて
+    並列に推論する。`?stream=1`（またはボディの "stream": true）で1行1件の NDJSON を
+    チャンクが終わるたびに逐次返す（最終行は件数のサマリ）。
+    """
     try:
-        if model is None:
+        if engine is None:
             return jsonify({"error": "モデルがロードされていません"}), 500
         
         data = request.json
@@ -202,35 +253,27 @@ def predict_batch():
         
         if not scenarios:
             return jsonify({"error": "シナリオデータがありません"}), 400
+        if not isinstance(scenarios, list):
+            return jsonify({"error": "scenarios は配列で指定してください"}), 400
+        if len(scenarios) > MAX_BATCH_SCENARIOS:
+            return jsonify({"error": f"シナリオ数が上限（{MAX_BATCH_SCENARIOS}件）を超えています: {len(scenarios)}件"}), 413
         
-        results = []
-        for scenario in scenarios:
-            # 各シナリオで予測
-            day_features, day_name = get_day_features(scenario.get('date'))
-            
-            features = {
-                **day_features,
-                'public_holiday': int(scenario.get('public_holiday', 0)),
-                'public_holiday_previous_day': int(scenario.get('public_holiday_previous_day', 0)),
-                'total_outpatient': int(scenario.get('total_outpatient', 500)),
-                'intro_outpatient': int(scenario.get('intro_outpatient', 20)),
-                'ER': int(scenario.get('ER', 15)),
-                'bed_count': int(scenario.get('bed_count', 280))
-            }
-            
-            df = pd.DataFrame([features])
-            prediction = model.predict(df)
-            
-            results.append({
-                "prediction": round(float(prediction[0]), 2),
-                "date": scenario.get('date', datetime.now().strftime('%Y-%m-%d')),
-                "day": day_name,
-                "scenario_name": scenario.get('name', f'シナリオ{len(results)+1}')
-            })
+        X, day_names, errors = encode_scenarios(scenarios)
+        
+        if request.args.get('stream') in ('1', 'true') or data.get('stream') is True:
+            def generate():
+                failed = 0
+                for result in iter_batch_results(scenarios, X, day_names, errors):
+                    failed += 'error' in result
+                    yield json.dumps(result, ensure_ascii=False) + '\n'
+                yield json.dumps({"count": len(scenarios), "failed": failed}) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
         
+        results = list(iter_batch_results(scenarios, X, day_names, errors))
         return jsonify({
             "predictions": results,
-            "count": len(results)
+            "count": len(results),
+            "failed": sum('error' in r for r in results)
         })
         
     except Exception as e:
@@ -1,4 +1,5 @@
 -- 病院内予測システム用テーブル
+-- このファイルの後に backend/sql/prediction_logs.sql（予測ログの冪等キー・集計テーブルと関数・トリガー）を実行する
 
 -- 予測ログテーブル
 CREATE TABLE prediction_logs (
@@ -12,6 +13,11 @@ CREATE TABLE prediction_logs (
     public_holiday BOOLEAN DEFAULT FALSE,
     day_of_week VARCHAR(10),
     features JSONB,
+    -- 同じモデル・予測日・特徴量の予測は1行にまとめ、回数と最後のリクエスト時刻を更新する
+    model_version VARCHAR(64),
+    fingerprint VARCHAR(32),
+    hit_count INTEGER NOT NULL DEFAULT 1,
+    last_seen_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
@@ -35,7 +41,9 @@ CREATE TABLE app_settings (
 
 -- インデックス作成
 CREATE INDEX idx_prediction_logs_date ON prediction_logs(prediction_date);
-CREATE INDEX idx_prediction_logs_created_at ON prediction_logs(created_at);
+-- /api/history のキーセットページネーション（created_at, id の降順）
+CREATE INDEX idx_prediction_logs_created_at_id ON prediction_logs(created_at, id);
+CREATE UNIQUE INDEX idx_prediction_logs_fingerprint ON prediction_logs(fingerprint);
 CREATE INDEX idx_app_settings_key ON app_settings(setting_key);
 
 -- Row Level Security (RLS) 有効化